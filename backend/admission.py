@@ -0,0 +1,169 @@
+import os
+import math
+import time
+import asyncio
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
+from fastapi import HTTPException
+from workers import get_io_pool
+import metrics
+
+# How much a page or megabyte of input costs, relative to a plain rewrite.
+# Ghostscript re-renders every page, so compression weighs the most.
+OPERATION_WEIGHTS = {
+    "compress": 10,
+    "thumbnails": 2,
+    "lock": 2,
+    "unlock": 1,
+    "merge": 1,
+    "split": 1,
+    "delete": 1,
+}
+# Extreme compression also downsamples every image.
+LEVEL_WEIGHTS = {"extreme": 2}
+REQUEST_COST = 1.0
+PAGE_COST = 0.1
+MB_COST = 1.0
+PRUNE_INTERVAL = 60
+
+
+def request_cost(
+    operation: str, sizes: List[int], pages: int, level: Optional[str] = None
+) -> float:
+    weight = OPERATION_WEIGHTS.get(operation, 1) * LEVEL_WEIGHTS.get(level, 1)
+    megabytes = sum(sizes) / (1024 * 1024)
+    return REQUEST_COST + weight * (pages * PAGE_COST + megabytes * MB_COST)
+
+
+def _take(
+    tokens: float, updated: float, now: float, cost: float, rate: float, burst: float
+) -> Tuple[float, float]:
+    # Returns (tokens left, seconds to wait). A cost above the burst is let
+    # through once the bucket is full and leaves it in debt, so a huge job is
+    # paid for by the requests that follow it.
+    tokens = min(burst, tokens + (now - updated) * rate)
+    needed = min(cost, burst)
+    if tokens >= needed:
+        return tokens - cost, 0.0
+    return tokens, (needed - tokens) / rate
+
+
+class MemoryBuckets:
+    # Per process; only right with a single uvicorn worker.
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._pruned = time.time()
+
+    def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, wait = _take(tokens, updated, now, cost, rate, burst)
+            self._buckets[key] = (tokens, now)
+            if now - self._pruned > PRUNE_INTERVAL:
+                # A bucket idle this long is full again, the same as no bucket.
+                limit = now - burst / rate
+                self._buckets = {
+                    k: v for k, v in self._buckets.items() if v[1] >= limit
+                }
+                self._pruned = now
+        return wait
+
+
+class SqliteBuckets:
+    # Shared by every uvicorn worker on the node, so the budget is per client
+    # rather than per client and process.
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._pruned = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+
+    def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, wait = _take(tokens, updated, now, cost, rate, burst)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now)
+            )
+            if now - self._pruned > PRUNE_INTERVAL:
+                conn.execute(
+                    "DELETE FROM buckets WHERE updated_at < ?", (now - burst / rate,)
+                )
+                self._pruned = now
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return wait
+
+
+class AdmissionController:
+    # Token buckets per client, refilled at rate tokens per second up to burst.
+    # Work that is over budget waits up to max_wait for the bucket to refill
+    # and is only rejected when it would have to wait longer than that.
+    def __init__(self, buckets, rate: float, burst: float, max_wait: float):
+        self.buckets = buckets
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    async def admit(self, client: str, operation: str, cost: float):
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.max_wait
+        queued = False
+        while True:
+            wait = await loop.run_in_executor(
+                get_io_pool(), self.buckets.take, client, cost, self.rate, self.burst
+            )
+            if wait <= 0:
+                metrics.inc("admission_cost_total", cost, operation=operation)
+                return
+            if time.monotonic() + wait > deadline:
+                metrics.inc("admission_rejected_total", operation=operation)
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many requests, please try again later.",
+                    headers={"Retry-After": str(math.ceil(wait))},
+                )
+            if not queued:
+                metrics.inc("admission_queued_total", operation=operation)
+                queued = True
+            await asyncio.sleep(wait)
+
+
+def create_admission_controller() -> Optional[AdmissionController]:
+    rate = float(os.getenv("ADMISSION_RATE", 10))
+    if rate <= 0:
+        return None
+    if os.getenv("ADMISSION_STORE", "sqlite").lower() == "sqlite":
+        buckets = SqliteBuckets(os.getenv("ADMISSION_DB_PATH", "admission.db"))
+    else:
+        buckets = MemoryBuckets()
+    return AdmissionController(
+        buckets,
+        rate,
+        float(os.getenv("ADMISSION_BURST", 100)),
+        float(os.getenv("ADMISSION_MAX_WAIT", 10)),
+    )
@@ -0,0 +1,88 @@
+# Wall-clock comparison of single-pass vs sharded Ghostscript compression.
+#
+#   python benchmarks/bench_sharded_compress.py --pages 1000 --workers 1,2,4,8
+#   python benchmarks/bench_sharded_compress.py --input scan.pdf
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+import gs_pool
+from pdf_utils import compress_pdf, compress_pdf_sharded, SHARD_PAGES
+
+
+def make_document(path: str, pages: int):
+    # A scan-like document: every page carries its own noisy image plus text.
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        samples = os.urandom(300 * 100 * 3) * 4
+        pixmap = fitz.Pixmap(fitz.csRGB, 300, 400, samples, False)
+        page.insert_image(page.rect, pixmap=pixmap)
+        page.insert_text((72, 72), f"Page {i + 1}", fontsize=24)
+    doc.save(path)
+    doc.close()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    output_path = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(output_path)
+    os.remove(output_path)
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", help="PDF to compress (generated if omitted)")
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--level", default="recommended")
+    parser.add_argument("--shard-pages", type=int, default=SHARD_PAGES)
+    parser.add_argument("--workers", default="1,2,4,8")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_")
+    os.environ["GS_ALLOWED_DIRS"] = work_dir
+    os.environ["GS_WORK_DIR"] = os.path.join(work_dir, ".gs")
+    try:
+        source = os.path.join(work_dir, "input.pdf")
+        if args.input:
+            shutil.copy(args.input, source)
+        else:
+            print(f"Generating {args.pages} page document...")
+            make_document(source, args.pages)
+        print(f"Input: {os.path.getsize(source)} bytes, cores: {os.cpu_count()}")
+
+        print(f"{'mode':<16}{'seconds':>10}{'speedup':>10}{'bytes':>14}")
+        os.environ["GS_POOL_SIZE"] = "1"
+        elapsed, size = timed(compress_pdf, source, args.level, output_dir=work_dir)
+        baseline = elapsed
+        print(f"{'single':<16}{elapsed:>10.2f}{1.0:>10.2f}{size:>14}")
+
+        for workers in [int(w) for w in args.workers.split(",")]:
+            # The gs pool size is what bounds how many shards run at once.
+            gs_pool.shutdown_pool()
+            os.environ["GS_POOL_SIZE"] = str(workers)
+            elapsed, size = timed(
+                compress_pdf_sharded,
+                source,
+                args.level,
+                output_dir=work_dir,
+                shard_pages=args.shard_pages,
+                workers=workers,
+            )
+            label = f"sharded x{workers}"
+            print(f"{label:<16}{elapsed:>10.2f}{baseline / elapsed:>10.2f}{size:>14}")
+    finally:
+        gs_pool.shutdown_pool()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Reproducible synthetic PDFs for the benchmark suite.
+#
+#   python benchmarks/corpus.py --output bench_corpus --profile full
+import os
+import re
+import json
+import random
+import argparse
+from typing import Dict, List
+
+import fitz
+from pypdf import PdfReader, PdfWriter
+
+PASSWORD = "bench"
+FONTS = ["helv", "tiro", "cour", "times-bold", "helvetica-oblique", "courier-bold"]
+ENCRYPTIONS = {"rc4": "RC4-128", "aes128": "AES-128", "aes256": "AES-256"}
+
+PROFILES = {
+    "quick": {
+        "pages": [10, 100],
+        "images": [0, 2],
+        "fonts": [1],
+        "encryption": ["aes256"],
+        "broken": True,
+    },
+    "full": {
+        "pages": [10, 200, 1000],
+        "images": [0, 1, 4],
+        "fonts": [1, 6],
+        "encryption": ["rc4", "aes128", "aes256"],
+        "broken": True,
+    },
+}
+
+
+def _image(rng: random.Random, width: int, height: int) -> fitz.Pixmap:
+    # Half noise, half flat colour: roughly what a scanned page compresses like.
+    noise = rng.randbytes(width * height * 3 // 2)
+    flat = bytes(rng.choice(range(256)) for _ in range(3)) * (width * height // 2)
+    return fitz.Pixmap(fitz.csRGB, width, height, noise + flat, False)
+
+
+def make_document(
+    path: str, pages: int, images: int = 0, fonts: int = 1, seed: int = 0
+) -> str:
+    rng = random.Random(f"{seed}-{pages}-{images}-{fonts}")
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        for j in range(fonts):
+            text = " ".join(
+                rng.choice(["lorem", "ipsum", "dolor", "sit"]) for _ in range(12)
+            )
+            page.insert_text(
+                (48, 72 + 24 * j), f"{i + 1}: {text}", fontname=FONTS[j % len(FONTS)]
+            )
+        for j in range(images):
+            top = 240 + (j % 2) * 260
+            left = 48 + (j // 2 % 2) * 260
+            rect = fitz.Rect(left, top, left + 240, top + 240)
+            page.insert_image(rect, pixmap=_image(rng, 320, 320))
+    # Fixed IDs and dates keep the bytes stable across runs.
+    doc.set_metadata(
+        {"creationDate": "D:20240101000000", "modDate": "D:20240101000000"}
+    )
+    doc.save(path, garbage=1, no_new_id=True)
+    doc.close()
+    return path
+
+
+def encrypt_document(source: str, path: str, algorithm: str) -> str:
+    writer = PdfWriter(clone_from=PdfReader(source))
+    writer.encrypt(PASSWORD, algorithm=algorithm)
+    with open(path, "wb") as f:
+        writer.write(f)
+    return path
+
+
+def break_xref(source: str, path: str) -> str:
+    # Shifts every xref offset so readers have to rebuild the table.
+    with open(source, "rb") as f:
+        data = f.read()
+    data = re.sub(
+        rb"(\d{10}) (\d{5}) n",
+        lambda m: b"%010d %s n" % (int(m.group(1)) + 7, m.group(2)),
+        data,
+    )
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def generate_corpus(
+    output_dir: str, profile: str = "quick", seed: int = 0
+) -> List[Dict]:
+    settings = PROFILES[profile]
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    cases = []
+
+    def add(name: str, path: str, pages: int, **extra):
+        cases.append(dict({"name": name, "path": path, "pages": pages}, **extra))
+
+    for pages in settings["pages"]:
+        for images in settings["images"]:
+            for fonts in settings["fonts"]:
+                name = f"p{pages}_i{images}_f{fonts}"
+                path = os.path.join(output_dir, f"{name}.pdf")
+                if not os.path.exists(path):
+                    make_document(path, pages, images, fonts, seed)
+                add(name, path, pages, images=images, fonts=fonts)
+
+    base_pages = settings["pages"][0]
+    base = os.path.join(output_dir, f"p{base_pages}_i0_f1.pdf")
+    if not os.path.exists(base):
+        make_document(base, base_pages, 0, 1, seed)
+    for key in settings["encryption"]:
+        name = f"p{base_pages}_{key}"
+        path = os.path.join(output_dir, f"{name}.pdf")
+        if not os.path.exists(path):
+            encrypt_document(base, path, ENCRYPTIONS[key])
+        add(name, path, base_pages, password=PASSWORD, encryption=key)
+
+    if settings["broken"]:
+        name = f"p{base_pages}_broken_xref"
+        path = os.path.join(output_dir, f"{name}.pdf")
+        if not os.path.exists(path):
+            break_xref(base, path)
+        add(name, path, base_pages, broken=True)
+
+    with open(os.path.join(output_dir, "corpus.json"), "w") as f:
+        json.dump(cases, f, indent=2)
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="bench_corpus")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for case in generate_corpus(args.output, args.profile, args.seed):
+        print(f"{case['name']:<24}{os.path.getsize(case['path']):>12} bytes")
+
+
+if __name__ == "__main__":
+    main()
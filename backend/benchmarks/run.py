@@ -0,0 +1,293 @@
+# Benchmarks every pdf_utils operation over the synthetic corpus, both called
+# directly and through the FastAPI app.
+#
+#   python benchmarks/run.py --output results.json
+#   python benchmarks/run.py --output new.json --compare results.json --threshold 0.2
+#
+# Each measurement runs in a fresh process so peak RSS belongs to that run
+# alone. In api mode the CPU-bound work happens in the app's process pool, so
+# cpu_time and peak_rss cover the request handling process only.
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import statistics
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import PROFILES, generate_corpus
+
+OPERATIONS = [
+    "merge",
+    "split",
+    "delete",
+    "compress",
+    "compress_native",
+    "lock",
+    "unlock",
+]
+MODES = ["inprocess", "api"]
+METRICS = ["wall_time", "cpu_time", "peak_rss_kb", "output_size"]
+# Differences below these are noise, whatever the ratio.
+NOISE_FLOOR = {
+    "wall_time": 0.005,
+    "cpu_time": 0.005,
+    "peak_rss_kb": 2048,
+    "output_size": 1024,
+}
+
+APP_ENV = {
+    "DEBUG": "false",
+    "TEMP_FOLDER": "temp_uploads",
+    "MAX_FILE_SIZE": str(1024 * 1024 * 1024),
+    "DEFAULT_LIMIT": "100000/minute",
+    "EXTRA_LIMIT": "100000/minute",
+    "RESULT_CACHE_MAX_MB": "0",
+    "ADMISSION_RATE": "0",
+}
+
+
+def _ranges(pages: int) -> str:
+    half = max(1, pages // 2)
+    return f"1-{half},{half + 1}-{pages}" if pages > 1 else "1"
+
+
+def _run_inprocess(operation: str, case: Dict, other: Dict) -> int:
+    import pdf_utils
+
+    path, password = case["path"], case.get("password")
+    item = {"path": path, "name": os.path.basename(path), "password": password}
+    if operation == "merge":
+        other_item = {"path": other["path"], "password": other.get("password")}
+        output = pdf_utils.merge_pdfs([item, other_item])
+    elif operation == "split":
+        output = pdf_utils.split_pdf(path, _ranges(case["pages"]), password)
+    elif operation == "delete":
+        output = pdf_utils.delete_pages(path, "1", password)
+    elif operation == "compress":
+        output = pdf_utils.compress_pdf(path, "recommended", password)
+    elif operation == "compress_native":
+        output = pdf_utils.compress_pdf_native(path, "recommended", password)
+    elif operation == "lock":
+        output = pdf_utils.lock_pdfs([item], "benchmark")
+    else:
+        output = pdf_utils.unlock_pdf(path, password)
+    return os.path.getsize(output)
+
+
+def _run_api(client, operation: str, case: Dict, other: Dict) -> int:
+    name = os.path.basename(case["path"])
+    passwords = {name: case["password"]} if case.get("password") else {}
+
+    def upload(field, c):
+        return (field, (os.path.basename(c["path"]), open(c["path"], "rb")))
+
+    data = {"passwords": json.dumps(passwords)}
+    if operation == "merge":
+        other_name = os.path.basename(other["path"])
+        if other.get("password"):
+            passwords[other_name] = other["password"]
+            data["passwords"] = json.dumps(passwords)
+        files = [upload("files", case), upload("files", other)]
+        url = "/merge"
+    elif operation == "split":
+        files, url = [upload("file", case)], "/split_pdf"
+        data["ranges"] = _ranges(case["pages"])
+    elif operation == "delete":
+        files, url = [upload("file", case)], "/delete-pages"
+        data["pages"] = "1"
+    elif operation == "compress":
+        files, url = [upload("file", case)], "/compress_pdf"
+        data["engine"] = "ghostscript"
+    elif operation == "compress_native":
+        files, url = [upload("file", case)], "/compress_pdf"
+        data["engine"] = "native"
+    elif operation == "lock":
+        files, url = [upload("files", case)], "/lock-pdf"
+        data["password"] = "benchmark"
+    else:
+        files, url = [upload("file", case)], "/unlock-pdf"
+        data["password"] = case.get("password") or ""
+
+    response = client.post(url, files=files, data=data)
+    for _, (_, handle) in files:
+        handle.close()
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return len(response.content)
+
+
+def measure(operation: str, mode: str, case: Dict, other: Dict, repeat: int) -> Dict:
+    # Runs in a child process with its own scratch directory.
+    work_dir = tempfile.mkdtemp(prefix="bench_run_")
+    os.chdir(work_dir)
+    # Broken inputs make pypdf log every object it recovers.
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+    for key, value in APP_ENV.items():
+        os.environ.setdefault(key, value)
+    from gs_pool import shutdown_pool
+    from workers import shutdown_pools
+
+    client = None
+    if mode == "api":
+        from fastapi.testclient import TestClient
+        import main
+
+        client = TestClient(main.app).__enter__()
+
+    walls, cpus, size = [], [], None
+    try:
+        for _ in range(repeat):
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            if mode == "api":
+                size = _run_api(client, operation, case, other)
+            else:
+                size = _run_inprocess(operation, case, other)
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            child_cpu = (after.ru_utime - children.ru_utime) + (
+                after.ru_stime - children.ru_stime
+            )
+            walls.append(time.perf_counter() - start_wall)
+            cpus.append(time.process_time() - start_cpu + child_cpu)
+    finally:
+        # Worker processes and Ghostscript interpreters run inside work_dir,
+        # so they have to be gone, not just told to stop, before it is
+        # deleted. The app's own shutdown doesn't wait for them.
+        shutdown_pools(wait=True)
+        shutdown_pool()
+        if client is not None:
+            client.__exit__(None, None, None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {
+        "wall_time": statistics.median(walls),
+        "cpu_time": statistics.median(cpus),
+        "peak_rss_kb": peak,
+        "output_size": size,
+    }
+
+
+def run_suite(
+    cases: List[Dict], operations: List[str], modes: List[str], repeat: int
+) -> List[Dict]:
+    from gs_pool import find_ghostscript
+
+    has_ghostscript = find_ghostscript() is not None
+    plain = [c for c in cases if not c.get("password") and not c.get("broken")]
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        other = plain[0] if plain else case
+        for operation in operations:
+            for mode in modes:
+                result = {"case": case["name"], "operation": operation, "mode": mode}
+                if operation == "compress" and not has_ghostscript:
+                    result["status"] = "skipped: Ghostscript not found"
+                    results.append(result)
+                    continue
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    future = pool.submit(measure, operation, mode, case, other, repeat)
+                    try:
+                        result.update(future.result(), status="ok")
+                    except Exception as e:
+                        result["status"] = f"error: {e}"
+                results.append(result)
+                print(_format(result), flush=True)
+    return results
+
+
+def _format(result: Dict) -> str:
+    label = f"{result['case']:<24}{result['operation']:<16}{result['mode']:<10}"
+    if result["status"] != "ok":
+        return f"{label}{result['status']}"
+    return (
+        f"{label}{result['wall_time']:>9.3f}s{result['cpu_time']:>9.3f}s"
+        f"{result['peak_rss_kb'] / 1024:>9.1f}MB{result['output_size']:>12}B"
+    )
+
+
+def compare(results: List[Dict], baseline: List[Dict], threshold: float) -> List[str]:
+    def key(r):
+        return r["case"], r["operation"], r["mode"]
+
+    previous = {key(r): r for r in baseline if r.get("status") == "ok"}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None or result.get("status") != "ok":
+            continue
+        for metric in METRICS:
+            before, after = old[metric], result[metric]
+            if after - before <= NOISE_FLOOR[metric]:
+                continue
+            if before and after > before * (1 + threshold):
+                regressions.append(
+                    f"{'/'.join(key(result))} {metric}: {before:.4g} -> {after:.4g}"
+                    f" (+{(after / before - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(BACKEND_DIR, "bench_corpus"))
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--operations", default=",".join(OPERATIONS))
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--cases", help="Only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    cases = generate_corpus(args.corpus, args.profile, args.seed)
+    if args.cases:
+        cases = [c for c in cases if args.cases in c["name"]]
+    results = run_suite(
+        cases, args.operations.split(","), args.modes.split(","), args.repeat
+    )
+
+    report = {
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "profile": args.profile,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Union
+from fastapi import HTTPException
+from result_cache import ResultCache, link_or_copy
+from workspace import Workspace
+from ingest import upload_error
+
+try:
+    import fcntl
+except ImportError:  # Windows: chunks of one upload are not serialized.
+    fcntl = None
+
+DOCUMENT_ID = re.compile(r"[0-9a-f]{64}")
+UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+# Skipped by eviction, like the cache's own staging directories.
+SESSIONS_DIR = ".uploads"
+SESSIONS_LOCK = "sessions.lock"
+# One file per upload of a document, named by the hash of its token.
+OWNERS_DIR = ".owners"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class DocumentStore(ResultCache):
+    # Uploaded documents under their content hash, so identical uploads are
+    # stored once. Entries expire ttl after their last upload and the least
+    # recently used go first once the store is over max_bytes. Large files
+    # can be sent in chunks over several requests through an upload session;
+    # a session reserves its declared size of the store until it finishes.
+    # Every upload gets a token of its own; deleting with it drops only that
+    # upload's claim, and the document goes once no claims are left.
+    def __init__(
+        self,
+        root: str,
+        max_bytes: int,
+        ttl: float,
+        max_size: int,
+        session_ttl: float,
+    ):
+        super().__init__(root, max_bytes, ttl)
+        self.max_size = max_size
+        self.session_ttl = session_ttl
+        self.sessions_dir = os.path.join(root, SESSIONS_DIR)
+        self.owners_dir = os.path.join(root, OWNERS_DIR)
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        os.makedirs(self.owners_dir, exist_ok=True)
+        self._sessions_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        # One step at a time for every server process.
+        with self._sessions_lock, open(
+            os.path.join(self.sessions_dir, SESSIONS_LOCK), "a"
+        ) as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _owner_path(self, doc_id: str, token: str) -> str:
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        return os.path.join(self.owners_dir, doc_id, digest)
+
+    def describe(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        path = self.get(doc_id) if DOCUMENT_ID.fullmatch(doc_id) else None
+        if path is None:
+            return None
+        return {
+            "id": doc_id,
+            "name": os.path.basename(path),
+            "size": os.path.getsize(path),
+        }
+
+    def add(self, name: str, sha256: str, source: Union[str, bytes]) -> Dict:
+        with self._locked():
+            document = self._add(name, sha256, source)
+            token = uuid.uuid4().hex
+            path = self._owner_path(sha256, token)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        return dict(document, token=token)
+
+    def _add(self, name: str, sha256: str, source: Union[str, bytes]) -> Dict:
+        existing = self.get(sha256)
+        if existing:
+            # Uploading it again restarts its TTL.
+            os.utime(existing)
+        else:
+            # Claims on an evicted copy don't carry over.
+            shutil.rmtree(os.path.join(self.owners_dir, sha256), ignore_errors=True)
+            staged_path = self.start(name)
+            try:
+                if isinstance(source, bytes):
+                    with open(staged_path, "wb") as f:
+                        f.write(source)
+                else:
+                    link_or_copy(source, staged_path)
+            except Exception:
+                self.abort(staged_path)
+                raise
+            self.commit(sha256, staged_path)
+        document = self.describe(sha256)
+        if document is None:
+            raise HTTPException(
+                status_code=413, detail="Document is too large for the store."
+            )
+        return document
+
+    def add_upload(self, upload: Dict) -> Dict:
+        source = upload["data"] if upload.get("data") is not None else upload["path"]
+        return self.add(upload["name"], upload["sha256"], source)
+
+    def checkout(self, doc_id: str, workspace: Workspace) -> Optional[Dict]:
+        # Links the document into a request's workspace, so the request can
+        # still read it if the store evicts it meanwhile.
+        path = self.get(doc_id) if DOCUMENT_ID.fullmatch(doc_id) else None
+        if path is None:
+            return None
+        name = os.path.basename(path)
+        target = workspace.upload_path(name)
+        try:
+            link_or_copy(path, target)
+        except FileNotFoundError:
+            return None
+        return {
+            "name": name,
+            "path": target,
+            "size": os.path.getsize(target),
+            "sha256": doc_id,
+        }
+
+    def remove(self, doc_id: str, token: str) -> bool:
+        # Drops the claim of the upload the token was issued for.
+        if not DOCUMENT_ID.fullmatch(doc_id) or not token:
+            return False
+        entry_dir = os.path.join(self.cache_dir, doc_id)
+        owners = os.path.join(self.owners_dir, doc_id)
+        with self._locked():
+            try:
+                os.remove(self._owner_path(doc_id, token))
+            except FileNotFoundError:
+                return False
+            if not os.path.isdir(entry_dir):
+                shutil.rmtree(owners, ignore_errors=True)
+                return False
+            if not os.listdir(owners):
+                self._remove(entry_dir)
+                os.rmdir(owners)
+        return True
+
+    def evict(self):
+        super().evict()
+        # Claims on documents that expired or were evicted.
+        for doc_id in os.listdir(self.owners_dir):
+            if not os.path.isdir(os.path.join(self.cache_dir, doc_id)):
+                shutil.rmtree(os.path.join(self.owners_dir, doc_id), ignore_errors=True)
+
+    def capacity(self) -> int:
+        return max(self.max_bytes - self.reserved_bytes(), 0)
+
+    def reserved_bytes(self) -> int:
+        reserved = 0
+        for name in os.listdir(self.sessions_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.sessions_dir, name)) as f:
+                    reserved += json.load(f)["size"]
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+        return reserved
+
+    def _session_paths(self, upload_id: str):
+        if not UPLOAD_ID.fullmatch(upload_id):
+            raise HTTPException(status_code=404, detail="Upload not found")
+        base = os.path.join(self.sessions_dir, upload_id)
+        return base + ".json", base + ".part"
+
+    def create_session(self, name: str, size: int) -> Dict:
+        if size <= 0:
+            raise HTTPException(status_code=422, detail="Size must be positive.")
+        if size > self.max_size:
+            raise upload_error(
+                413, "too_large", f"File too large. Max size is {self.max_size} bytes."
+            )
+        self.prune_sessions()
+        # The check and the new reservation are one step, so concurrent
+        # sessions can't overbook the store together.
+        with self._locked():
+            if self.reserved_bytes() + size > self.max_bytes:
+                raise upload_error(
+                    507,
+                    "storage_full",
+                    "The document store has no room for this upload.",
+                )
+            upload_id = uuid.uuid4().hex
+            info_path, part_path = self._session_paths(upload_id)
+            open(part_path, "wb").close()
+            with open(info_path, "w") as f:
+                json.dump({"name": os.path.basename(name), "size": size}, f)
+        # Makes room for the reservation now rather than at the next upload.
+        self.evict()
+        return {"upload_id": upload_id, "name": name, "size": size, "offset": 0}
+
+    def session(self, upload_id: str) -> Dict:
+        info_path, part_path = self._session_paths(upload_id)
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+            offset = os.path.getsize(part_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        return dict(info, upload_id=upload_id, offset=offset)
+
+    def open_session(self, upload_id: str, offset: int):
+        # Returns (session, file to append to). The file stays locked until it
+        # is closed, so one request appends at a time, and a chunk is only
+        # accepted at the end it sees under the lock: a retried or stale one
+        # is refused, not doubled.
+        session = self.session(upload_id)
+        try:
+            fd = os.open(self._session_paths(upload_id)[1], os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        f = os.fdopen(fd, "ab")
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise HTTPException(
+                        status_code=409,
+                        detail="Another chunk of this upload is being written.",
+                    )
+            session["offset"] = os.fstat(fd).st_size
+            if offset != session["offset"]:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Upload is at offset {session['offset']}.",
+                    headers={"Upload-Offset": str(session["offset"])},
+                )
+        except BaseException:
+            f.close()
+            raise
+        return session, f
+
+    def finish_session(self, upload_id: str) -> Dict:
+        session = self.session(upload_id)
+        part_path = self._session_paths(upload_id)[1]
+        try:
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                if not f.read(5).startswith(b"%PDF-"):
+                    raise upload_error(400, "invalid_format", "Not a generic PDF.")
+                f.seek(0)
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            # The reservation ends before the document is counted instead.
+            os.remove(self._session_paths(upload_id)[0])
+            return self.add(session["name"], digest.hexdigest(), part_path)
+        finally:
+            self.discard_session(upload_id)
+
+    def discard_session(self, upload_id: str):
+        for path in self._session_paths(upload_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prune_sessions(self):
+        # Every chunk written touches the data file, so an upload still in
+        # progress is never pruned.
+        limit = time.time() - self.session_ttl
+        for name in os.listdir(self.sessions_dir):
+            upload_id, ext = os.path.splitext(name)
+            if ext != ".part":
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.sessions_dir, name)) < limit:
+                    self.discard_session(upload_id)
+            except (FileNotFoundError, HTTPException):
+                pass
+
+
+def create_document_store() -> DocumentStore:
+    return DocumentStore(
+        os.getenv("DOCUMENT_STORE_DIR", "documents"),
+        int(os.getenv("DOCUMENT_STORE_MAX_MB", 2048)) * 1024 * 1024,
+        float(os.getenv("DOCUMENT_STORE_TTL", 86400)),
+        int(os.getenv("DOCUMENT_MAX_MB", 1024)) * 1024 * 1024,
+        float(os.getenv("UPLOAD_SESSION_TTL", 86400)),
+    )
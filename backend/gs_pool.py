@@ -0,0 +1,333 @@
+import os
+import time
+import uuid
+import queue
+import shutil
+import threading
+import subprocess
+from typing import Dict, List, Optional
+import metrics
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MARKER = "%%[GSPOOL"
+
+
+def find_ghostscript() -> Optional[str]:
+    return shutil.which("gswin64c") or shutil.which("gs")
+
+
+def _ps_string(value: str) -> str:
+    escaped = value.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return f"({escaped})"
+
+
+def _is_within(path: str, folders: List[str]) -> bool:
+    path = os.path.abspath(path)
+    return any(path.startswith(folder + os.sep) for folder in folders)
+
+
+class GhostscriptWorker:
+    # A long-lived interpreter reading PostScript jobs from stdin. Each job
+    # points pdfwrite at a new OutputFile, runs the input, then switches back to
+    # the worker's idle file, which closes and finalizes the job's output.
+    def __init__(
+        self,
+        executable: str,
+        setting: str,
+        allowed_dirs: List[str],
+        work_dir: str,
+        memory_limit: int,
+        start_timeout: float,
+    ):
+        os.makedirs(work_dir, exist_ok=True)
+        self.idle_path = os.path.join(work_dir, f"idle_{uuid.uuid4().hex}.pdf")
+        self.jobs = 0
+        self.lines: "queue.Queue[Optional[str]]" = queue.Queue()
+
+        permits = []
+        for folder in allowed_dirs + [work_dir]:
+            pattern = os.path.join(os.path.abspath(folder), "*")
+            permits += [
+                f"--permit-file-read={pattern}",
+                f"--permit-file-write={pattern}",
+            ]
+
+        command = [
+            executable,
+            "-q",
+            "-dSAFER",
+            "-dNOPAUSE",
+            "-dNOPROMPT",
+            "-sDEVICE=pdfwrite",
+            "-dCompatibilityLevel=1.4",
+            f"-dPDFSETTINGS={setting}",
+            f"-sOutputFile={self.idle_path}",
+            *permits,
+            "-",
+        ]
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1,
+        )
+        if memory_limit and resource is not None and hasattr(resource, "prlimit"):
+            resource.prlimit(
+                self.process.pid, resource.RLIMIT_AS, (memory_limit, memory_limit)
+            )
+        threading.Thread(target=self._read_output, daemon=True).start()
+
+        try:
+            self._send(f"({MARKER}-READY]%%\\n) print flush\n")
+            self._wait_for(f"{MARKER}-READY]%%", start_timeout)
+        except Exception:
+            self.kill()
+            raise
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            self.lines.put(line.rstrip("\n"))
+        self.lines.put(None)
+
+    def _send(self, program: str):
+        self.process.stdin.write(program)
+        self.process.stdin.flush()
+
+    def _wait_for(self, prefix: str, timeout: float) -> List[str]:
+        # One deadline for the whole job, so a stream of warnings can't keep
+        # it alive.
+        deadline = time.monotonic() + timeout
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("Ghostscript did not respond in time")
+            if line is None:
+                raise RuntimeError(
+                    "Ghostscript exited unexpectedly: " + " ".join(output[-5:])
+                )
+            if line.startswith(prefix):
+                output.append(line)
+                return output
+            output.append(line)
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, input_path: str, output_path: str, timeout: float):
+        self.jobs += 1
+        token = f"{self.jobs}"
+        self._send(
+            f"{{ << /OutputFile {_ps_string(os.path.abspath(output_path))} >> "
+            f"setpagedevice {_ps_string(os.path.abspath(input_path))} run }} stopped\n"
+            f"{{ clear ({MARKER}-FAIL {token} ) print $error /errorname get =only }}\n"
+            f"{{ clear ({MARKER}-OK {token} ) print }} ifelse\n"
+            f"<< /OutputFile {_ps_string(self.idle_path)} >> setpagedevice\n"
+            f"(]%%\\n) print flush\n"
+        )
+        output = self._wait_for(f"{MARKER}-", timeout)
+        status = output[-1]
+        if not status.startswith(f"{MARKER}-OK {token} "):
+            details = " ".join(line for line in output[:-1] if line.strip())
+            raise RuntimeError(f"Ghostscript job failed: {status} {details}".strip())
+
+    def close(self):
+        if self.alive():
+            try:
+                self._send("quit\n")
+                self.process.stdin.close()
+                self.process.wait(timeout=2)
+            except Exception:
+                self.process.kill()
+        if os.path.exists(self.idle_path):
+            os.remove(self.idle_path)
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+            self.process.wait()
+        if os.path.exists(self.idle_path):
+            os.remove(self.idle_path)
+
+
+class GhostscriptPool:
+    def __init__(
+        self,
+        executable: str,
+        size: int,
+        max_jobs: int,
+        timeout: float,
+        memory_limit: int,
+        allowed_dirs: List[str],
+        work_dir: str,
+    ):
+        self.executable = executable
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.allowed_dirs = [os.path.abspath(d) for d in allowed_dirs]
+        self.work_dir = work_dir
+        self._idle: Dict[str, List[GhostscriptWorker]] = {}
+        self._started: Dict[str, int] = {}
+        self._condition = threading.Condition()
+        self.crashes = 0
+        self.timeouts = 0
+
+    def accepts(self, *paths: str) -> bool:
+        return all(_is_within(path, self.allowed_dirs) for path in paths)
+
+    def _checkout(self, setting: str) -> GhostscriptWorker:
+        with self._condition:
+            while True:
+                idle = self._idle.setdefault(setting, [])
+                while idle:
+                    worker = idle.pop()
+                    if worker.alive():
+                        return worker
+                    worker.kill()
+                    self._started[setting] -= 1
+                if self._started.get(setting, 0) < self.size:
+                    self._started[setting] = self._started.get(setting, 0) + 1
+                    break
+                self._condition.wait()
+
+        try:
+            return GhostscriptWorker(
+                self.executable,
+                setting,
+                self.allowed_dirs,
+                self.work_dir,
+                self.memory_limit,
+                self.timeout,
+            )
+        except Exception:
+            self._release_slot(setting)
+            raise
+
+    def _release_slot(self, setting: str):
+        with self._condition:
+            self._started[setting] -= 1
+            self._condition.notify()
+
+    def _checkin(self, setting: str, worker: GhostscriptWorker):
+        if worker.jobs >= self.max_jobs or not worker.alive():
+            worker.close()
+            self._release_slot(setting)
+            return
+        with self._condition:
+            self._idle.setdefault(setting, []).append(worker)
+            self._condition.notify()
+
+    def run(self, input_path: str, output_path: str, setting: str):
+        worker = self._checkout(setting)
+        try:
+            worker.run(input_path, output_path, self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            metrics.inc("ghostscript_runs_total", mode="pool", result="timeout")
+            worker.kill()
+            self._release_slot(setting)
+            raise RuntimeError(f"PDF compression timed out after {self.timeout}s")
+        except Exception:
+            # After a failed job the interpreter state is unknown; start fresh.
+            self.crashes += 1
+            metrics.inc("ghostscript_runs_total", mode="pool", result="error")
+            worker.kill()
+            self._release_slot(setting)
+            raise
+        metrics.inc("ghostscript_runs_total", mode="pool", result="ok")
+        self._checkin(setting, worker)
+
+    def shutdown(self):
+        with self._condition:
+            workers = [w for idle in self._idle.values() for w in idle]
+            self._idle = {}
+            self._started = {}
+        for worker in workers:
+            worker.close()
+
+
+_pool: Optional[GhostscriptPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(executable: str) -> Optional[GhostscriptPool]:
+    global _pool
+    size = int(os.getenv("GS_POOL_SIZE", 2))
+    if size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            workspaces = os.getenv("WORKSPACE_ROOT") or os.getenv(
+                "TEMP_FOLDER", "temp_uploads"
+            )
+            allowed = os.getenv("GS_ALLOWED_DIRS", f"{workspaces},output_files")
+            _pool = GhostscriptPool(
+                executable,
+                size=size,
+                max_jobs=int(os.getenv("GS_MAX_JOBS", 50)),
+                timeout=float(os.getenv("GS_TIMEOUT", 300)),
+                memory_limit=int(os.getenv("GS_MEMORY_LIMIT_MB", 1024)) * 1024 * 1024,
+                allowed_dirs=[d.strip() for d in allowed.split(",") if d.strip()],
+                work_dir=os.getenv("GS_WORK_DIR", os.path.join("output_files", ".gs")),
+            )
+        return _pool
+
+
+def run_ghostscript(
+    input_path: str, output_path: str, setting: str, password: Optional[str] = None
+):
+    executable = find_ghostscript()
+    if not executable:
+        raise EnvironmentError("Ghostscript not found.")
+
+    pool = get_pool(executable)
+    # Passwords are only accepted on the command line, so encrypted inputs and
+    # paths outside the permitted folders go through a one-off process.
+    if pool is not None and not password and pool.accepts(input_path, output_path):
+        pool.run(input_path, output_path, setting)
+        return
+
+    command = [
+        executable,
+        "-sDEVICE=pdfwrite",
+        "-dCompatibilityLevel=1.4",
+        f"-dPDFSETTINGS={setting}",
+        "-dNOPAUSE",
+        "-dQUIET",
+        "-dBATCH",
+        f"-sOutputFile={output_path}",
+    ]
+    if password:
+        command.append(f"-sPDFPassword={password}")
+    command.append(input_path)
+
+    timeout = float(os.getenv("GS_TIMEOUT", 300))
+    try:
+        subprocess.run(command, check=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        metrics.inc("ghostscript_runs_total", mode="oneshot", result="timeout")
+        raise RuntimeError(f"PDF compression timed out after {timeout}s")
+    except subprocess.CalledProcessError as e:
+        metrics.inc(
+            "ghostscript_runs_total", mode="oneshot", result=f"exit_{e.returncode}"
+        )
+        raise
+    metrics.inc("ghostscript_runs_total", mode="oneshot", result="ok")
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,302 @@
+import os
+import json
+import asyncio
+import hashlib
+from typing import Dict, List, Optional, Tuple
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from python_multipart.multipart import (
+    MultipartParser,
+    MultipartParseError,
+    parse_options_header,
+)
+from workers import get_io_pool
+from workspace import Workspace, QuotaExceededError
+
+# Plain form values are kept in memory, so each one is capped.
+FIELD_MAX_SIZE = 64 * 1024
+
+
+def upload_error(status_code: int, error_type: str, message: str) -> HTTPException:
+    return HTTPException(
+        status_code=status_code,
+        detail=json.dumps({"type": error_type, "message": message}),
+    )
+
+
+class UploadForm:
+    def __init__(self, workspace: Workspace):
+        self.workspace = workspace
+        self.fields: Dict[str, str] = {}
+        self.uploads: List[Dict] = []
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.fields.get(name, default)
+
+    def require(self, name: str) -> str:
+        if name not in self.fields:
+            raise HTTPException(status_code=422, detail=f"Missing form field: {name}")
+        return self.fields[name]
+
+    def files(self, field: str) -> List[Dict]:
+        items = [item for item in self.uploads if item["field"] == field]
+        if not items:
+            raise HTTPException(status_code=422, detail=f"Missing file field: {field}")
+        return items
+
+    def paths(self) -> List[str]:
+        # Everything the request wrote lives in its workspace.
+        return [self.workspace.path]
+
+
+class StreamingUploadParser:
+    # Parses multipart/form-data as it arrives and writes file parts straight to
+    # disk, so an oversized file is rejected before the rest of it is received.
+    # Files up to memory_max stay in memory and are handed on as "data". A
+    # plain value in one of document_fields names a stored document instead of
+    # a file; it keeps its place among the uploads as {"field", "document_id"}.
+    # With collect_errors, a file that is too large, empty or not a PDF gets
+    # an "error" ({"type", "message"}) and the rest of it is skipped, instead
+    # of failing the whole request.
+    def __init__(
+        self,
+        workspace: Workspace,
+        max_file_size: int,
+        memory_max: int = 0,
+        document_fields: Tuple[str, ...] = (),
+        collect_errors: bool = False,
+    ):
+        self.workspace = workspace
+        self.max_file_size = max_file_size
+        self.memory_max = memory_max
+        self.document_fields = document_fields
+        self.collect_errors = collect_errors
+        self.form = UploadForm(workspace)
+        self._part: Dict = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._pending: List = []
+        self._finished: List[Dict] = []
+
+    def on_part_begin(self):
+        self._part = {"disposition": b"", "data": bytearray(), "upload": None}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._part["disposition"] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._part["disposition"])
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail="Malformed multipart part.")
+        self._part["field"] = options[b"name"].decode("utf-8", "replace")
+        if options.get(b"filename"):
+            filename = os.path.basename(options[b"filename"].decode("utf-8", "replace"))
+            upload = {
+                "field": self._part["field"],
+                "name": filename,
+                "path": self.workspace.upload_path(filename),
+                "size": 0,
+                "sha256": hashlib.sha256(),
+                "head": b"",
+                "file": None,
+                "buffer": bytearray(),
+            }
+            self._part["upload"] = upload
+            self.form.uploads.append(upload)
+
+    def _reject(self, upload: Dict, status_code: int, error_type: str, message: str):
+        if not self.collect_errors:
+            raise upload_error(status_code, error_type, message)
+        upload["error"] = {"type": error_type, "message": message}
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        upload = self._part["upload"]
+        if upload is None:
+            if len(self._part["data"]) + len(chunk) > FIELD_MAX_SIZE:
+                raise upload_error(
+                    413,
+                    "too_large",
+                    f"Form field too large. Max size is {FIELD_MAX_SIZE} bytes.",
+                )
+            self._part["data"].extend(chunk)
+            return
+        if "error" in upload:
+            return
+
+        upload["size"] += len(chunk)
+        if upload["size"] > self.max_file_size:
+            self._reject(
+                upload,
+                413,
+                "too_large",
+                f"File too large. Max size is {self.max_file_size} bytes.",
+            )
+            return
+        try:
+            self.workspace.reserve(len(chunk))
+        except QuotaExceededError as e:
+            if e.request_limit:
+                raise upload_error(413, "too_large", str(e))
+            raise upload_error(507, "storage_full", str(e))
+        if len(upload["head"]) < 5:
+            upload["head"] += chunk[:5]
+            if len(upload["head"]) >= 5 and not upload["head"].startswith(b"%PDF-"):
+                self._reject(upload, 400, "invalid_format", "Not a generic PDF.")
+                return
+        self._pending.append((upload, chunk))
+
+    def on_part_end(self):
+        upload = self._part["upload"]
+        if upload is None:
+            value = self._part["data"].decode("utf-8", "replace")
+            if self._part["field"] in self.document_fields:
+                document_id = value.strip().lower()
+                self.form.uploads.append(
+                    {"field": self._part["field"], "document_id": document_id}
+                )
+                return
+            self.form.fields[self._part["field"]] = value
+            return
+        if "error" not in upload:
+            if upload["size"] == 0:
+                self._reject(upload, 400, "empty", "File is empty.")
+            elif not upload["head"].startswith(b"%PDF-"):
+                self._reject(upload, 400, "invalid_format", "Not a generic PDF.")
+        self._finished.append(upload)
+
+    def callbacks(self) -> Dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def has_pending(self) -> bool:
+        return bool(self._pending or self._finished)
+
+    def touches_disk(self) -> bool:
+        uploads = [upload for upload, _ in self._pending] + self._finished
+        return any(upload["size"] > self.memory_max for upload in uploads)
+
+    def flush(self):
+        for upload, chunk in self._pending:
+            upload["sha256"].update(chunk)
+            if upload["size"] <= self.memory_max:
+                upload["buffer"] += chunk
+                continue
+            if upload["file"] is None:
+                upload["file"] = open(upload["path"], "wb")
+                upload["file"].write(upload["buffer"])
+                upload["buffer"] = bytearray()
+            upload["file"].write(chunk)
+        for upload in self._finished:
+            if upload["file"] is not None:
+                upload["file"].close()
+            else:
+                upload["data"] = bytes(upload["buffer"])
+            upload["sha256"] = upload["sha256"].hexdigest()
+            del upload["head"], upload["file"], upload["buffer"]
+        self._pending = []
+        self._finished = []
+
+    def discard(self):
+        for upload in self.form.uploads:
+            if upload.get("file") is not None:
+                upload["file"].close()
+            if "path" in upload and os.path.exists(upload["path"]):
+                os.remove(upload["path"])
+
+
+def spill_uploads(uploads: List[Dict]):
+    # Writes in-memory uploads out to their paths, for work that needs a file.
+    for upload in uploads:
+        data = upload.pop("data", None)
+        if data is not None:
+            with open(upload["path"], "wb") as f:
+                f.write(data)
+
+
+async def parse_upload_form(
+    request: Request,
+    workspace: Workspace,
+    max_file_size: int,
+    memory_max: int = 0,
+    document_fields: Tuple[str, ...] = (),
+    collect_errors: bool = False,
+) -> UploadForm:
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    if b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data.")
+
+    handler = StreamingUploadParser(
+        workspace, max_file_size, memory_max, document_fields, collect_errors
+    )
+    parser = MultipartParser(params[b"boundary"], handler.callbacks())
+    loop = asyncio.get_running_loop()
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if handler.touches_disk():
+                await loop.run_in_executor(get_io_pool(), handler.flush)
+            elif handler.has_pending():
+                handler.flush()
+        parser.finalize()
+    except MultipartParseError:
+        await loop.run_in_executor(get_io_pool(), handler.discard)
+        raise HTTPException(status_code=400, detail="Malformed multipart body.")
+    except BaseException:
+        await loop.run_in_executor(get_io_pool(), handler.discard)
+        raise
+    return handler.form
+
+
+class RequestSizeLimitMiddleware:
+    # Enforces a per-request byte budget on every route, before and while the
+    # body is received.
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        length = dict(scope["headers"]).get(b"content-length")
+        if length and length.isdigit() and int(length) > self.max_size:
+            error = upload_error(413, "too_large", self._message())
+            response = JSONResponse(
+                status_code=413,
+                content={"detail": error.detail},
+                headers={"Connection": "close"},
+            )
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise upload_error(413, "too_large", self._message())
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    def _message(self) -> str:
+        return f"Request too large. Max total size is {self.max_size} bytes."
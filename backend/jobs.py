@@ -0,0 +1,358 @@
+import os
+import abc
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from fastapi import HTTPException
+from workers import run_io
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _new_job(operation: str, params: Dict[str, Any], cleanup: List[str]) -> Dict:
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "operation": operation,
+        "state": QUEUED,
+        "progress": 0.0,
+        "params": params,
+        "result": None,
+        "error": None,
+        "cleanup": cleanup,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+class JobStore(abc.ABC):
+    # A job's secrets (document passwords) stay in the memory of the process
+    # that created it, never in params, and are dropped once it ends. Only
+    # that process can claim a job that has any.
+    def __init__(self):
+        self._secrets: Dict[str, Dict[str, Any]] = {}
+
+    def secrets(self, job_id: str) -> Dict[str, Any]:
+        return self._secrets.get(job_id, {})
+
+    def forget(self, job_id: str):
+        self._secrets.pop(job_id, None)
+
+    @abc.abstractmethod
+    def create(
+        self,
+        operation: str,
+        params: Dict[str, Any],
+        cleanup: List[str],
+        secrets: Optional[Dict[str, Any]] = None,
+    ) -> Dict: ...
+
+    @abc.abstractmethod
+    def get(self, job_id: str) -> Optional[Dict]: ...
+
+    @abc.abstractmethod
+    def claim(self) -> Optional[Dict]: ...
+
+    @abc.abstractmethod
+    def update(self, job_id: str, **fields): ...
+
+    @abc.abstractmethod
+    def delete(self, job_id: str): ...
+
+    @abc.abstractmethod
+    def expired(self, max_age: float) -> List[Dict]: ...
+
+
+class MemoryJobStore(JobStore):
+    def __init__(self):
+        super().__init__()
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def create(self, operation, params, cleanup, secrets=None):
+        job = _new_job(operation, params, cleanup)
+        with self._lock:
+            self._jobs[job["id"]] = job
+            if secrets:
+                self._secrets[job["id"]] = secrets
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def claim(self):
+        with self._lock:
+            queued = [j for j in self._jobs.values() if j["state"] == QUEUED]
+            if not queued:
+                return None
+            job = min(queued, key=lambda j: j["created_at"])
+            job.update(state=RUNNING, updated_at=time.time())
+            return dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        self.forget(job_id)
+
+    def expired(self, max_age):
+        limit = time.time() - max_age
+        with self._lock:
+            return [dict(j) for j in self._jobs.values() if j["updated_at"] < limit]
+
+
+class SqliteJobStore(JobStore):
+    # Shared by every uvicorn worker on the node, so any of them can pick up a job.
+    _JSON_FIELDS = ("params", "result", "cleanup")
+
+    def __init__(self, db_path: str):
+        super().__init__()
+        self.db_path = db_path
+        # Marks the jobs whose secrets this process holds.
+        self.owner = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    operation TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    progress REAL NOT NULL,
+                    params TEXT,
+                    result TEXT,
+                    error TEXT,
+                    cleanup TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    owner TEXT
+                )"""
+            )
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _to_job(self, row) -> Optional[Dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        job.pop("owner", None)
+        for field in self._JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def create(self, operation, params, cleanup, secrets=None):
+        job = _new_job(operation, params, cleanup)
+        row = dict(job, owner=self.owner if secrets else None)
+        for field in self._JSON_FIELDS:
+            row[field] = json.dumps(row[field])
+        if secrets:
+            self._secrets[job["id"]] = secrets
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs VALUES (:id, :operation, :state, :progress, "
+                ":params, :result, :error, :cleanup, :created_at, :updated_at, "
+                ":owner)",
+                row,
+            )
+        return job
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row)
+
+    def claim(self):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE state = ? AND (owner IS NULL OR owner = ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, self.owner),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?",
+                    (RUNNING, time.time(), row["id"]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        job = self._to_job(row)
+        if job:
+            job["state"] = RUNNING
+        return job
+
+    def update(self, job_id, **fields):
+        for field in self._JSON_FIELDS:
+            if field in fields:
+                fields[field] = json.dumps(fields[field])
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = :{name}" for name in fields)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                f"UPDATE jobs SET {columns} WHERE id = :job_id",
+                dict(fields, job_id=job_id),
+            )
+
+    def delete(self, job_id):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self.forget(job_id)
+
+    def expired(self, max_age):
+        limit = time.time() - max_age
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE updated_at < ?", (limit,)
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+
+def create_job_store() -> JobStore:
+    if os.getenv("JOB_STORE", "memory").lower() == "sqlite":
+        return SqliteJobStore(os.getenv("JOB_DB_PATH", "jobs.db"))
+    return MemoryJobStore()
+
+
+def job_status(job: Dict) -> Dict:
+    status = {
+        "id": job["id"],
+        "operation": job["operation"],
+        "state": job["state"],
+        "progress": job["progress"],
+        "error": job["error"],
+    }
+    if job["state"] == DONE:
+        status["result_url"] = f"/jobs/{job['id']}/result"
+    return status
+
+
+class JobRunner:
+    def __init__(
+        self,
+        store: JobStore,
+        handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]],
+        cleanup: Callable[[List[str]], None],
+    ):
+        self.store = store
+        self.handlers = handlers
+        self.cleanup = cleanup
+        self.workers = int(os.getenv("JOB_WORKERS", 2))
+        self.poll_interval = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+        self.ttl = float(os.getenv("JOB_TTL", 3600))
+        self._tasks: List[asyncio.Task] = []
+        self._running: Set[str] = set()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self):
+        while True:
+            job = await run_io("jobs", self.store.claim)
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            self._running.add(job["id"])
+            try:
+                await self._execute(job)
+            finally:
+                self._running.discard(job["id"])
+
+    async def _execute(self, job: Dict):
+        handler = self.handlers.get(job["operation"])
+        if handler is None:
+            await self._fail(job, f"Unknown operation {job['operation']}")
+            return
+
+        await run_io("jobs", self.store.update, job["id"], progress=0.1)
+        try:
+            result = await handler(dict(job["params"], **self.store.secrets(job["id"])))
+        except HTTPException as e:
+            if e.status_code == 503:
+                # Pools are saturated: put the job back and let it wait its turn.
+                await run_io(
+                    "jobs", self.store.update, job["id"], state=QUEUED, progress=0.0
+                )
+                await asyncio.sleep(self.poll_interval)
+                return
+            await self._fail(job, e.detail)
+            return
+        except Exception as e:
+            print(f"Job {job['id']} ({job['operation']}) failed: {e}")
+            await self._fail(job, str(e))
+            return
+
+        self.store.forget(job["id"])
+        await run_io(
+            "jobs",
+            self.store.update,
+            job["id"],
+            state=DONE,
+            progress=1.0,
+            params={},
+            result=result,
+            cleanup=job["cleanup"] + [result["path"]],
+        )
+
+    async def _fail(self, job: Dict, error: str):
+        self.store.forget(job["id"])
+        await run_io("jobs", self.cleanup, job["cleanup"])
+        await run_io(
+            "jobs",
+            self.store.update,
+            job["id"],
+            state=FAILED,
+            error=error,
+            params={},
+            cleanup=[],
+        )
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(max(self.ttl / 10, self.poll_interval))
+            await self.sweep()
+
+    async def sweep(self):
+        for job in await run_io("jobs", self.store.expired, self.ttl):
+            if job["state"] == RUNNING:
+                # Untouched for a whole TTL and not running here: the process
+                # that claimed it is gone. It stays visible as failed for
+                # another TTL, then goes like any other.
+                if job["id"] not in self._running:
+                    await self._fail(job, "Job was interrupted.")
+                continue
+            await run_io("jobs", self.cleanup, job["cleanup"] or [])
+            await run_io("jobs", self.store.delete, job["id"])
@@ -0,0 +1,159 @@
+import os
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pypdf import PdfReader
+import metrics
+
+# The file key lives on private attributes of pypdf's encryption object
+# (checked against the pinned pypdf 6.6.0). Should they move, the cache is
+# bypassed instead of failing the request.
+KEY_FIELDS = ("_key", "_password_type")
+
+
+class KeyCache:
+    # Short-lived, memory-only record of passwords that were already verified.
+    # Entries are addressed by an HMAC of the document identity and the
+    # password, so neither the password nor anything that can be checked
+    # against it offline is kept. The value is the derived file key (or just
+    # True for a content-level check), which lets a reader skip key derivation.
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._new: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, identity: str, password: Optional[str]) -> str:
+        message = f"{identity}\0{password or ''}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def get(self, identity: str, password: Optional[str]) -> Any:
+        if self.max_entries <= 0:
+            return None
+        slot = self._slot(identity, password)
+        with self._lock:
+            entry = self._entries.get(slot)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(slot)
+                metrics.inc("key_cache_lookups_total", result="hit")
+                return entry[1]
+            self._entries.pop(slot, None)
+        metrics.inc("key_cache_lookups_total", result="miss")
+        return None
+
+    def put(self, identity: str, password: Optional[str], value: Any):
+        if self.max_entries <= 0:
+            return
+        entry = (time.time() + self.ttl, value)
+        slot = self._slot(identity, password)
+        with self._lock:
+            self._store(slot, entry)
+            self._new[slot] = entry
+
+    def _store(self, slot: str, entry: Tuple[float, Any]):
+        self._entries[slot] = entry
+        self._entries.move_to_end(slot)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Worker processes have their own copy. They get the server's entries with
+    # each task and hand back whatever they verified, see workers.run_cpu.
+    def export(self) -> Optional[Dict[str, Any]]:
+        if self.max_entries <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            entries = {k: v for k, v in self._entries.items() if v[0] > now}
+        return {"secret": self._secret, "entries": entries}
+
+    def load(self, state: Optional[Dict[str, Any]]):
+        if state is None:
+            self.max_entries = 0
+            return
+        with self._lock:
+            self._secret = state["secret"]
+            self._entries = OrderedDict(state["entries"])
+            self._new = {}
+
+    def drain(self) -> Dict[str, Tuple[float, Any]]:
+        with self._lock:
+            new, self._new = self._new, {}
+        return new
+
+    def merge(self, entries: Dict[str, Tuple[float, Any]]):
+        with self._lock:
+            for slot, entry in entries.items():
+                self._store(slot, entry)
+
+
+def _encryption(reader: PdfReader) -> Any:
+    encryption = getattr(reader, "_encryption", None)
+    if encryption is None or not all(hasattr(encryption, f) for f in KEY_FIELDS):
+        return None
+    return encryption
+
+
+def encryption_identity(reader: PdfReader) -> Optional[str]:
+    # Everything the file key is derived from besides the password; None when
+    # this pypdf doesn't expose it.
+    encryption = _encryption(reader)
+    if encryption is None:
+        return None
+    try:
+        values = encryption.values
+        parts = (
+            encryption.id1_entry,
+            values.O,
+            values.U,
+            values.OE,
+            values.UE,
+            f"{encryption.V}:{encryption.R}:{encryption.P}:{encryption.Length}",
+            str(encryption.EncryptMetadata),
+        )
+    except AttributeError:
+        return None
+    digest = hashlib.sha256()
+    for part in parts:
+        part = part.encode() if isinstance(part, str) else part
+        digest.update(len(part).to_bytes(4, "big") + part)
+    return f"enc:{digest.hexdigest()}"
+
+
+def content_identity(sha256: str) -> str:
+    return f"sha:{sha256}"
+
+
+def read_file_key(reader: PdfReader) -> Optional[Tuple[bytes, Any]]:
+    encryption = _encryption(reader)
+    if encryption is None:
+        return None
+    return tuple(getattr(encryption, field) for field in KEY_FIELDS)
+
+
+def apply_file_key(reader: PdfReader, value: Tuple[bytes, Any]) -> bool:
+    # The same state PdfReader.decrypt leaves behind after a successful check.
+    encryption = _encryption(reader)
+    if encryption is None:
+        return False
+    for field, part in zip(KEY_FIELDS, value):
+        setattr(encryption, field, part)
+    return True
+
+
+_keys: Optional[KeyCache] = None
+
+
+def get_key_cache() -> KeyCache:
+    global _keys
+    if _keys is None:
+        _keys = KeyCache(
+            int(os.getenv("KEY_CACHE_SIZE", 256)),
+            float(os.getenv("KEY_CACHE_TTL", 300)),
+        )
+    return _keys
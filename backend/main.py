@@ -1,162 +1,180 @@
 import os
+import re
 import json
-import io
-from pypdf import PdfReader
-from typing import List, Dict
+import asyncio
+import shutil
+import hashlib
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Tuple
+from urllib.parse import quote
 from fastapi import (
     FastAPI,
-    UploadFile,
-    File,
     BackgroundTasks,
+    Depends,
     Form,
     HTTPException,
     Request,
 )
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from pdf_utils import *
+from workers import (
+    run_io,
+    run_cpu,
+    stream_io,
+    shutdown_pools,
+    get_io_pool,
+    queue_depth,
+    run_batch,
+    iter_async,
+    batch_workers,
+    operation_slot,
+    run_cpu_held,
+    run_io_held,
+)
+from gs_pool import shutdown_pool, get_pool, find_ghostscript
+from jobs import JobRunner, create_job_store, job_status, DONE
+from ingest import (
+    UploadForm,
+    RequestSizeLimitMiddleware,
+    parse_upload_form,
+    spill_uploads,
+    upload_error,
+)
+from result_cache import cache_key, create_result_cache, create_thumbnail_cache
+import metrics
+from key_cache import get_key_cache, content_identity
+from workspace import create_temp_store
+from admission import (
+    create_admission_controller,
+    request_cost,
+    LEVEL_WEIGHTS,
+    OPERATION_WEIGHTS,
+)
+from document_store import create_document_store
 
 load_dotenv()
-app = FastAPI()
+job_store = create_job_store()
+result_cache = create_result_cache()
+thumbnail_cache = create_thumbnail_cache()
+document_store = create_document_store()
+temp_store = create_temp_store()
+admission = create_admission_controller()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_runner = JobRunner(job_store, JOB_HANDLERS, cleanup_files)
+    job_runner.start()
+    janitor = asyncio.create_task(
+        temp_store.run_janitor(float(os.getenv("WORKSPACE_SWEEP_INTERVAL", 60)))
+    )
+    yield
+    janitor.cancel()
+    await asyncio.gather(janitor, return_exceptions=True)
+    await job_runner.stop()
+    shutdown_pools()
+    shutdown_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 DEBUG_MODE = os.getenv("DEBUG").lower() == "true"
 TEMP_FOLDER = os.getenv("TEMP_FOLDER")
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE"))
+MAX_REQUEST_SIZE = int(os.getenv("MAX_REQUEST_SIZE", MAX_FILE_SIZE * 5))
+STREAM_ARCHIVES = os.getenv("STREAM_ARCHIVES", "true").lower() == "true"
+INCREMENTAL_DELETE = os.getenv("INCREMENTAL_DELETE", "false").lower() == "true"
+COMPRESS_SHARD_PAGES = int(os.getenv("COMPRESS_SHARD_PAGES", SHARD_PAGES))
+TIMING_HEADER = os.getenv("TIMING_HEADER", "false").lower() == "true"
+# Sampling walks every thread's stack, so it is opt-in and never too often.
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+PROFILER_MIN_INTERVAL = 0.005
+MEMORY_UPLOAD_MAX = int(os.getenv("MEMORY_UPLOAD_MAX", 1024 * 1024))
+MEMORY_RESULT_MAX = int(os.getenv("MEMORY_RESULT_MAX", 8 * 1024 * 1024))
+BYTE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+LINEARIZE_OUTPUT = os.getenv("LINEARIZE_OUTPUT", "false")
+COMPRESS_ENGINE = os.getenv("COMPRESS_ENGINE", "auto")
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", 1024))
+THUMBNAIL_MAX_PAGES = int(os.getenv("THUMBNAIL_MAX_PAGES", 50))
+# Roughly the first screen of a file grid.
+THUMBNAIL_DEFAULT_PAGES = "1-12"
+THUMBNAIL_KEY = re.compile(r"[0-9a-f]{64}")
+# File fields that also take the id of a stored document.
+DOCUMENT_FIELDS = ("file", "files")
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 EXTRA_LIMIT = os.getenv("EXTRA_LIMIT")
 DEFAULT_LIMIT = os.getenv("DEFAULT_LIMIT")
+# A chunked upload takes many requests, so chunks get their own budget.
+UPLOAD_CHUNK_LIMIT = os.getenv("UPLOAD_CHUNK_LIMIT", "120/minute")
 origins_str = os.getenv("ALLOWED_ORIGINS", "")
 origins = [origin.strip() for origin in origins_str.split(",") if origin]
+app.add_middleware(RequestSizeLimitMiddleware, max_size=MAX_REQUEST_SIZE)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "ETag", "Accept-Ranges", "Content-Range"],
 )
+# Outermost, so rejected and CORS requests are measured too.
+app.add_middleware(metrics.MetricsMiddleware, timing_header=TIMING_HEADER)
 
 
 def cleanup_files(file_paths: List[str]):
     for path in file_paths:
-        if path and os.path.exists(path):
+        if path and temp_store.owns(path):
+            temp_store.release(path)
+        elif path and os.path.exists(path):
             try:
-                os.remove(path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
             except Exception as e:
                 print(f"Error deleting file {path}: {e}")
 
 
-@app.post("/check-password")
-@limiter.limit(EXTRA_LIMIT)
-async def check_password_endpoint(
-    request: Request, file: UploadFile = File(...), password: str = Form(None)
-):
-    try:
-        content = await file.read()
-        await file.seek(0)
-        reader = PdfReader(io.BytesIO(content))
-        if reader.is_encrypted:
-            if password and reader.decrypt(password):
-                return {"ok": True}
-            else:
-                return {"ok": False, "error": "Invalid password"}
-        else:
-            return {"ok": True}
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
-
-
-@app.post("/validate-pdf")
-async def validate_pdf_endpoint(files: List[UploadFile] = File(...)):
-    print(f"/validate-pdf called with {len(files)} files.")  # Debug log
-
-    results = {}
-    for file in files:
-        error_type = None
-        error_message = None
-        try:
-            result = await validate_file(file)
-            await file.seek(0)
-            content = await file.read()
-            if not content or len(content) == 0:
-                error_type = "empty"
-                error_message = "File is empty."
-            elif result is not None:
-                error_type = result["type"]
-                error_message = result["message"]
-            if error_type:
-                results[file.filename] = {
-                    "ok": False,
-                    "error_type": error_type,
-                    "error": error_message,
-                }
-            else:
-                results[file.filename] = {"ok": True}
-        except HTTPException as e:
-            try:
-                detail = json.loads(e.detail)
-                results[file.filename] = {
-                    "ok": False,
-                    "error_type": detail.get("type", "unknown"),
-                    "error": detail.get("message", str(e)),
-                }
-            except Exception:
-                results[file.filename] = {
-                    "ok": False,
-                    "error_type": "unknown",
-                    "error": str(e),
-                }
-        except Exception as e:
-            results[file.filename] = {
-                "ok": False,
-                "error_type": "unknown",
-                "error": str(e),
-            }
-    return results
-
-
-async def validate_file(file: UploadFile):
-    if file.size and file.size > MAX_FILE_SIZE:
-        return {
-            "type": "too_large",
-            "message": f"File too large. Max size is {MAX_FILE_SIZE} bytes.",
-        }
-    await file.seek(0)
-    header = await file.read(5)
-    await file.seek(0)
-    if not header.startswith(b"%PDF-"):
-        return {
-            "type": "invalid_format  ",
-            "message": " Not a generic PDF.",
-        }
-    return None
-
-
-async def check_files_lock(files: List[UploadFile], passwords_dict: Dict[str, str]):
-    locked_files_names = []
-    for file in files:
-        await file.seek(0)
-        content = await file.read()
-        await file.seek(0)
-        try:
-            pdf_reader = PdfReader(io.BytesIO(content))
-            if pdf_reader.is_encrypted:
-                file_password = passwords_dict.get(file.filename)
-                if not file_password or not pdf_reader.decrypt(file_password):
-                    locked_files_names.append(file.filename)
-        except Exception as e:
-            print(f"Check lock failed for {file.filename}: {e}")
-            continue
+async def check_files_lock(items: List[Dict]):
+    # Files already opened with the same password skip parsing entirely.
+    keys = get_key_cache()
+    unchecked = [
+        item
+        for item in items
+        if not keys.get(content_identity(item["sha256"]), item.get("password"))
+    ]
+    if not unchecked:
+        return
+    with metrics.stage("lock_check"):
+        locked_files_names = await run_cpu("check_lock", find_locked_files, unchecked)
+    for item in unchecked:
+        if item["name"] not in locked_files_names:
+            keys.put(content_identity(item["sha256"]), item.get("password"), True)
     if locked_files_names:
         raise HTTPException(status_code=423, detail=json.dumps(locked_files_names))
 
 
 def handle_pdf_error(e: Exception, saved_paths: List[str]):
     cleanup_files(saved_paths)
+    if isinstance(e, LockedFilesError):
+        raise HTTPException(status_code=423, detail=json.dumps(e.filenames))
+    if isinstance(e, PipelineStepError):
+        raise HTTPException(
+            status_code=422, detail={"step": e.step, "op": e.op, "error": e.message}
+        )
     error_msg = str(e)
     if "PASSWORD_REQUIRED" in error_msg or "INVALID_PASSWORD" in error_msg:
         try:
@@ -171,24 +189,496 @@ def handle_pdf_error(e: Exception, saved_paths: List[str]):
     )
 
 
+def zip_response(chunks, filename: str, cleanup_paths: List[str]):
+    return StreamingResponse(
+        chunks,
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        background=BackgroundTask(cleanup_files, cleanup_paths),
+    )
+
+
+async def cached_result(
+    key: str, compute: Callable[[], Awaitable[str]]
+) -> Tuple[str, bool]:
+    # Returns (path, cached). Cached paths belong to the cache and must not be
+    # cleaned up after the response.
+    if result_cache is None:
+        return await compute(), False
+    cached_path = await run_io("cache", result_cache.get, key)
+    if cached_path:
+        return cached_path, True
+    result = await compute()
+    await cache_put(key, result)
+    return result, False
+
+
+async def cache_put(key: str, result):
+    if isinstance(result, str):
+        await run_io("cache", result_cache.put, key, result)
+    else:
+        await run_io("cache", result_cache.put_data, key, *result)
+
+
+async def cached_job_result(params: Dict, compute: Callable[[], Awaitable[str]]):
+    key = params.get("cache_key")
+    if result_cache is None or not key:
+        return await compute()
+    # Job results are deleted after download, so jobs get their own copy.
+    cached_path = await run_io("cache", result_cache.export, key, params["output_dir"])
+    if cached_path:
+        return cached_path
+    output_path = await compute()
+    await run_io("cache", result_cache.put, key, output_path)
+    return output_path
+
+
+async def cache_stream(chunks, key: str, name: str):
+    # Tees a streamed archive into the cache; only a complete body is kept.
+    if result_cache is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    staged_path = await run_io("cache", result_cache.start, name)
+    complete = False
+    try:
+        with open(staged_path, "wb") as f:
+            async for chunk in chunks:
+                await loop.run_in_executor(get_io_pool(), f.write, chunk)
+                yield chunk
+        complete = True
+    finally:
+        await chunks.aclose()
+        if complete:
+            await run_io("cache", result_cache.commit, key, staged_path)
+        else:
+            await run_io("cache", result_cache.abort, staged_path)
+
+
+def output_cleanup(saved_paths: List[str], output, cached: bool):
+    if cached or not isinstance(output, str):
+        return saved_paths
+    return saved_paths + [output]
+
+
+def media_type_for(path: str) -> str:
+    return "application/zip" if path.endswith(".zip") else "application/pdf"
+
+
+def result_name(result) -> str:
+    return os.path.basename(result) if isinstance(result, str) else result[0]
+
+
+def output_dir_for(items: List[Dict], form: UploadForm) -> Optional[str]:
+    # Small jobs keep their result in memory; None tells pdf_utils to do so.
+    if sum(item["size"] for item in items) <= MEMORY_RESULT_MAX:
+        return None
+    return form.workspace.output_dir
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags
+
+
+def wants_linearized(form: UploadForm) -> bool:
+    return form.get("linearize", LINEARIZE_OUTPUT).lower() == "true"
+
+
+def compress_engine(form: UploadForm) -> str:
+    engine = form.get("engine", COMPRESS_ENGINE).lower()
+    if engine not in COMPRESS_ENGINES:
+        engines = ", ".join(COMPRESS_ENGINES)
+        raise HTTPException(
+            status_code=422, detail=f"Unknown engine, expected one of {engines}."
+        )
+    return engine
+
+
+def result_response(
+    result, filename: str = None, media_type: str = None, request: Request = None
+):
+    # Results on disk are sent with FileResponse, which hands the path to the
+    # server (pathsend) where supported and answers Range / If-Range requests,
+    # so an interrupted download can resume; in-memory ones get the same
+    # from memory_response.
+    filename = filename or result_name(result)
+    media_type = media_type or media_type_for(result_name(result))
+    if isinstance(result, str):
+        response = FileResponse(
+            path=result,
+            filename=filename,
+            media_type=media_type,
+            stat_result=os.stat(result),
+        )
+        etag = response.headers["etag"]
+        if request is not None and etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return response
+    return memory_response(result[1], filename, media_type, request)
+
+
+def memory_response(
+    content: bytes, filename: str, media_type: str, request: Request = None
+):
+    # An ETag from the content, 304 for a matching If-None-Match, and a single
+    # byte range (unless If-Range names another version), like FileResponse.
+    etag = f'"{hashlib.sha256(content).hexdigest()}"'
+    headers = {
+        "Content-Disposition": content_disposition(filename),
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+    }
+    if request is None:
+        return Response(content=content, media_type=media_type, headers=headers)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    match = BYTE_RANGE.fullmatch(request.headers.get("range", "").strip())
+    if not match or not any(match.groups()):
+        return Response(content=content, media_type=media_type, headers=headers)
+    if request.headers.get("if-range", etag) != etag:
+        return Response(content=content, media_type=media_type, headers=headers)
+    size = len(content)
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last or size - 1), size - 1)
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start > end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(
+        content=content[start : end + 1],
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+def content_disposition(filename: str) -> str:
+    # Same form FileResponse uses.
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def batch_output_dir(item: Dict, form: UploadForm, index: int) -> Optional[str]:
+    # Files run in parallel, so each gets its own directory in case two
+    # uploads share a name.
+    if item["size"] <= MEMORY_RESULT_MAX:
+        return None
+    return os.path.join(form.workspace.output_dir, str(index))
+
+
+async def batch_response(
+    operation: str,
+    func: Callable,
+    items: List[Dict],
+    make_args: Callable[[Dict], Tuple],
+    zip_name: str,
+    form: UploadForm,
+    background_tasks: BackgroundTasks,
+):
+    for i, item in enumerate(items):
+        item["output_dir"] = batch_output_dir(item, form, i)
+    results = run_batch(operation, func, items, make_args)
+    parts = iter_batch_parts(iter_async(results, asyncio.get_running_loop()))
+    # The archive has its own slot so it never waits on the files it collects.
+    if STREAM_ARCHIVES:
+        chunks = await stream_io("archive", stream_zip(parts))
+        return zip_response(chunks, zip_name, form.paths())
+    zip_path = os.path.join(form.workspace.output_dir, zip_name)
+    await run_io("archive", write_zip, parts, zip_path)
+    background_tasks.add_task(cleanup_files, form.paths())
+    return FileResponse(path=zip_path, filename=zip_name, media_type="application/zip")
+
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the PDF upload service!"}
 
 
+def checkout_documents(form: UploadForm):
+    for upload in form.uploads:
+        if "document_id" in upload:
+            document = document_store.checkout(upload["document_id"], form.workspace)
+            if document is None:
+                raise upload_error(
+                    404, "not_found", f"Document {upload['document_id']} not found."
+                )
+            upload.update(document)
+
+
+async def read_upload_form(
+    request: Request, collect_errors: bool = False
+) -> UploadForm:
+    workspace = temp_store.create()
+    try:
+        with metrics.stage("upload"):
+            form = await parse_upload_form(
+                request,
+                workspace,
+                MAX_FILE_SIZE,
+                MEMORY_UPLOAD_MAX,
+                DOCUMENT_FIELDS,
+                collect_errors,
+            )
+        if any("document_id" in upload for upload in form.uploads):
+            await run_io("upload", checkout_documents, form)
+    except BaseException:
+        temp_store.release(workspace.path)
+        raise
+    for upload in form.uploads:
+        if "document_id" in upload:
+            continue
+        metrics.inc(
+            "upload_bytes_total",
+            upload["size"],
+            operation=metrics.current_operation.get(),
+        )
+    return form
+
+
+async def upload_form(request: Request) -> AsyncIterator[UploadForm]:
+    # The workspace goes when the request is over however it ends: after the
+    # response, on an error raised after parsing (e.g. by the rate limiter),
+    # or when the client disconnects mid-response. Jobs take it over instead.
+    form = await read_upload_form(request)
+    try:
+        yield form
+    finally:
+        release_form(form)
+
+
+async def checked_upload_form(request: Request) -> AsyncIterator[UploadForm]:
+    # upload_form for routes that report on every file: one that is too large,
+    # empty or not a PDF is marked with an "error" instead of failing the
+    # request.
+    form = await read_upload_form(request, collect_errors=True)
+    try:
+        yield form
+    finally:
+        release_form(form)
+
+
+def release_form(form: UploadForm):
+    if not form.workspace.kept:
+        temp_store.release(form.workspace.path)
+
+
+async def admit(
+    request: Request,
+    operation: str,
+    form: UploadForm,
+    pages: Optional[int] = None,
+    level: Optional[str] = None,
+):
+    if admission is None:
+        return
+    uploads = [upload for upload in form.uploads if "error" not in upload]
+    if pages is None:
+        sources = [item_source(upload) for upload in uploads]
+        pages = await run_io("admission", count_pages, sources)
+    if level is None and operation == "compress":
+        level = form.get("level")
+    cost = request_cost(operation, [u["size"] for u in uploads], pages, level)
+    try:
+        await admission.admit(get_remote_address(request), operation, cost)
+    except BaseException:
+        cleanup_files(form.paths())
+        raise
+
+
+def admitted_form(operation: str):
+    # upload_form, then admission control charged for what was uploaded.
+    async def dependency(
+        request: Request, form: UploadForm = Depends(upload_form)
+    ) -> UploadForm:
+        await admit(request, operation, form)
+        return form
+
+    return dependency
+
+
+@app.post("/check-password")
+@limiter.limit(EXTRA_LIMIT)
+async def check_password_endpoint(
+    request: Request, form: UploadForm = Depends(checked_upload_form)
+):
+    # Only the trailer and encryption dictionary are read.
+    await admit(request, "check_password", form, 0)
+    upload = form.files("file")[0]
+    if "error" in upload:
+        return {"ok": False, "error": upload["error"]["message"]}
+    password = form.get("password")
+    try:
+        # Remembered so the operation that follows doesn't check it again.
+        identity = content_identity(upload["sha256"])
+        if get_key_cache().get(identity, password):
+            return {"ok": True}
+        if await run_io("check_password", is_locked, item_source(upload), password):
+            return {"ok": False, "error": "Invalid password"}
+        get_key_cache().put(identity, password, True)
+        return {"ok": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+
+@app.post("/validate-pdf")
+async def validate_pdf_endpoint(form: UploadForm = Depends(checked_upload_form)):
+    # The checks run while the upload streams in; nothing else is read.
+    results = {}
+    for upload in form.files("files"):
+        error = upload.get("error")
+        metrics.inc("validated_files_total", result=error["type"] if error else "ok")
+        if error:
+            results[upload["name"]] = {
+                "ok": False,
+                "error_type": error["type"],
+                "error": error["message"],
+            }
+        else:
+            results[upload["name"]] = {"ok": True}
+    return results
+
+
 @app.post("/upload-pdf/")
 @limiter.limit(EXTRA_LIMIT)
-async def upload_pdf(request: Request, file: UploadFile = File(...)):
-    if not file.filename.endswith(".pdf"):
+async def upload_pdf(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    form: UploadForm = Depends(upload_form),
+):
+    upload = form.files("file")[0]
+    if not upload["name"].endswith(".pdf"):
+        cleanup_files(form.paths())
         return {"error": "Invalid file. Please upload only PDF files."}
-    await validate_file(file)
-    file_location = save_file_to_temp(file, TEMP_FOLDER)
+    try:
+        document = await run_io("upload", document_store.add_upload, upload)
+    finally:
+        background_tasks.add_task(cleanup_files, form.paths())
     return {
-        "filename": file.filename,
-        "location": file_location,
+        "id": document["id"],
+        "token": document["token"],
+        "filename": upload["name"],
+        "size": document["size"],
         "status": "File uploaded successfully",
-        "content_type": file.content_type,
+        "content_type": "application/pdf",
+    }
+
+
+@app.post("/documents", status_code=201)
+@limiter.limit(EXTRA_LIMIT)
+async def upload_documents(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    form: UploadForm = Depends(upload_form),
+):
+    # Stores the uploaded files ("file"/"files"). Their ids can then be sent
+    # as the value of a file field to any endpoint instead of the file.
+    background_tasks.add_task(cleanup_files, form.paths())
+    uploads = [
+        u
+        for u in form.uploads
+        if u["field"] in DOCUMENT_FIELDS and "document_id" not in u
+    ]
+    if not uploads:
+        cleanup_files(form.paths())
+        raise HTTPException(status_code=422, detail="Missing file field: files")
+    documents = []
+    for upload in uploads:
+        documents.append(await run_io("upload", document_store.add_upload, upload))
+    return {"documents": documents}
+
+
+@app.api_route("/documents/{doc_id}", methods=["GET", "HEAD"])
+async def get_document(doc_id: str):
+    document = await run_io("upload", document_store.describe, doc_id.lower())
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return document
+
+
+@app.delete("/documents/{doc_id}", status_code=204)
+@limiter.limit(DEFAULT_LIMIT)
+async def delete_document(request: Request, doc_id: str):
+    # Ids are content hashes anyone may know; only the token handed out with
+    # an upload drops that upload's claim on the document.
+    token = request.headers.get("Document-Token", "")
+    if not await run_io("upload", document_store.remove, doc_id.lower(), token):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return Response(status_code=204)
+
+
+@app.post("/documents/uploads", status_code=201)
+@limiter.limit(EXTRA_LIMIT)
+async def create_upload_session(
+    request: Request, filename: str = Form(...), size: int = Form(...)
+):
+    # Starts a chunked upload of size bytes. Chunks are sent with PATCH and an
+    # Upload-Offset header; after an interruption, GET tells where to resume.
+    session = await run_io("upload", document_store.create_session, filename, size)
+    return dict(session, url=f"/documents/uploads/{session['upload_id']}")
+
+
+def upload_status(session: Dict, document: Optional[Dict] = None) -> JSONResponse:
+    content = {
+        "upload_id": session["upload_id"],
+        "offset": session["offset"],
+        "size": session["size"],
     }
+    if document is not None:
+        content["document"] = document
+    return JSONResponse(content, headers={"Upload-Offset": str(session["offset"])})
+
+
+@app.api_route("/documents/uploads/{upload_id}", methods=["GET", "HEAD"])
+async def get_upload_session(upload_id: str):
+    return upload_status(await run_io("upload", document_store.session, upload_id))
+
+
+@app.patch("/documents/uploads/{upload_id}")
+@limiter.limit(UPLOAD_CHUNK_LIMIT)
+async def append_upload_chunk(request: Request, upload_id: str):
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Missing Upload-Offset header.")
+    session, f = await run_io("upload", document_store.open_session, upload_id, offset)
+
+    # Whatever arrives is kept, so a chunk cut off halfway resumes from where
+    # it stopped rather than from its start. The session stays locked until
+    # f is closed, finishing included.
+    loop = asyncio.get_running_loop()
+    try:
+        async for chunk in request.stream():
+            if session["offset"] + len(chunk) > session["size"]:
+                await loop.run_in_executor(get_io_pool(), f.truncate, offset)
+                raise upload_error(
+                    413, "too_large", "Chunk runs past the declared size."
+                )
+            await loop.run_in_executor(get_io_pool(), f.write, chunk)
+            session["offset"] += len(chunk)
+        if session["offset"] < session["size"]:
+            return upload_status(session)
+        await loop.run_in_executor(get_io_pool(), f.flush)
+        document = await run_io("upload", document_store.finish_session, upload_id)
+        return upload_status(session, document)
+    finally:
+        await loop.run_in_executor(get_io_pool(), f.close)
+
+
+@app.delete("/documents/uploads/{upload_id}", status_code=204)
+async def abort_upload_session(upload_id: str):
+    await run_io("upload", document_store.session, upload_id)
+    await run_io("upload", document_store.discard_session, upload_id)
+    return Response(status_code=204)
 
 
 @app.post("/merge")
@@ -196,44 +686,47 @@ async def upload_pdf(request: Request, file: UploadFile = File(...)):
 async def merge_pdfs_endpoint(
     request: Request,
     background_tasks: BackgroundTasks,
-    files: List[UploadFile] = File(...),
-    passwords: str = Form("{}"),
-    rotations: str = Form("{}"),
+    form: UploadForm = Depends(admitted_form("merge")),
 ):
 
-    saved_paths_list = []
+    saved_paths_list = form.paths()
 
     try:
-        passwords_dict = json.loads(passwords)
-        rotations_dict = json.loads(rotations)
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
     except:
         passwords_dict = {}
         rotations_dict = {}
 
     try:
-        await check_files_lock(files, passwords_dict)
         merge_items = []
 
-        for file in files:
-            await validate_file(file)
-            path = save_file_to_temp(file, TEMP_FOLDER)
-            saved_paths_list.append(path)
-            file_pass = passwords_dict.get(file.filename)
-            file_rot = rotations_dict.get(file.filename, 0)
-            merge_items.append(
-                {"path": path, "password": file_pass, "rotation": int(file_rot)}
-            )
+        for item in form.files("files"):
+            item["password"] = passwords_dict.get(item["name"])
+            item["rotation"] = int(rotations_dict.get(item["name"], 0))
+            merge_items.append(item)
 
         if not merge_items:
             return {"error": "No valid PDF files uploaded."}
 
-        merge_files_path = merge_pdfs(merge_items)
-        files_to_delete = saved_paths_list + [merge_files_path]
+        linearize = wants_linearized(form)
+        key = cache_key(
+            "merge",
+            merge_items,
+            rotations=[i["rotation"] for i in merge_items],
+            linearize=linearize,
+        )
+        output_dir = output_dir_for(merge_items, form)
+        merged, cached = await cached_result(
+            key,
+            lambda: run_cpu(
+                "merge", merge_pdfs, merge_items, "merged.pdf", output_dir, linearize
+            ),
+        )
+        files_to_delete = output_cleanup(saved_paths_list, merged, cached)
         background_tasks.add_task(cleanup_files, files_to_delete)
 
-        return FileResponse(
-            path=merge_files_path, filename="merged.pdf", media_type="application/pdf"
-        )
+        return result_response(merged, "merged.pdf", "application/pdf", request)
 
     except Exception as e:
         return handle_pdf_error(e, saved_paths_list)
@@ -244,36 +737,74 @@ async def merge_pdfs_endpoint(
 async def delete_pages_endpoint(
     request: Request,
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
-    pages: str = Form(...),
-    passwords: str = Form("{}"),
-    rotations: str = Form("{}"),
+    form: UploadForm = Depends(admitted_form("delete")),
 ):
-    saved_path = None
+    saved_paths = form.paths()
 
     try:
-        passwords_dict = json.loads(passwords)
-        rotations_dict = json.loads(rotations)
-        password = passwords_dict.get(file.filename)
-        rotation = int(rotations_dict.get(file.filename, 0))
+        file = form.files("file")[0]
+        pages = form.require("pages")
+    except HTTPException as e:
+        return handle_pdf_error(e, saved_paths)
+
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
+        password = passwords_dict.get(file["name"])
+        rotation = int(rotations_dict.get(file["name"], 0))
 
     except:
-        passwords_dict = {}
         password = None
         rotation = 0
 
+    # Incremental output keeps the deleted pages' bytes in the file body.
+    incremental = form.get("incremental", str(INCREMENTAL_DELETE)).lower() == "true"
     try:
-        await validate_file(file)
-        await check_files_lock([file], passwords_dict)
-        saved_path = save_file_to_temp(file)
-        new_pdf_path = delete_pages(saved_path, pages, password, rotation)
-        pages_to_delete = [saved_path, new_pdf_path]
-        background_tasks.add_task(cleanup_files, pages_to_delete)
-        return FileResponse(
-            path=new_pdf_path, filename="edited.pdf", media_type="application/pdf"
+        key = cache_key(
+            "delete",
+            [dict(file, password=password)],
+            pages=pages,
+            rotation=rotation,
+            incremental=incremental,
         )
+        edited, cached = await cached_result(
+            key,
+            lambda: run_cpu(
+                "delete",
+                delete_pages,
+                item_source(file),
+                pages,
+                password,
+                rotation,
+                incremental,
+                output_dir_for([file], form),
+            ),
+        )
+        pages_to_delete = output_cleanup(saved_paths, edited, cached)
+        background_tasks.add_task(cleanup_files, pages_to_delete)
+        return result_response(edited, "edited.pdf", "application/pdf", request)
     except Exception as e:
-        return handle_pdf_error(e, [saved_path] if saved_path else [])
+        return handle_pdf_error(e, saved_paths)
+
+
+def split_spec(form: UploadForm, mode: str):
+    # The value plan_split_parts takes for each mode.
+    try:
+        if mode == "ranges":
+            return form.require("ranges")
+        if mode == "every":
+            value = int(form.get("pages_per_part", "1"))
+        elif mode == "bookmarks":
+            value = int(form.get("level", "1"))
+        elif mode == "size":
+            value = int(float(form.require("max_size_mb")) * 1024 * 1024)
+        else:
+            raise HTTPException(status_code=422, detail=f"Unknown split mode: {mode}")
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid value for {mode} split")
+    if value < 1:
+        raise HTTPException(status_code=422, detail=f"Invalid value for {mode} split")
+    return value
 
 
 @app.post("/split_pdf")
@@ -281,37 +812,212 @@ async def delete_pages_endpoint(
 async def split_pdf_endpoint(
     request: Request,
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
-    ranges: str = Form(...),
-    passwords: str = Form("{}"),
-    rotations: str = Form("{}"),
+    form: UploadForm = Depends(admitted_form("split")),
 ):
-    saved_path = None
+    saved_paths = form.paths()
+
     try:
-        passwords_dict = json.loads(passwords)
-        rotations_dict = json.loads(rotations)
-        password = passwords_dict.get(file.filename)
-        rotation = int(rotations_dict.get(file.filename, 0))
+        file = form.files("file")[0]
+        mode = form.get("mode", "ranges")
+        spec = split_spec(form, mode)
+    except HTTPException as e:
+        return handle_pdf_error(e, saved_paths)
+
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
+        password = passwords_dict.get(file["name"])
+        rotation = int(rotations_dict.get(file["name"], 0))
 
     except:
-        passwords_dict = {}
         password = None
         rotation = 0
 
+    base_name = os.path.splitext(file["name"])[0]
+    key = cache_key(
+        "split",
+        [dict(file, password=password)],
+        mode=mode,
+        spec=spec,
+        rotation=rotation,
+        base_name=base_name,
+    )
     try:
-        await validate_file(file)
-        await check_files_lock([file], passwords_dict)
-        saved_path = save_file_to_temp(file)
-        output_path = split_pdf(saved_path, ranges, password, rotation)
-        if output_path.endswith(".zip"):
-            media_type = "application/zip"
-        else:
-            media_type = "application/pdf"
-        filename = os.path.basename(output_path)
-        background_tasks.add_task(cleanup_files, [saved_path, output_path])
-        return FileResponse(path=output_path, filename=filename, media_type=media_type)
+        cached_path = result_cache and await run_io("cache", result_cache.get, key)
+        if cached_path:
+            background_tasks.add_task(cleanup_files, saved_paths)
+            return result_response(cached_path, request=request)
+
+        source = item_source(file)
+        output_dir = output_dir_for([file], form)
+        # The request holds one split slot; its parts are written under it by
+        # several workers, each opening the source itself and taking a
+        # consecutive run of parts. Any part failing fails the request, so an
+        # incomplete archive is never sent or cached.
+        async with operation_slot("split"):
+            parts = await run_cpu_held(
+                "split", plan_split_parts, source, password, mode, spec, base_name
+            )
+            batches = balanced_batches(
+                parts, batch_workers(), lambda part: len(part[1])
+            )
+            written = await asyncio.gather(
+                *(
+                    run_cpu_held(
+                        "split",
+                        write_split_parts,
+                        source,
+                        password,
+                        batch,
+                        rotation,
+                        output_dir,
+                    )
+                    for batch in batches
+                )
+            )
+        outputs = [output for batch in written for output in batch]
+        if len(outputs) == 1:
+            output = outputs[0]
+            if result_cache:
+                await cache_put(key, output)
+            background_tasks.add_task(
+                cleanup_files, output_cleanup(saved_paths, output, False)
+            )
+            return result_response(output, request=request)
+
+        zip_name = f"{base_name}_splits.zip"
+        entries = iter_batch_parts([({"name": base_name}, outputs, None)])
+        if STREAM_ARCHIVES:
+            chunks = await stream_io("archive", stream_zip(entries))
+            return zip_response(
+                cache_stream(chunks, key, zip_name), zip_name, saved_paths
+            )
+        zip_path = os.path.join(form.workspace.output_dir, zip_name)
+        await run_io("archive", write_zip, entries, zip_path)
+        if result_cache:
+            await cache_put(key, zip_path)
+        background_tasks.add_task(cleanup_files, saved_paths)
+        return result_response(zip_path, request=request)
     except Exception as e:
-        return handle_pdf_error(e, [saved_path] if saved_path else [])
+        return handle_pdf_error(e, saved_paths)
+
+
+async def run_compress(
+    path: str,
+    level: str,
+    password,
+    rotation: int,
+    output_dir: str,
+    sharded: bool,
+    linearize: bool = False,
+    engine: str = "ghostscript",
+) -> str:
+    if engine == "auto":
+        engine = await run_cpu("compress", pick_compress_engine, path, password, engine)
+    metrics.inc("compress_engine_total", engine=engine)
+    if engine == "native":
+        return await run_native_compress(
+            path, level, password, rotation, output_dir, linearize
+        )
+    if sharded:
+        return await run_sharded_compress(
+            path, level, password, rotation, output_dir, linearize
+        )
+    return await run_io(
+        "compress", compress_pdf, path, level, password, rotation, output_dir, linearize
+    )
+
+
+async def run_sharded_compress(
+    path: str,
+    level: str,
+    password,
+    rotation: int,
+    output_dir: str,
+    linearize: bool = False,
+) -> str:
+    # compress_pdf_sharded split up: shards are cut and joined in the process
+    # pool, and compressed on threads driving this process's Ghostscript pool,
+    # whose size caps how many run at once. The request holds one slot.
+    async with operation_slot("compress"):
+        shards = await run_cpu_held(
+            "compress",
+            write_shards,
+            path,
+            password,
+            rotation,
+            output_dir,
+            COMPRESS_SHARD_PAGES,
+        )
+        if shards is None:
+            return await run_io_held(
+                "compress",
+                compress_pdf,
+                path,
+                level,
+                password,
+                rotation,
+                output_dir,
+                linearize,
+            )
+
+        shard_dir, shard_paths = shards
+        try:
+            compressed_paths = [compressed_shard_path(p) for p in shard_paths]
+            # Every shard finishes before the directory goes, failed or not.
+            results = await asyncio.gather(
+                *(
+                    run_io_held("compress", compress_file, shard, compressed, level)
+                    for shard, compressed in zip(shard_paths, compressed_paths)
+                ),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            return await run_cpu_held(
+                "compress",
+                join_shards,
+                path,
+                password,
+                compressed_paths,
+                level,
+                output_dir,
+                linearize,
+            )
+        finally:
+            await run_io_held("compress", shutil.rmtree, shard_dir, True)
+
+
+async def run_native_compress(
+    path: str,
+    level: str,
+    password,
+    rotation: int,
+    output_dir: str,
+    linearize: bool = False,
+) -> str:
+    # Distinct images are re-encoded by several workers at once, between a
+    # scan and a write that run in one each.
+    images = await run_cpu("compress", plan_image_recompression, path, password, level)
+    batches = balanced_batches(images, batch_workers(), lambda image: image["size"])
+    encoded = await asyncio.gather(
+        *(
+            run_cpu("images", recompress_images, path, password, batch, level)
+            for batch in batches
+        )
+    )
+    return await run_cpu(
+        "compress",
+        write_recompressed,
+        path,
+        password,
+        [image for batch in encoded for image in batch],
+        level,
+        rotation,
+        output_dir,
+        linearize,
+    )
 
 
 @app.post("/compress_pdf")
@@ -319,35 +1025,65 @@ async def split_pdf_endpoint(
 async def compress_pdf_endpoint(
     request: Request,
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
-    level: str = Form("recommended"),
-    passwords: str = Form("{}"),
-    rotations: str = Form("{}"),
+    form: UploadForm = Depends(admitted_form("compress")),
 ):
-    saved_path = None
+    saved_paths = form.paths()
+
     try:
-        passwords_dict = json.loads(passwords)
-        rotations_dict = json.loads(rotations)
-        password = passwords_dict.get(file.filename)
-        rotation = int(rotations_dict.get(file.filename, 0))
+        file = form.files("file")[0]
+        saved_path = file["path"]
+    except HTTPException as e:
+        return handle_pdf_error(e, saved_paths)
+
+    level = form.get("level", "recommended")
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
+        password = passwords_dict.get(file["name"])
+        rotation = int(rotations_dict.get(file["name"], 0))
 
     except:
-        passwords_dict = {}
         password = None
         rotation = 0
+    sharded = form.get("sharded", "false").lower() == "true"
+    linearize = wants_linearized(form)
     try:
-        await validate_file(file)
-        await check_files_lock([file], passwords_dict)
-        saved_path = save_file_to_temp(file)
-        compressed_path = compress_pdf(saved_path, level, password, rotation)
-        background_tasks.add_task(cleanup_files, [saved_path, compressed_path])
-        return FileResponse(
-            path=compressed_path,
-            filename=f"compressed_{level}_{file.filename}",
-            media_type="application/pdf",
+        engine = compress_engine(form)
+        # Ghostscript runs in its own process, so only a thread waits on it.
+        await run_io("compress", spill_uploads, [file])
+        key = cache_key(
+            "compress",
+            [dict(file, password=password)],
+            level=level,
+            rotation=rotation,
+            sharded=sharded,
+            linearize=linearize,
+            engine=engine,
+        )
+        compressed_path, cached = await cached_result(
+            key,
+            lambda: run_compress(
+                saved_path,
+                level,
+                password,
+                rotation,
+                form.workspace.output_dir,
+                sharded,
+                linearize,
+                engine,
+            ),
+        )
+        background_tasks.add_task(
+            cleanup_files, output_cleanup(saved_paths, compressed_path, cached)
+        )
+        return result_response(
+            compressed_path,
+            f"compressed_{level}_{file['name']}",
+            "application/pdf",
+            request,
         )
     except Exception as e:
-        return handle_pdf_error(e, [saved_path] if saved_path else [])
+        return handle_pdf_error(e, saved_paths)
 
 
 @app.post("/lock-pdf")
@@ -355,43 +1091,51 @@ async def compress_pdf_endpoint(
 async def lock_pdf_endpoint(
     request: Request,
     background_tasks: BackgroundTasks,
-    files: List[UploadFile] = File(...),
-    password: str = Form(...),
-    passwords: str = Form("{}"),
-    rotations: str = Form("{}"),
+    form: UploadForm = Depends(admitted_form("lock")),
 ):
-    saved_paths_list = []
+    saved_paths_list = form.paths()
     try:
-        old_passwords_dict = json.loads(passwords)
-        rotations_dict = json.loads(rotations)
+        old_passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
 
     except:
         old_passwords_dict = {}
         rotations_dict = {}
 
     try:
-        await check_files_lock(files, old_passwords_dict)
+        password = form.require("password")
         lock_items = []
 
-        for file in files:
-            await validate_file(file)
-            path = save_file_to_temp(file)
-            saved_paths_list.append(path)
-            old_pass = old_passwords_dict.get(file.filename)
-            file_rot = rotations_dict.get(file.filename, 0)
-            lock_items.append(
-                {"path": path, "password": old_pass, "rotation": int(file_rot)}
+        for item in form.files("files"):
+            item["password"] = old_passwords_dict.get(item["name"])
+            item["rotation"] = int(rotations_dict.get(item["name"], 0))
+            lock_items.append(item)
+
+        if len(lock_items) > 1:
+            await check_files_lock(lock_items)
+            return await batch_response(
+                "lock",
+                lock_pdf,
+                lock_items,
+                lambda item: (item, password, item["output_dir"]),
+                "locked_files.zip",
+                form,
+                background_tasks,
             )
 
-        output_path = lock_pdfs(lock_items, password)
-        if output_path.endswith(".zip"):
+        output = await run_cpu(
+            "lock", lock_pdfs, lock_items, password, output_dir_for(lock_items, form)
+        )
+        if result_name(output).endswith(".zip"):
             media_type = "application/zip"
             filename = "locked_files.zip"
         else:
             media_type = "application/pdf"
-            filename = f"locked_{files[0].filename}"
-        background_tasks.add_task(cleanup_files, saved_paths_list + [output_path])
-        return FileResponse(path=output_path, filename=filename, media_type=media_type)
+            filename = f"locked_{lock_items[0]['name']}"
+        background_tasks.add_task(
+            cleanup_files, output_cleanup(saved_paths_list, output, False)
+        )
+        return result_response(output, filename, media_type, request)
     except Exception as e:
         return handle_pdf_error(e, saved_paths_list)
 
@@ -401,27 +1145,603 @@ async def lock_pdf_endpoint(
 async def unlock_pdf_endpoint(
     request: Request,
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
-    password: str = Form(None),
-    rotations: str = Form("{}"),
+    form: UploadForm = Depends(admitted_form("unlock")),
+):
+    saved_paths = form.paths()
+
+    # Several files (as "files", or repeated "file") are unlocked as a batch.
+    files = [u for u in form.uploads if u["field"] in ("file", "files")]
+    try:
+        file = files[0] if files else form.files("file")[0]
+    except HTTPException as e:
+        return handle_pdf_error(e, saved_paths)
+
+    password = form.get("password")
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
+        rotation = int(rotations_dict.get(file["name"], 0))
+
+    except:
+        passwords_dict = {}
+        rotations_dict = {}
+        rotation = 0
+
+    try:
+        if len(files) > 1:
+            for item in files:
+                item["password"] = passwords_dict.get(item["name"], password)
+                item["rotation"] = int(rotations_dict.get(item["name"], 0))
+            await check_files_lock(files)
+            return await batch_response(
+                "unlock",
+                unlock_pdf,
+                files,
+                lambda item: (
+                    item_source(item),
+                    item["password"],
+                    item["rotation"],
+                    item["output_dir"],
+                    item["name"],
+                ),
+                "unlocked_files.zip",
+                form,
+                background_tasks,
+            )
+
+        linearize = wants_linearized(form)
+        key = cache_key(
+            "unlock",
+            [dict(file, password=password)],
+            rotation=rotation,
+            linearize=linearize,
+        )
+        output, cached = await cached_result(
+            key,
+            lambda: run_cpu(
+                "unlock",
+                unlock_pdf,
+                item_source(file),
+                password,
+                rotation,
+                output_dir_for([file], form),
+                file["name"],
+                linearize,
+            ),
+        )
+        background_tasks.add_task(
+            cleanup_files, output_cleanup(saved_paths, output, cached)
+        )
+        return result_response(
+            output, f"unlocked_{file['name']}", "application/pdf", request
+        )
+    except Exception as e:
+        return handle_pdf_error(e, saved_paths)
+
+
+async def run_pipeline_compressed(
+    path: str,
+    password: Optional[str],
+    plan: List[Dict],
+    output_dir: str,
+    filename: str,
+) -> str:
+    # run_pipeline split up: the pypdf stages in the process pool, Ghostscript
+    # on a thread driving this process's interpreter pool.
+    steps = {step["op"]: step for step in plan}
+    output_path = os.path.join(output_dir, f"processed_{filename}")
+    gs_input, gs_password = await run_cpu(
+        "pipeline", pipeline_gs_input, path, password, plan, output_dir, filename
+    )
+    gs_output = output_path
+    if "lock" in steps:
+        gs_output = os.path.join(output_dir, f".compressed_{filename}")
+    try:
+        await run_io(
+            "pipeline",
+            compress_file,
+            gs_input,
+            gs_output,
+            steps["compress"]["level"],
+            gs_password,
+        )
+        if "lock" in steps:
+            await run_cpu(
+                "pipeline",
+                lock_file,
+                gs_output,
+                output_path,
+                steps["lock"]["password"],
+            )
+    finally:
+        for staged in (gs_input, gs_output):
+            if staged not in (path, output_path) and os.path.exists(staged):
+                os.remove(staged)
+    return output_path
+
+
+@app.post("/pipeline")
+@limiter.limit(DEFAULT_LIMIT)
+async def pipeline_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    form: UploadForm = Depends(upload_form),
+):
+    # Runs "steps", a JSON list such as [{"op": "delete", "pages": "2-3"},
+    # {"op": "rotate", "angle": 90}, {"op": "compress", "level": "recommended"},
+    # {"op": "lock", "password": "..."}], on one uploaded file. A bad step is
+    # reported as 422 with its index in the list.
+    saved_paths = form.paths()
+    try:
+        file = form.files("file")[0]
+        try:
+            steps = json.loads(form.require("steps"))
+        except json.JSONDecodeError:
+            steps = None
+        if not isinstance(steps, list) or not steps:
+            raise HTTPException(
+                status_code=422, detail="Steps must be a non-empty JSON list."
+            )
+        plan = plan_pipeline(steps)
+        # Charged as its most expensive step.
+        ops = [step["op"] for step in plan]
+        charged = max(
+            plan,
+            key=lambda step: OPERATION_WEIGHTS.get(step["op"], 1)
+            * LEVEL_WEIGHTS.get(step.get("level"), 1),
+        )
+        await admit(request, charged["op"], form, level=charged.get("level"))
+
+        try:
+            passwords_dict = json.loads(form.get("passwords", "{}"))
+        except:
+            passwords_dict = {}
+        password = passwords_dict.get(file["name"], form.get("password"))
+        if "compress" in ops:
+            await run_io("pipeline", spill_uploads, [file])
+            compute = lambda: run_pipeline_compressed(
+                file["path"],
+                password,
+                plan,
+                form.workspace.output_dir,
+                file["name"],
+            )
+        else:
+            compute = lambda: run_cpu(
+                "pipeline",
+                run_pipeline,
+                item_source(file),
+                password,
+                plan,
+                output_dir_for([file], form),
+                file["name"],
+            )
+        if "lock" in ops:
+            # Locked output is never cached, like /lock-pdf's.
+            output, cached = await compute(), False
+        else:
+            key = cache_key("pipeline", [dict(file, password=password)], steps=plan)
+            output, cached = await cached_result(key, compute)
+        background_tasks.add_task(
+            cleanup_files, output_cleanup(saved_paths, output, cached)
+        )
+        return result_response(
+            output, f"processed_{file['name']}", "application/pdf", request
+        )
+    except Exception as e:
+        return handle_pdf_error(e, saved_paths)
+
+
+def lookup_thumbnails(item: Dict, pages: List[int], size: int):
+    # Returns (page_count, {page: key}, pages still to render); page_count is
+    # None until the document has been rendered once.
+    path = thumbnail_cache.get(cache_key("page_count", [item]))
+    page_count = None
+    if path:
+        with open(path) as f:
+            page_count = int(f.read())
+        pages = [n for n in pages if n <= page_count]
+    keys = {n: cache_key("thumbnail", [item], page=n, size=size) for n in pages}
+    missing = [n for n, key in keys.items() if thumbnail_cache.get(key) is None]
+    return page_count, keys, missing
+
+
+def store_thumbnails(item: Dict, keys: Dict[int, str], rendered: Dict):
+    count = str(rendered["page_count"]).encode()
+    thumbnail_cache.put_data(cache_key("page_count", [item]), "pages.txt", count, False)
+    for page, data in rendered["images"].items():
+        thumbnail_cache.put_data(keys[page], f"page_{page}.jpg", data, False)
+    thumbnail_cache.evict()
+
+
+async def document_thumbnails(item: Dict, pages: List[int], size: int) -> Dict:
+    entry = {"name": item["name"], "sha256": item["sha256"]}
+    try:
+        page_count, keys, missing = await run_io(
+            "thumbnails", lookup_thumbnails, item, pages, size
+        )
+        if missing or page_count is None:
+            if "path" not in item:
+                return dict(
+                    entry,
+                    ok=False,
+                    error_type="not_cached",
+                    error="Document is not cached, upload it again.",
+                )
+            rendered = await run_cpu(
+                "thumbnails",
+                render_thumbnails,
+                item_source(item),
+                item.get("password"),
+                missing,
+                size,
+                item["name"],
+            )
+            await run_io("thumbnails", store_thumbnails, item, keys, rendered)
+            page_count = rendered["page_count"]
+    except Exception as e:
+        error_type = "locked" if "PASSWORD" in str(e) else "invalid"
+        return dict(entry, ok=False, error_type=error_type, error=str(e))
+
+    thumbnails = [
+        {"page": page, "url": f"/thumbnails/{key}", "etag": f'"{key}"'}
+        for page, key in keys.items()
+        if page <= page_count
+    ]
+    return dict(entry, ok=True, page_count=page_count, thumbnails=thumbnails)
+
+
+@app.post("/thumbnails")
+@limiter.limit(DEFAULT_LIMIT)
+async def thumbnails_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    form: UploadForm = Depends(upload_form),
+):
+    # Renders a range of pages for each uploaded file ("file"/"files"). Files
+    # rendered before can be named by their content hash in "sha256" (comma
+    # separated) instead of being uploaded again. The images themselves are
+    # fetched from the returned urls.
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+    except:
+        passwords_dict = {}
+    try:
+        size = int(form.get("size", 200))
+    except ValueError:
+        size = 200
+    size = min(max(size, 16), THUMBNAIL_MAX_SIZE)
+    try:
+        pages = parse_page_range(
+            form.get("pages") or THUMBNAIL_DEFAULT_PAGES, THUMBNAIL_MAX_PAGES
+        )
+    except ValueError as e:
+        cleanup_files(form.paths())
+        raise HTTPException(status_code=422, detail=str(e))
+
+    items = [u for u in form.uploads if u["field"] in ("file", "files")]
+    # Only the requested pages are rendered, whatever the document's length.
+    await admit(request, "thumbnails", form, len(pages) * max(1, len(items)))
+    for sha in (form.get("sha256") or "").split(","):
+        sha = sha.strip().lower()
+        if THUMBNAIL_KEY.fullmatch(sha):
+            items.append({"name": sha, "sha256": sha})
+    for item in items:
+        item["password"] = passwords_dict.get(item["name"], form.get("password"))
+
+    documents = await asyncio.gather(
+        *(document_thumbnails(item, pages, size) for item in items)
+    )
+    background_tasks.add_task(cleanup_files, form.paths())
+    return {"size": size, "documents": documents}
+
+
+@app.get("/thumbnails/{key}")
+async def thumbnail_image(request: Request, key: str):
+    if not THUMBNAIL_KEY.fullmatch(key):
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Keys are content hashes, so a thumbnail never changes.
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400, immutable"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    path = await run_io("cache", thumbnail_cache.get, key)
+    # The cache also holds page counts and inspect results; only the
+    # thumbnails themselves (page_<n>.jpg) are served here.
+    if not path or not path.endswith(".jpg"):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+
+def lookup_inspections(items: List[Dict]) -> Dict[str, Dict]:
+    found = {}
+    for item in items:
+        path = thumbnail_cache.get(cache_key("inspect", [{"sha256": item["sha256"]}]))
+        if path:
+            with open(path) as f:
+                found[item["sha256"]] = json.load(f)
+    return found
+
+
+def store_inspections(inspected: Dict[str, Dict]):
+    for sha, info in inspected.items():
+        data = json.dumps(info).encode()
+        key = cache_key("inspect", [{"sha256": sha}])
+        thumbnail_cache.put_data(key, "inspect.json", data, False)
+    thumbnail_cache.evict()
+
+
+@app.post("/inspect")
+@limiter.limit(DEFAULT_LIMIT)
+async def inspect_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    form: UploadForm = Depends(upload_form),
+):
+    # Page count, version, encryption, linearization and a compressibility
+    # estimate for every uploaded file ("file"/"files"), read from the header,
+    # trailer and cross-reference table only. One call covers what
+    # /validate-pdf and /check-password do per file when files are dropped.
+    await admit(request, "inspect", form, 0)
+    items = [u for u in form.uploads if u["field"] in ("file", "files")]
+    background_tasks.add_task(cleanup_files, form.paths())
+
+    inspected = await run_io("inspect", lookup_inspections, items)
+    errors = {}
+    # Each distinct document is probed once, even if uploaded twice.
+    pending = list({item["sha256"]: item for item in items}.values())
+    pending = [item for item in pending if item["sha256"] not in inspected]
+    probed = {}
+    async for item, info, error in run_batch(
+        "inspect", get_pdf_info, pending, lambda item: (item_source(item),)
+    ):
+        if error is None:
+            probed[item["sha256"]] = info
+        else:
+            errors[item["sha256"]] = error
+    if probed:
+        await run_io("inspect", store_inspections, probed)
+        inspected.update(probed)
+
+    results = []
+    for item in items:
+        entry = {"name": item["name"], "sha256": item["sha256"]}
+        if item["sha256"] in inspected:
+            results.append(dict(entry, ok=True, **inspected[item["sha256"]]))
+            continue
+        error = str(errors[item["sha256"]])
+        results.append(dict(entry, ok=False, error_type="invalid", error=error))
+    return {"files": results}
+
+
+async def run_merge_job(params: Dict) -> Dict:
+    passwords = params.get("passwords") or [None] * len(params["items"])
+    items = [
+        dict(item, password=password)
+        for item, password in zip(params["items"], passwords)
+    ]
+    path = await cached_job_result(
+        params,
+        lambda: run_cpu(
+            "merge",
+            merge_pdfs,
+            items,
+            "merged.pdf",
+            params["output_dir"],
+            params.get("linearize", False),
+        ),
+    )
+    return {"path": path, "filename": "merged.pdf", "media_type": "application/pdf"}
+
+
+async def run_compress_job(params: Dict) -> Dict:
+    path = await cached_job_result(
+        params,
+        lambda: run_compress(
+            params["path"],
+            params["level"],
+            params.get("password"),
+            params["rotation"],
+            params["output_dir"],
+            params.get("sharded", False),
+            params.get("linearize", False),
+            params.get("engine", "ghostscript"),
+        ),
+    )
+    return {
+        "path": path,
+        "filename": f"compressed_{params['level']}_{params['filename']}",
+        "media_type": "application/pdf",
+    }
+
+
+JOB_HANDLERS = {"merge": run_merge_job, "compress": run_compress_job}
+
+
+@app.post("/jobs/merge", status_code=202)
+@limiter.limit(DEFAULT_LIMIT)
+async def submit_merge_job(
+    request: Request, form: UploadForm = Depends(admitted_form("merge"))
 ):
-    saved_path = None
+    saved_paths_list = form.paths()
+    output_dir = form.workspace.output_dir
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
+    except:
+        passwords_dict = {}
+        rotations_dict = {}
+
     try:
-        rotations_dict = json.loads(rotations)
-        rotation = int(rotations_dict.get(file.filename, 0))
+        merge_items = []
+        for item in form.files("files"):
+            item["password"] = passwords_dict.get(item["name"])
+            item["rotation"] = int(rotations_dict.get(item["name"], 0))
+            merge_items.append(item)
+        await check_files_lock(merge_items)
+        # Job parameters are stored as JSON, so uploads have to be on disk.
+        await run_io("upload", spill_uploads, merge_items)
 
+        linearize = wants_linearized(form)
+        key = cache_key(
+            "merge",
+            merge_items,
+            rotations=[i["rotation"] for i in merge_items],
+            linearize=linearize,
+        )
+        # Passwords stay out of the stored params (see JobStore).
+        passwords = [item.pop("password") for item in merge_items]
+        job = await run_io(
+            "jobs",
+            job_store.create,
+            "merge",
+            {
+                "items": merge_items,
+                "output_dir": output_dir,
+                "linearize": linearize,
+                "cache_key": key,
+            },
+            saved_paths_list,
+            {"passwords": passwords} if any(passwords) else None,
+        )
+        form.workspace.keep()
+        return job_status(job)
+    except Exception as e:
+        return handle_pdf_error(e, saved_paths_list)
+
+
+@app.post("/jobs/compress", status_code=202)
+@limiter.limit(DEFAULT_LIMIT)
+async def submit_compress_job(
+    request: Request, form: UploadForm = Depends(admitted_form("compress"))
+):
+    saved_paths = form.paths()
+    output_dir = form.workspace.output_dir
+    level = form.get("level", "recommended")
+
+    try:
+        file = form.files("file")[0]
+    except HTTPException as e:
+        return handle_pdf_error(e, saved_paths)
+
+    try:
+        passwords_dict = json.loads(form.get("passwords", "{}"))
+        rotations_dict = json.loads(form.get("rotations", "{}"))
+        password = passwords_dict.get(file["name"])
+        rotation = int(rotations_dict.get(file["name"], 0))
     except:
+        password = None
         rotation = 0
 
     try:
-        await validate_file(file)
-        saved_path = save_file_to_temp(file)
-        output_path = unlock_pdf(saved_path, password, rotation)
-        background_tasks.add_task(cleanup_files, [saved_path, output_path])
-        return FileResponse(
-            path=output_path,
-            filename=f"unlocked_{file.filename}",
-            media_type="application/pdf",
+        await check_files_lock([dict(file, password=password)])
+        await run_io("upload", spill_uploads, [file])
+        sharded = form.get("sharded", "false").lower() == "true"
+        linearize = wants_linearized(form)
+        engine = compress_engine(form)
+        key = cache_key(
+            "compress",
+            [dict(file, password=password)],
+            level=level,
+            rotation=rotation,
+            sharded=sharded,
+            linearize=linearize,
+            engine=engine,
+        )
+        job = await run_io(
+            "jobs",
+            job_store.create,
+            "compress",
+            {
+                "path": file["path"],
+                "filename": file["name"],
+                "level": level,
+                "rotation": rotation,
+                "sharded": sharded,
+                "linearize": linearize,
+                "engine": engine,
+                "output_dir": output_dir,
+                "cache_key": key,
+            },
+            saved_paths,
+            {"password": password} if password else None,
         )
+        form.workspace.keep()
+        return job_status(job)
     except Exception as e:
-        return handle_pdf_error(e, [saved_path] if saved_path else [])
+        return handle_pdf_error(e, saved_paths)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    if result_cache is None:
+        return {"enabled": False}
+    return dict(await run_io("cache", result_cache.stats), enabled=True)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    gauges = {"worker_queue_depth": queue_depth()}
+    executable = find_ghostscript()
+    pool = get_pool(executable) if executable else None
+    if pool is not None:
+        gauges["ghostscript_pool_crashes"] = pool.crashes
+        gauges["ghostscript_pool_timeouts"] = pool.timeouts
+    if result_cache is not None:
+        gauges["result_cache_hits"] = result_cache.hits
+        gauges["result_cache_misses"] = result_cache.misses
+        gauges["result_cache_evictions"] = result_cache.evictions
+    gauges["thumbnail_cache_hits"] = thumbnail_cache.hits
+    gauges["thumbnail_cache_misses"] = thumbnail_cache.misses
+    gauges["thumbnail_cache_evictions"] = thumbnail_cache.evictions
+    gauges["document_store_evictions"] = document_store.evictions
+    workspaces = temp_store.stats()
+    gauges["workspaces_active"] = workspaces["active"]
+    gauges["workspace_bytes"] = workspaces["bytes"]
+    gauges["workspaces_reclaimed"] = workspaces["reclaimed"]
+    return PlainTextResponse(
+        metrics.REGISTRY.render(gauges), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/debug/profiler")
+async def profiler_output():
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(metrics.profiler.collapsed())
+
+
+@app.post("/debug/profiler")
+async def toggle_profiler(enabled: bool = Form(...), interval: float = Form(0.01)):
+    # Collapsed stacks from GET can be fed to flamegraph.pl or speedscope.
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if enabled:
+        metrics.profiler.start(max(interval, PROFILER_MIN_INTERVAL))
+    else:
+        await run_io("profiler", metrics.profiler.stop)
+    return metrics.profiler.status()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await run_io("jobs", job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+
+@app.api_route("/jobs/{job_id}/result", methods=["GET", "HEAD"])
+async def download_job_result(request: Request, job_id: str):
+    job = await run_io("jobs", job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["state"] != DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['state']}")
+
+    # The result stays until the job expires (JOB_TTL) rather than going with
+    # the first download, so an interrupted one can resume with a Range request.
+    result = job["result"]
+    return result_response(
+        result["path"], result["filename"], result["media_type"], request
+    )
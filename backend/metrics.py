@@ -0,0 +1,324 @@
+import os
+import sys
+import time
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+# The operation a pool task belongs to, and the stage timings of the request
+# being served (used for the Server-Timing header).
+current_operation = contextvars.ContextVar("current_operation", default="unknown")
+request_stages: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = (
+    contextvars.ContextVar("request_stages", default=None)
+)
+
+
+def _key(name: str, labels: Dict[str, str]) -> Tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    # Plain dicts throughout so samples taken in a worker process can be
+    # pickled back and merged into the server's registry.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple, float] = {}
+        self.histograms: Dict[Tuple, List[float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            # One slot per bucket, then sum and count.
+            data = self.histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def drain(self) -> Dict:
+        with self._lock:
+            samples = {"counters": self.counters, "histograms": self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return samples
+
+    def merge(self, samples: Dict):
+        with self._lock:
+            for key, value in samples["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in samples["histograms"].items():
+                data = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    data[i] += value
+
+    def render(self, gauges: Dict[str, float] = None) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value:g}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), data in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, data):
+                    bucket = labels + (("le", f"{bound:g}"),)
+                    lines.append(f"{name}_bucket{_labels(bucket)} {count:g}")
+                bucket = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_labels(bucket)} {data[-1]:g}")
+                lines.append(f"{name}_sum{_labels(labels)} {data[-2]:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {data[-1]:g}")
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+REGISTRY = Registry()
+
+
+def inc(name: str, value: float = 1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+def add_pages(count: int):
+    inc("pdf_pages_total", count, operation=current_operation.get())
+
+
+def record_stage(name: str, seconds: float, operation: str = None):
+    operation = operation or current_operation.get()
+    REGISTRY.observe("pdf_stage_seconds", seconds, operation=operation, stage=name)
+    stages = request_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+@contextmanager
+def stage(name: str, operation: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, operation)
+
+
+def run_traced(operation: str, func, *args, **kwargs):
+    # Entry point for pool tasks: tags everything recorded with the operation.
+    token = current_operation.set(operation)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        current_operation.reset(token)
+
+
+def run_collected(operation: str, func, *args, **kwargs):
+    # Entry point for process-pool tasks. Samples recorded in the worker are
+    # shipped back with the result so the server can merge them.
+    stages: List[Tuple[str, float]] = []
+    token = request_stages.set(stages)
+    try:
+        result = run_traced(operation, func, *args, **kwargs)
+        error = None
+    except Exception as e:
+        result = None
+        error = e
+    finally:
+        request_stages.reset(token)
+    return result, error, REGISTRY.drain(), stages
+
+
+def merge_collected(samples: Dict, stages: List[Tuple[str, float]]):
+    REGISTRY.merge(samples)
+    current = request_stages.get()
+    if current is not None:
+        current.extend(stages)
+
+
+def server_timing(stages: List[Tuple[str, float]]) -> str:
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages if name
+    )
+
+
+class SamplingProfiler:
+    # Samples the stacks of every thread in this process at a fixed interval
+    # and aggregates them in collapsed-stack form (flamegraph.pl/speedscope).
+    # Work running in the process pool is not sampled.
+    def __init__(self):
+        self.interval = 0.01
+        self.samples: Counter = Counter()
+        self.started_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.01):
+        if self.running:
+            return
+        self.interval = interval
+        self.samples = Counter()
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack = ";".join(reversed(names))
+                self.samples[stack] += 1
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
+
+    def status(self) -> Dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "started_at": self.started_at,
+            "samples": sum(self.samples.values()),
+        }
+
+
+profiler = SamplingProfiler()
+
+
+def route_path(scope) -> str:
+    # Labels by route template so ids in the URL don't create new series.
+    for route in getattr(scope.get("app"), "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    # Request latency, bytes in/out and response streaming time per route, plus
+    # the optional Server-Timing header with the stages of this request.
+    def __init__(self, app, timing_header: bool = False):
+        self.app = app
+        self.timing_header = timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        path = route_path(scope)
+        stages: List[Tuple[str, float]] = []
+        token = request_stages.set(stages)
+        operation_token = current_operation.set(path)
+        start = time.perf_counter()
+        status = {"code": 500, "response_start": None}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                inc(
+                    "http_request_bytes_total", len(message.get("body", b"")), path=path
+                )
+            return message
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                status["response_start"] = time.perf_counter()
+                if self.timing_header:
+                    stages.append(("handler", status["response_start"] - start))
+                    header = server_timing(stages).encode()
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", header)
+                    ]
+            elif message["type"] == "http.response.body":
+                inc(
+                    "http_response_bytes_total",
+                    len(message.get("body", b"")),
+                    path=path,
+                )
+                if not message.get("more_body") and status["response_start"]:
+                    record_stage(
+                        "response", time.perf_counter() - status["response_start"]
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, timed_send)
+        finally:
+            request_stages.reset(token)
+            current_operation.reset(operation_token)
+            observe(
+                "http_request_seconds",
+                time.perf_counter() - start,
+                path=path,
+                status=status["code"],
+            )
@@ -1,303 +1,1636 @@
 import os
+import io
+import re
+import json
+import mmap
+import bisect
+import math
+import time
+import hashlib
+import tempfile
 import subprocess
 import zipfile
 import fitz
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pypdf import PdfReader, PdfWriter
-from typing import List, Dict, Optional, Any
+from pypdf.errors import PdfReadError
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+from gs_pool import run_ghostscript, find_ghostscript
+from pdf_writer import StreamingPdfWriter, page_closure
+import metrics
+from key_cache import get_key_cache, encryption_identity, read_file_key, apply_file_key
+from typing import List, Dict, Optional, Any, Iterator, Tuple, BinaryIO, Union, Callable
 
 DIR_OUTPUT = "output_files"
-
-
-def get_pdf_info(file_path: str):
-    if not os.path.exists(file_path):
-        return {"valid": False, "error": "File not found"}
-    try:
-        with fitz.open(file_path) as doc:
-            is_encrypted = doc.is_encrypted
-            page_count = len(doc)
-        return {"valid": True, "pages": page_count, "encrypted": is_encrypted}
-    except Exception as e:
-        return {"valid": False, "error": str(e)}
+COMPRESSION_SETTINGS = {
+    "extreme": "/screen",
+    "recommended": "/ebook",
+    "less": "/printer",
+}
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+SHARD_PAGES = 100
+ZIP_CHUNK_SIZE = 256 * 1024
+MMAP_MIN_SIZE = 1024 * 1024
+BATCH_ERRORS_NAME = "errors.json"
+THUMBNAIL_QUALITY = 75
+# Streams looked at when estimating compressibility, spread over the file.
+INSPECT_SAMPLE_OBJECTS = 2000
+# Rough share of a stream's bytes that compression wins back, by kind.
+SAVINGS_UNFILTERED = 0.6
+SAVINGS_JPEG_IMAGE = 0.5
+SAVINGS_OTHER_IMAGE = 0.3
+SAVINGS_OTHER = 0.05
+ENCRYPTION_NAMES = {"/AESV3": "AES-256", "/AESV2": "AES-128"}
+PIPELINE_OPS = ("delete", "rotate", "compress", "lock")
+COMPRESS_ENGINES = ("ghostscript", "native", "auto")
+# Resolution (dpi) and JPEG quality the native engine targets per level,
+# close to what the matching Ghostscript presets use.
+IMAGE_SETTINGS = {
+    "extreme": (72, 50),
+    "recommended": (150, 75),
+    "less": (300, 85),
+}
+# Share of the file in image streams from which auto picks the native engine.
+NATIVE_IMAGE_RATIO = 0.5
+# Smaller images are left alone, and a new encoding has to save this much.
+IMAGE_MIN_BYTES = 16 * 1024
+IMAGE_MIN_SAVING = 0.1
+
+# A source is a path, or the bytes of a small upload that was kept in memory.
+# A result is a path, or (filename, bytes) when no output_dir was given.
+Source = Union[str, bytes]
+Result = Union[str, Tuple[str, bytes]]
+
+
+def render_thumbnails(
+    source: Source,
+    password: Optional[str],
+    pages: List[int],
+    size: int,
+    filename: str = None,
+) -> Dict[str, Any]:
+    # Renders only the requested (1-based) pages, as JPEGs whose longer side is
+    # size pixels. Pages past the end of the document are left out.
+    filename = filename or source_name(source)
+    with metrics.stage("open"):
+        if isinstance(source, bytes):
+            doc = fitz.open(stream=source, filetype="pdf")
+        else:
+            doc = fitz.open(source)
+    with doc:
+        if doc.needs_pass:
+            if not password:
+                raise ValueError(f"PASSWORD_REQUIRED:{filename}")
+            if not doc.authenticate(password):
+                raise ValueError(f"INVALID_PASSWORD:{filename}")
+        images = {}
+        with metrics.stage("render"):
+            for number in pages:
+                if not 1 <= number <= doc.page_count:
+                    continue
+                page = doc[number - 1]
+                zoom = size / max(page.rect.width, page.rect.height, 1)
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                images[number] = pixmap.tobytes("jpeg", jpg_quality=THUMBNAIL_QUALITY)
+        metrics.add_pages(len(images))
+        return {"page_count": doc.page_count, "images": images}
+
+
+def _xref_value(doc, xref: int, key: str) -> str:
+    kind, value = doc.xref_get_key(xref, key)
+    if kind == "xref":
+        return doc.xref_object(int(value.split()[0]), compressed=True).strip()
+    return "" if kind == "null" else value
+
+
+def _encryption_name(doc) -> Optional[str]:
+    kind, value = doc.xref_get_key(-1, "Encrypt")
+    if kind == "null":
+        return None
+    # Usually an object of its own, but writers like MuPDF put it inline in
+    # the trailer.
+    if kind == "xref":
+        xref, prefix = int(value.split()[0]), ""
+    else:
+        xref, prefix = -1, "Encrypt/"
+    handler = _xref_value(doc, xref, prefix + "Filter")
+    if handler and handler != "/Standard":
+        return handler[1:]
+    method = _xref_value(doc, xref, prefix + "CF/StdCF/CFM")
+    if method in ENCRYPTION_NAMES:
+        return ENCRYPTION_NAMES[method]
+    if _xref_value(doc, xref, prefix + "V") == "5":
+        return "AES-256"
+    length = _xref_value(doc, xref, prefix + "Length") or "40"
+    return f"RC4-{length}"
+
+
+def _estimated_savings(doc, size: int) -> float:
+    # Guesses the share of the file compression would save from the stream
+    # dictionaries alone; no stream is decoded.
+    count = doc.xref_length() - 1
+    step = max(1, count // INSPECT_SAMPLE_OBJECTS)
+    saved = 0.0
+    for xref in range(1, count + 1, step):
+        if not doc.xref_is_stream(xref):
+            continue
+        try:
+            length = int(_xref_value(doc, xref, "Length") or 0)
+        except ValueError:
+            continue
+        filters = _xref_value(doc, xref, "Filter")
+        image = _xref_value(doc, xref, "Subtype") == "/Image"
+        if not filters:
+            saved += length * SAVINGS_UNFILTERED
+        elif image and ("DCTDecode" in filters or "JPXDecode" in filters):
+            saved += length * SAVINGS_JPEG_IMAGE
+        elif image:
+            saved += length * SAVINGS_OTHER_IMAGE
+        else:
+            saved += length * SAVINGS_OTHER
+    return round(min(0.95, saved * step / size), 3) if size else 0.0
+
+
+def get_pdf_info(source: Source) -> Dict[str, Any]:
+    # Header, trailer, cross-reference table and page tree only; works on
+    # encrypted files without the password.
+    if isinstance(source, bytes):
+        head, size = source[:1024], len(source)
+    else:
+        with open(source, "rb") as f:
+            head = f.read(1024)
+        size = os.path.getsize(source)
+    match = re.match(rb"%PDF-(\d\.\d)", head)
+    if not match:
+        raise ValueError("Not a PDF file.")
+
+    with metrics.stage("open"):
+        if isinstance(source, bytes):
+            doc = fitz.open(stream=source, filetype="pdf")
+        else:
+            doc = fitz.open(source)
+    with doc:
+        version = match.group(1).decode()
+        # The catalog may declare a later version than the header.
+        catalog_version = doc.xref_get_key(doc.pdf_catalog(), "Version")[1]
+        if re.fullmatch(r"/\d\.\d", catalog_version):
+            version = max(version, catalog_version[1:])
+        encryption = _encryption_name(doc)
+        return {
+            "pages": doc.page_count,
+            "version": version,
+            "encrypted": encryption is not None,
+            "encryption": encryption,
+            "needs_password": bool(doc.needs_pass),
+            "linearized": bool(doc.is_fast_webaccess),
+            "size": size,
+            "estimated_savings": _estimated_savings(doc, size),
+        }
 
 
 def save_file_to_temp(upload_file, temp_folder="temp_uploads"):
     os.makedirs(temp_folder, exist_ok=True)
-    file_location = os.path.join(temp_folder, upload_file.filename)
+    # A directory of its own so same-named uploads don't overwrite each other.
+    folder = tempfile.mkdtemp(dir=temp_folder)
+    file_location = os.path.join(folder, os.path.basename(upload_file.filename))
     with open(file_location, "wb") as buffer:
         shutil.copyfileobj(upload_file.file, buffer)
     return file_location
 
 
-def parse_page_range(text: str) -> List[int]:
-    pages = set()
-    if not text:
-        return []
-    parts = text.split(",")
-    for part in parts:
+def page_spans(text: str) -> List[Tuple[int, int]]:
+    # The (first, last) pairs of a page list like "1-3,7", not expanded.
+    spans = []
+    for part in (text or "").split(","):
         part = part.strip()
-        if "-" in part:
-            try:
+        try:
+            if "-" in part:
                 start_str, end_str = part.split("-")
-                start, end = int(start_str), int(end_str)
-                pages.update(range(start, end + 1))
-            except ValueError:
-                continue
-        else:
-            try:
-                pages.add(int(part))
-            except ValueError:
-                continue
-    return sorted(list(pages))
+                span = (int(start_str), int(end_str))
+            else:
+                span = (int(part), int(part))
+        except ValueError:
+            continue
+        if span[0] <= span[1]:
+            spans.append(span)
+    return spans
+
+
+def parse_page_range(text: str, limit: int = None, page_count: int = None) -> List[int]:
+    # Sorted 1-based page numbers, never past page_count when given. With a
+    # limit it gives up (ValueError) as soon as more pages than that are
+    # named, so "1-99999999" costs nothing either way.
+    pages = set()
+    for first, last in page_spans(text):
+        if page_count is not None:
+            last = min(last, page_count)
+        for number in range(max(first, 1), last + 1):
+            pages.add(number)
+            if limit is not None and len(pages) > limit:
+                raise ValueError(f"At most {limit} pages per request.")
+    return sorted(pages)
+
+
+def is_locked(source: Source, password: Optional[str]) -> bool:
+    reader = PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if not reader.is_encrypted:
+        return False
+    if not password:
+        return True
+    try:
+        unlock_if_encrypted(reader, password, "")
+    except ValueError:
+        return True
+    return False
 
 
 def unlock_if_encrypted(reader: PdfReader, password: Optional[str], filename: str):
     if reader.is_encrypted:
+        keys = get_key_cache()
+        # Without an identity (pypdf internals changed) the cache is skipped.
+        identity = encryption_identity(reader)
+        file_key = keys.get(identity, password) if identity else None
+        if file_key is not None and apply_file_key(reader, file_key):
+            return
         if not password:
             if not reader.decrypt(""):
                 raise ValueError(f"PASSWORD_REQUIRED:{filename}")
         else:
             if not reader.decrypt(password):
                 raise ValueError(f"INVALID_PASSWORD:{filename}")
+        file_key = read_file_key(reader)
+        if identity and file_key is not None:
+            keys.put(identity, password, file_key)
 
 
-def page_rotate(writer: PdfWriter, page, rotation: int):
-    if rotation != 0:
-        page.rotate(rotation)
-    writer.add_page(page)
+class LockedFilesError(Exception):
+    def __init__(self, filenames: List[str]):
+        super().__init__(filenames)
+        self.filenames = filenames
 
+    def __str__(self):
+        return f"PASSWORD_REQUIRED:{', '.join(self.filenames)}"
 
-def merge_pdfs(items: List[Dict[str, Any]], output_filename="merged.pdf") -> str:
-    writer = PdfWriter()
 
-    for item in items:
-        path = item["path"]
-        password = item.get("password")
-        rotation = item.get("rotation", 0)
+class PipelineStepError(Exception):
+    def __init__(self, step: int, op: str, message: str):
+        super().__init__(step, op, message)
+        self.step = step
+        self.op = op
+        self.message = message
 
+    def __str__(self):
+        return f"Step {self.step + 1} ({self.op}): {self.message}"
+
+
+def count_pages(sources: List[Source]) -> int:
+    # Only the cross-reference table and page tree are read, and the page tree
+    # is readable without the password. Unreadable files count as no pages.
+    total = 0
+    for source in sources:
         try:
-            reader = PdfReader(path)
-            unlock_if_encrypted(reader, password, os.path.basename(path))
+            if isinstance(source, bytes):
+                doc = fitz.open(stream=source, filetype="pdf")
+            else:
+                doc = fitz.open(source)
+            with doc:
+                total += doc.page_count
+        except Exception:
+            pass
+    return total
+
+
+def source_name(source: Source, default: str = "document.pdf") -> str:
+    return os.path.basename(source) if isinstance(source, str) else default
+
+
+def read_source(source: Source):
+    if isinstance(source, bytes):
+        # BytesIO shares the bytes object until something writes to it.
+        return io.BytesIO(source)
+    if os.path.getsize(source) >= MMAP_MIN_SIZE:
+        # Pages are read from the page cache instead of a private copy.
+        with open(source, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return source
+
+
+def create_output(output_dir: Optional[str], filename: str) -> BinaryIO:
+    if output_dir is None:
+        buffer = io.BytesIO()
+        buffer.name = filename
+        return buffer
+    os.makedirs(output_dir, exist_ok=True)
+    return open(os.path.join(output_dir, filename), "w+b")
+
+
+def copy_output(source: Source, output_dir: Optional[str], filename: str) -> BinaryIO:
+    if output_dir is None or isinstance(source, bytes):
+        f = create_output(output_dir, filename)
+        if isinstance(source, bytes):
+            f.write(source)
+        else:
+            with open(source, "rb") as src:
+                shutil.copyfileobj(src, f)
+        return f
+    output_path = os.path.join(output_dir, filename)
+    os.makedirs(output_dir, exist_ok=True)
+    shutil.copyfile(source, output_path)
+    return open(output_path, "r+b")
 
-            for page in reader.pages:
-                page_rotate(writer, page, rotation)
 
-        except Exception as e:
-            print(f"Error merging {path}: {e}")
-            raise e
+def discard_output(f: BinaryIO):
+    f.close()
+    if not isinstance(f, io.BytesIO):
+        os.remove(f.name)
 
-    os.makedirs(DIR_OUTPUT, exist_ok=True)
-    output_path = os.path.join(DIR_OUTPUT, output_filename)
 
-    with open(output_path, "wb") as f:
-        writer.write(f)
+def finish_output(f: BinaryIO) -> Result:
+    if isinstance(f, io.BytesIO):
+        return f.name, f.getvalue()
+    f.close()
+    return f.name
+
+
+def find_qpdf() -> Optional[str]:
+    return shutil.which("qpdf")
 
-    return output_path
+
+def linearize_pdf(input_path: str, output_path: str):
+    executable = find_qpdf()
+    if not executable:
+        raise EnvironmentError("qpdf not found.")
+    timeout = float(os.getenv("QPDF_TIMEOUT", 120))
+    try:
+        result = subprocess.run(
+            [executable, "--linearize", input_path, output_path],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        metrics.inc("linearize_total", result="timeout")
+        raise RuntimeError(f"Linearization timed out after {timeout}s")
+    # qpdf exits with 3 when the file was written but had warnings.
+    if result.returncode not in (0, 3):
+        raise RuntimeError(f"Linearization failed: {result.stderr.strip()}")
+
+
+def linearize_output(result: Result) -> Result:
+    # Rewrites a finished result with page 1 and the hint tables up front
+    # ("fast web view"), so viewers can show it before the rest arrives.
+    # Without qpdf the result is sent as it is.
+    if not find_qpdf():
+        metrics.inc("linearize_total", result="unavailable")
+        return result
+    with metrics.stage("linearize"):
+        if isinstance(result, str):
+            linear_path = result + ".linear"
+            try:
+                linearize_pdf(result, linear_path)
+                os.replace(linear_path, result)
+            finally:
+                if os.path.exists(linear_path):
+                    os.remove(linear_path)
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                input_path = os.path.join(tmp, "input.pdf")
+                linear_path = os.path.join(tmp, "linear.pdf")
+                with open(input_path, "wb") as f:
+                    f.write(result[1])
+                linearize_pdf(input_path, linear_path)
+                with open(linear_path, "rb") as f:
+                    result = result[0], f.read()
+    metrics.inc("linearize_total", result="ok")
+    return result
+
+
+def open_pdf(source, password: Optional[str] = None, filename: str = None):
+    if isinstance(source, PdfReader):
+        return source
+    with metrics.stage("open"):
+        reader = PdfReader(read_source(source))
+    if reader.is_encrypted:
+        with metrics.stage("decrypt"):
+            unlock_if_encrypted(reader, password, filename or source_name(source))
+    return reader
+
+
+def item_source(item: Dict[str, Any]):
+    if item.get("reader") is not None:
+        return item["reader"]
+    return item["data"] if item.get("data") is not None else item["path"]
+
+
+def open_pdfs(items: List[Dict[str, Any]]) -> List[PdfReader]:
+    readers = []
+    locked = []
+    for item in items:
+        name = item.get("name") or os.path.basename(item["path"])
+        try:
+            readers.append(open_pdf(item_source(item), item.get("password"), name))
+        except ValueError as e:
+            if "PASSWORD_REQUIRED" in str(e) or "INVALID_PASSWORD" in str(e):
+                locked.append(name)
+            else:
+                raise
+    if locked:
+        raise LockedFilesError(locked)
+    return readers
+
+
+def find_locked_files(items: List[Dict[str, Any]]) -> List[str]:
+    try:
+        open_pdfs(items)
+    except LockedFilesError as e:
+        return e.filenames
+    return []
+
+
+def page_rotate(writer: PdfWriter, page, rotation: int):
+    if rotation != 0:
+        page.rotate(rotation)
+    writer.add_page(page)
+
+
+def merge_pdfs(
+    items: List[Dict[str, Any]],
+    output_filename="merged.pdf",
+    output_dir: Optional[str] = DIR_OUTPUT,
+    linearize: bool = False,
+) -> Result:
+    # Sources are opened one at a time and their pages go straight to the
+    # output, so memory stays flat however many files are merged.
+    f = create_output(output_dir, output_filename)
+    writer = StreamingPdfWriter(f)
+    locked = []
+    try:
+        for item in items:
+            name = item.get("name") or os.path.basename(item["path"])
+            try:
+                reader = open_pdf(item_source(item), item.get("password"), name)
+            except ValueError as e:
+                if "PASSWORD_REQUIRED" in str(e) or "INVALID_PASSWORD" in str(e):
+                    locked.append(name)
+                    continue
+                raise
+            # Keep going only to name every locked file.
+            if locked:
+                continue
+
+            try:
+                with metrics.stage("write"):
+                    writer.add_document(reader, item.get("rotation", 0))
+            except Exception as e:
+                print(f"Error merging {name}: {e}")
+                raise e
+            metrics.add_pages(len(reader.pages))
+
+        if locked:
+            raise LockedFilesError(locked)
+        writer.close()
+    except Exception:
+        discard_output(f)
+        raise
+    metrics.inc("merge_streams_deduplicated_total", writer.deduplicated)
+
+    result = finish_output(f)
+    return linearize_output(result) if linearize else result
 
 
 def delete_pages(
-    file_path: str, page_ranges: str, password: str = None, rotation: int = 0
-) -> str:
-    reader = PdfReader(file_path)
-    unlock_if_encrypted(reader, password, os.path.basename(file_path))
+    file_path: Source,
+    page_ranges: str,
+    password: str = None,
+    rotation: int = 0,
+    incremental: bool = False,
+    output_dir: Optional[str] = DIR_OUTPUT,
+) -> Result:
+    reader = open_pdf(file_path, password)
+    pages_to_remove = parse_page_range(page_ranges, page_count=len(reader.pages))
+    indices_to_remove = {page - 1 for page in pages_to_remove}
+
+    output_filename = f"deleted_{source_name(file_path)}"
+
+    if incremental and can_update_incrementally(reader):
+        with metrics.stage("write"):
+            f = delete_pages_in_place(
+                reader,
+                file_path,
+                output_dir,
+                output_filename,
+                indices_to_remove,
+                rotation,
+            )
+        metrics.add_pages(len(indices_to_remove))
+        return finish_output(f)
+
     writer = PdfWriter()
-    pages_to_remove = parse_page_range(page_ranges)
-    indices_to_remove = [page - 1 for page in pages_to_remove]
     for i in range(len(reader.pages)):
         if i not in indices_to_remove:
             page_rotate(writer, reader.pages[i], rotation)
 
+    if len(writer.pages) == 0:
         raise ValueError("Cannot delete all pages from the PDF")
 
-    output_filename = f"deleted_{os.path.basename(file_path)}"
-    os.makedirs(DIR_OUTPUT, exist_ok=True)
-    output_path = os.path.join(DIR_OUTPUT, output_filename)
-    with open(output_path, "wb") as f:
+    f = create_output(output_dir, output_filename)
+    with metrics.stage("write"):
         writer.write(f)
-    return output_path
+    metrics.add_pages(len(writer.pages))
+    return finish_output(f)
 
 
-def split_pdf(
-    file_path: str, page_ranges: str, password: str = None, rotation: int = 0
-) -> str:
-    ranges_list = [r.strip() for r in page_ranges.split(",")]
-    output_ranges = []
-    reader = PdfReader(file_path)
-    unlock_if_encrypted(reader, password, os.path.basename(file_path))
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    os.makedirs(DIR_OUTPUT, exist_ok=True)
-    for i, r in enumerate(ranges_list):
-        pages_in_range = parse_page_range(r)
-        pages = [p - 1 for p in pages_in_range]
-        writer = PdfWriter()
-        flag = False
+def parse_split_range(text: str, page_count: int) -> Optional[range]:
+    # "N", "a-b", "a-" (to the end), "-b" (from the start), each optionally
+    # followed by ":step". Returns 0-based indices as a range, so explode
+    # style splits of huge documents never build page lists.
+    body, _, step = text.strip().partition(":")
+    try:
+        step = int(step) if step else 1
+        if "-" in body:
+            start, end = body.split("-")
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else page_count
+        else:
+            start = end = int(body)
+    except ValueError:
+        return None
+    if step < 1:
+        return None
+    pages = range(max(start, 1) - 1, min(end, page_count), step)
+    return pages if len(pages) else None
+
+
+def split_page_groups(page_ranges: str, page_count: int) -> List[Tuple[int, range]]:
+    groups = []
+    for i, r in enumerate(page_ranges.split(",")):
+        pages = parse_split_range(r, page_count)
+        if pages is not None:
+            groups.append((i, pages))
+    return groups
+
+
+def object_sizes(reader: PdfReader) -> Dict[int, int]:
+    # Bytes each object takes in the file, from the gaps between offsets in
+    # the cross-reference table. Objects packed in an object stream get an
+    # equal share of that stream.
+    offsets = sorted(
+        (offset, idnum)
+        for generation in reader.xref.values()
+        for idnum, offset in generation.items()
+        if offset > 0
+    )
+    reader.stream.seek(0, os.SEEK_END)
+    ends = [offset for offset, _ in offsets[1:]] + [reader.stream.tell()]
+    sizes = {idnum: end - offset for (offset, idnum), end in zip(offsets, ends)}
+    packed: Dict[int, List[int]] = {}
+    for idnum, (stream_num, _) in reader.xref_objStm.items():
+        packed.setdefault(stream_num, []).append(idnum)
+    for stream_num, members in packed.items():
+        share = sizes.get(stream_num, 0) // len(members)
+        for idnum in members:
+            sizes[idnum] = share
+    return sizes
+
+
+def size_groups(reader: PdfReader, max_bytes: int) -> List[range]:
+    # Consecutive pages packed into parts of about max_bytes. A page costs
+    # what it needs that the part doesn't already have, so shared fonts and
+    # images are only counted once per part. Nothing is written to find out.
+    sizes = object_sizes(reader)
+    page_ids = {
+        page.indirect_reference.idnum
+        for page in reader.pages
+        if page.indirect_reference is not None
+    }
+    groups = []
+    start, total, seen = 0, 0, set()
+    for i, page in enumerate(reader.pages):
+        needed = page_closure(page, page_ids)
+        own = (
+            sizes.get(page.indirect_reference.idnum, 0)
+            if page.indirect_reference
+            else 0
+        )
+        cost = own + sum(sizes.get(n, 0) for n in needed - seen)
+        if i > start and total + cost > max_bytes:
+            groups.append(range(start, i))
+            start, total, seen = i, 0, set()
+            cost = own + sum(sizes.get(n, 0) for n in needed)
+        total += cost
+        seen |= needed
+    groups.append(range(start, len(reader.pages)))
+    return groups
+
+
+def bookmark_groups(reader: PdfReader, level: int = 1) -> List[Tuple[str, range]]:
+    # A part per outline entry at the given depth, up to the next one's page.
+    # Pages before the first entry form a part of their own.
+    starts: Dict[int, str] = {}
+
+    def walk(items, depth):
+        for item in items:
+            if isinstance(item, list):
+                if depth < level:
+                    walk(item, depth + 1)
+            elif depth == level:
+                try:
+                    page = reader.get_destination_page_number(item)
+                except Exception:
+                    continue
+                if page is not None and page >= 0:
+                    starts.setdefault(page, item.title or "")
+
+    walk(reader.outline, 1)
+    if not starts:
+        raise ValueError("The document has no bookmarks to split by.")
+    if 0 not in starts:
+        starts[0] = ""
+    bounds = sorted(starts) + [len(reader.pages)]
+    return [(starts[a], range(a, b)) for a, b in zip(bounds, bounds[1:])]
+
+
+def part_title(title: str) -> str:
+    title = re.sub(r"[^\w\- ]+", "", title).strip().replace(" ", "_")
+    return title[:60]
+
+
+def plan_split_parts(
+    source: Source,
+    password: Optional[str],
+    mode: str,
+    value: Any,
+    base_name: str,
+) -> List[Tuple[str, range]]:
+    # (filename, pages) for every part. For "ranges" value is the range text,
+    # for "every" pages per part, for "bookmarks" the outline depth and for
+    # "size" the largest part in bytes.
+    reader = open_pdf(source, password)
+    page_count = len(reader.pages)
+    if mode == "ranges":
+        groups = [(i, pages, "") for i, pages in split_page_groups(value, page_count)]
+    elif mode == "every":
+        groups = [
+            (i, range(start, min(start + value, page_count)), "")
+            for i, start in enumerate(range(0, page_count, value))
+        ]
+    elif mode == "bookmarks":
+        groups = [
+            (i, pages, part_title(title))
+            for i, (title, pages) in enumerate(bookmark_groups(reader, value))
+        ]
+    elif mode == "size":
+        groups = [(i, pages, "") for i, pages in enumerate(size_groups(reader, value))]
+    else:
+        raise ValueError(f"Unknown split mode: {mode}")
+    if not groups:
+        raise ValueError("No valid pages found for the specified ranges.")
+    return [
+        (f"{base_name}_part{i+1}{'_' + title if title else ''}.pdf", pages)
+        for i, pages, title in groups
+    ]
 
-        for p in pages:
-            if 0 <= p < len(reader.pages):
-                page_rotate(writer, reader.pages[p], rotation)
-                flag = True
 
-        if flag:
-            range_name = f"{base_name}_part{i+1}.pdf"
-            range_name_path = os.path.join(DIR_OUTPUT, range_name)
+def balanced_batches(
+    items: List, workers: int, weight: Callable[[Any], int]
+) -> List[List]:
+    # Consecutive items grouped into at most workers batches of about the same
+    # total weight, e.g. split parts by page count so each worker reads one
+    # stretch of the file.
+    total = sum(weight(item) for item in items)
+    batches, current, count = [], [], 0
+    for item in items:
+        current.append(item)
+        count += weight(item)
+        if len(batches) < workers - 1 and count * workers >= total * (len(batches) + 1):
+            batches.append(current)
+            current = []
+    if current:
+        batches.append(current)
+    return batches
+
+
+def write_split_parts(
+    source: Source,
+    password: Optional[str],
+    parts: List[Tuple[str, range]],
+    rotation: int = 0,
+    output_dir: Optional[str] = DIR_OUTPUT,
+) -> List[Result]:
+    # Each part gets exactly the objects its pages use; see add_pages.
+    reader = open_pdf(source, password)
+    results = []
+    for name, pages in parts:
+        f = create_output(output_dir, name)
+        try:
+            writer = StreamingPdfWriter(f)
+            with metrics.stage("write"):
+                writer.add_pages(reader, pages, rotation, prune_resources=True)
+                writer.close()
+        except Exception:
+            discard_output(f)
+            raise
+        metrics.add_pages(len(pages))
+        results.append(finish_output(f))
+    return results
+
+
+def write_pages(reader: PdfReader, indices: List[int], rotation: int, target):
+    writer = PdfWriter()
+    for p in indices:
+        page_rotate(writer, reader.pages[p], rotation)
+    with metrics.stage("write"):
+        writer.write(target)
+    metrics.add_pages(len(indices))
 
-            with open(range_name_path, "wb") as f:
-                writer.write(f)
-            output_ranges.append(range_name_path)
 
-    if not output_ranges:
-        raise ValueError("No valid pages found for the specified ranges.")
+def write_locked(reader: PdfReader, rotation: int, new_password: str, target):
+    writer = PdfWriter()
+    for page in reader.pages:
+        page_rotate(writer, page, rotation)
+    with metrics.stage("encrypt"):
+        writer.encrypt(user_password=new_password, algorithm="AES-256")
+        writer.write(target)
+    metrics.add_pages(len(writer.pages))
 
-    if len(output_ranges) == 1:
-        return output_ranges[0]
 
-    zip_filename = f"{base_name}_splits.zip"
-    zip_path = os.path.join(DIR_OUTPUT, zip_filename)
+def iter_locked_parts(
+    items: List[Dict[str, Any]], readers: List[PdfReader], new_password: str
+) -> Iterator[Tuple[str, BinaryIO]]:
+    for item, reader in zip(items, readers):
+        name = item.get("name") or os.path.basename(item["path"])
+        try:
+            buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            write_locked(reader, item.get("rotation", 0), new_password, buffer)
+            buffer.seek(0)
+        except Exception as e:
+            print(f"Error locking {item['path']}: {e}")
+            raise e
+        yield f"locked_{name}", buffer
+
+
+def iter_batch_parts(
+    results: Iterator[Tuple[Dict[str, Any], Result, Optional[Exception]]],
+) -> Iterator[Tuple[str, BinaryIO]]:
+    # Archive entries in the order the files finish. A file that failed is
+    # listed in errors.json at the end instead of failing the whole archive.
+    # An item may also produce a list of results, as split batches do.
+    errors = []
+    for item, result, error in results:
+        if error is not None:
+            print(f"Error processing {item['name']}: {error}")
+            errors.append({"name": item["name"], "error": str(error)})
+            continue
+        for output in result if isinstance(result, list) else [result]:
+            if isinstance(output, str):
+                yield os.path.basename(output), open(output, "rb")
+                os.remove(output)
+            else:
+                yield output[0], io.BytesIO(output[1])
+    if errors:
+        report = json.dumps(errors, indent=2).encode()
+        yield BATCH_ERRORS_NAME, io.BytesIO(report)
+
+
+class _ZipSink(io.RawIOBase):
+    # Write-only target for ZipFile; the bytes are handed out by stream_zip.
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _copy_to_zip(zipf: zipfile.ZipFile, name: str, data: BinaryIO, sink=None):
+    # PDF streams are already compressed, so entries are stored, not deflated.
+    with zipf.open(zipfile.ZipInfo(name, time.localtime()[:6]), "w") as entry:
+        while chunk := data.read(ZIP_CHUNK_SIZE):
+            entry.write(chunk)
+            if sink is not None:
+                yield sink.pop()
+    data.close()
+
+
+def write_zip(parts: Iterator[Tuple[str, BinaryIO]], target):
+    with zipfile.ZipFile(target, "w", zipfile.ZIP_STORED) as zipf:
+        for name, data in parts:
+            for _ in _copy_to_zip(zipf, name, data):
+                pass
+    return target
+
+
+def stream_zip(parts: Iterator[Tuple[str, BinaryIO]]) -> Iterator[bytes]:
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zipf:
+        for name, data in parts:
+            for chunk in _copy_to_zip(zipf, name, data, sink):
+                if chunk:
+                    yield chunk
+    yield sink.pop()
 
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for file in output_ranges:
-            zipf.write(file, os.path.basename(file))
-            os.remove(file)
 
-    return zip_path
+def split_pdf(
+    file_path,
+    page_ranges: str,
+    password: str = None,
+    rotation: int = 0,
+    output_dir: Optional[str] = DIR_OUTPUT,
+    base_name: str = None,
+) -> Result:
+    base_name = base_name or os.path.splitext(source_name(file_path))[0]
+    parts = plan_split_parts(file_path, password, "ranges", page_ranges, base_name)
+    results = write_split_parts(file_path, password, parts, rotation, output_dir)
+    if len(results) == 1:
+        return results[0]
+
+    f = create_output(output_dir, f"{base_name}_splits.zip")
+    write_zip(iter_batch_parts([({"name": base_name}, results, None)]), f)
+    return finish_output(f)
+
+
+def _last_startxref(f: BinaryIO) -> int:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 1024))
+    tail = f.read()
+    position = tail.rfind(b"startxref")
+    if position < 0:
+        raise ValueError("startxref not found")
+    return int(tail[position + len(b"startxref") :].split()[0])
+
+
+def _append_update(f: BinaryIO, reader: PdfReader, objects: Dict[int, Tuple]):
+    # Appends an incremental update with the given (generation, object) pairs,
+    # chained to the previous cross-reference section. The new section uses the
+    # same form, table or stream, as the one it follows.
+    previous_xref = _last_startxref(f)
+    f.seek(previous_xref)
+    classic = f.read(4) == b"xref"
+
+    f.seek(0, os.SEEK_END)
+    f.write(b"\n")
+    offsets = []
+    for idnum in sorted(objects):
+        generation, obj = objects[idnum]
+        offsets.append((idnum, generation, f.tell()))
+        f.write(f"{idnum} {generation} obj\n".encode())
+        obj.write_to_stream(f)
+        f.write(b"\nendobj\n")
+
+    trailer = DictionaryObject(
+        {
+            NameObject("/Size"): NumberObject(reader.trailer["/Size"]),
+            NameObject("/Root"): reader.trailer.raw_get("/Root"),
+            NameObject("/Prev"): NumberObject(previous_xref),
+        }
+    )
+    for key in ("/Info", "/ID"):
+        if key in reader.trailer:
+            trailer[NameObject(key)] = reader.trailer.raw_get(key)
+
+    xref_offset = f.tell()
+    if classic:
+        f.write(b"xref\n0 1\n0000000000 65535 f\r\n")
+        for idnum, generation, offset in offsets:
+            f.write(f"{idnum} 1\n{offset:010d} {generation:05d} n\r\n".encode())
+        f.write(b"trailer\n")
+        trailer.write_to_stream(f)
+    else:
+        xref_id = int(reader.trailer["/Size"])
+        offsets.append((xref_id, 0, xref_offset))
+        xref = StreamObject()
+        xref.update(trailer)
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/Size")] = NumberObject(xref_id + 1)
+        xref[NameObject("/W")] = ArrayObject([NumberObject(n) for n in (1, 4, 2)])
+        xref[NameObject("/Index")] = ArrayObject(
+            [NumberObject(n) for idnum, _, _ in offsets for n in (idnum, 1)]
+        )
+        xref.set_data(
+            b"".join(
+                b"\x01" + offset.to_bytes(4, "big") + generation.to_bytes(2, "big")
+                for _, generation, offset in offsets
+            )
+        )
+        f.write(f"{xref_id} 0 obj\n".encode())
+        xref.write_to_stream(f)
+        f.write(b"\nendobj")
+    f.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+
+def _rotated_pages(reader: PdfReader, rotation: int, skip=()) -> Dict[int, Tuple]:
+    pages = {}
+    for i, page in enumerate(reader.pages):
+        if i in skip:
+            continue
+        ref = page.indirect_reference
+        page[NameObject("/Rotate")] = NumberObject((page.rotation + rotation) % 360)
+        pages[ref.idnum] = (ref.generation, page)
+    return pages
+
+
+def _prune_page_tree(ref, remove: List[int], start: int, changed: Dict) -> int:
+    # Walks the page tree by /Count, so only branches holding removed pages are
+    # resolved and page objects themselves are never loaded. `remove` is sorted.
+    node = ref.get_object()
+    kids = ArrayObject()
+    position = start
+    count = 0
+    for kid_ref in node["/Kids"]:
+        # A page counts once; a /Pages node can hold any number, even none.
+        kid = kid_ref.get_object()
+        is_node = "/Kids" in kid
+        total = int(kid.get("/Count", 0)) if is_node else 1
+        i = bisect.bisect_left(remove, position)
+        if i == len(remove) or remove[i] >= position + total:
+            kept = total
+        elif not is_node:
+            kept = 0
+        else:
+            kept = _prune_page_tree(kid_ref, remove, position, changed)
+        position += total
+        if kept:
+            kids.append(kid_ref)
+            count += kept
+    if count != int(node["/Count"]):
+        node[NameObject("/Kids")] = kids
+        node[NameObject("/Count")] = NumberObject(count)
+        changed[ref.idnum] = (ref.generation, node)
+    return count
+
+
+def _xref_intact(reader: PdfReader) -> bool:
+    # pypdf quietly repairs a broken xref table, but an appended update still
+    # chains to the original one. Re-read it strictly and check that every
+    # offset lands on its own object.
+    stream = reader.stream
+    try:
+        strict = PdfReader(stream, strict=True)
+        for generation, offsets in strict.xref.items():
+            for idnum, offset in offsets.items():
+                stream.seek(offset)
+                if strict.read_object_header(stream) != (idnum, generation):
+                    return False
+    except (PdfReadError, ValueError):
+        return False
+    return True
+
+
+def can_update_incrementally(reader: PdfReader) -> bool:
+    pages_ref = reader.trailer["/Root"].raw_get("/Pages")
+    return (
+        not reader.is_encrypted
+        and isinstance(pages_ref, IndirectObject)
+        and _xref_intact(reader)
+    )
+
+
+def rotate_pages_in_place(file_path: str, rotation: int):
+    # Rewrites only the page dictionaries with their new /Rotate, instead of
+    # re-serializing the whole document.
+    reader = PdfReader(file_path)
+    with open(file_path, "r+b") as f:
+        _append_update(f, reader, _rotated_pages(reader, rotation))
+
+
+def delete_pages_in_place(
+    reader: PdfReader,
+    file_path: Source,
+    output_dir: Optional[str],
+    output_filename: str,
+    indices_to_remove: set,
+    rotation: int = 0,
+) -> BinaryIO:
+    # Prunes deleted pages from the page tree in an appended update. The old
+    # page objects stay in the file body, unreferenced.
+    changed = {}
+    if rotation != 0:
+        changed.update(_rotated_pages(reader, rotation, skip=indices_to_remove))
+    pages_ref = reader.trailer["/Root"].raw_get("/Pages")
+    if not _prune_page_tree(pages_ref, sorted(indices_to_remove), 0, changed):
+        raise ValueError("Cannot delete all pages from the PDF")
+    f = copy_output(file_path, output_dir, output_filename)
+    _append_update(f, reader, changed)
+    return f
 
 
 def compress_pdf(
-    file_path: str, level: str = "recommended", password: str = None, rotation: int = 0
+    file_path: str,
+    level: str = "recommended",
+    password: str = None,
+    rotation: int = 0,
+    output_dir: str = DIR_OUTPUT,
+    linearize: bool = False,
 ) -> str:
 
-    source_path = file_path
-    temp_rotated_path = None
-
     try:
-        reader = PdfReader(file_path)
-        unlock_if_encrypted(reader, password, os.path.basename(file_path))
-        if rotation != 0:
-            writer = PdfWriter()
-            for page in reader.pages:
-                page_rotate(writer, page, rotation)
-
-            temp_rotated_path = f"{file_path}_rotated.pdf"
-            with open(temp_rotated_path, "wb") as f:
-                writer.write(f)
-
-            source_path = temp_rotated_path
-            password = None
+        reader = open_pdf(file_path, password)
+        # Ghostscript decrypts on its own, so no decrypted copy is written.
+        password = password if reader.is_encrypted else None
 
     except ValueError as e:
         raise e
 
     except Exception as e:
-        if temp_rotated_path and os.path.exists(temp_rotated_path):
-            os.remove(temp_rotated_path)
         raise RuntimeError(f"Pre-processing failed: {e}")
 
-    compression_settings = {
-        "extreme": "/screen",
-        "recommended": "/ebook",
-        "less": "/printer",
-    }
-    ghostscript_setting = compression_settings.get(level, "/ebook")
-    ghostscript = shutil.which("gswin64c") or shutil.which("gs")
-
-    if not ghostscript:
-        if temp_rotated_path and os.path.exists(temp_rotated_path):
-            os.remove(temp_rotated_path)
-        raise EnvironmentError("Ghostscript not found.")
-
+    ghostscript_setting = COMPRESSION_SETTINGS.get(level, "/ebook")
     output_filename = f"compressed_{level}_{os.path.basename(file_path)}"
-    os.makedirs(DIR_OUTPUT, exist_ok=True)
-    output_path = os.path.join(DIR_OUTPUT, output_filename)
-
-    command = [
-        ghostscript,
-        "-sDEVICE=pdfwrite",
-        "-dCompatibilityLevel=1.4",
-        f"-dPDFSETTINGS={ghostscript_setting}",
-        "-dNOPAUSE",
-        "-dQUIET",
-        "-dBATCH",
-        f"-sOutputFile={output_path}",
-    ]
-    if password:
-        command.append(f"-sPDFPassword={password}")
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, output_filename)
 
-    command.append(source_path)
     try:
-        subprocess.run(command, check=True)
+        with metrics.stage("ghostscript"):
+            run_ghostscript(file_path, output_path, ghostscript_setting, password)
+        if rotation != 0:
+            with metrics.stage("rotate"):
+                rotate_pages_in_place(output_path, rotation)
 
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"PDF compression failed: {e}")
 
-    finally:
-        if temp_rotated_path and os.path.exists(temp_rotated_path):
-            os.remove(temp_rotated_path)
-
-    return output_path
-
+    return linearize_output(output_path) if linearize else output_path
 
-def lock_pdfs(items: List[Dict[str, Any]], new_password: str) -> str:
-    output_files = []
-    os.makedirs(DIR_OUTPUT, exist_ok=True)
 
-    for item in items:
-
-        path = item["path"]
-        old_password = item.get("password")
-        rotation = item.get("rotation", 0)
-
-        try:
-            reader = PdfReader(path)
-            unlock_if_encrypted(reader, old_password, os.path.basename(path))
-            writer = PdfWriter()
+def compress_file(
+    input_path: str, output_path: str, level: str, password: Optional[str] = None
+) -> str:
+    # Uses this process's Ghostscript pool, so the server calls it on a thread.
+    try:
+        with metrics.stage("ghostscript"):
+            run_ghostscript(
+                input_path,
+                output_path,
+                COMPRESSION_SETTINGS.get(level, "/ebook"),
+                password,
+            )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"PDF compression failed: {e}")
+    return output_path
 
-            for page in reader.pages:
-                page_rotate(writer, page, rotation)
 
-            writer.encrypt(user_password=new_password, algorithm="AES-256")
+def open_fitz(source: Source, password: Optional[str]):
+    filename = source_name(source)
+    if isinstance(source, bytes):
+        doc = fitz.open(stream=source, filetype="pdf")
+    else:
+        doc = fitz.open(source)
+    if doc.needs_pass:
+        if not password:
+            doc.close()
+            raise ValueError(f"PASSWORD_REQUIRED:{filename}")
+        if not doc.authenticate(password):
+            doc.close()
+            raise ValueError(f"INVALID_PASSWORD:{filename}")
+    return doc
+
+
+def image_byte_ratio(source: Source, password: Optional[str]) -> float:
+    # Share of the file taken by image streams, from a sample of stream
+    # dictionaries; nothing is decoded.
+    with open_fitz(source, password) as doc:
+        count = doc.xref_length() - 1
+        step = max(1, count // INSPECT_SAMPLE_OBJECTS)
+        images = 0
+        for xref in range(1, count + 1, step):
+            if doc.xref_is_image(xref):
+                try:
+                    images += int(_xref_value(doc, xref, "Length") or 0)
+                except ValueError:
+                    continue
+        size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    return min(1.0, images * step / size) if size else 0.0
+
+
+def pick_compress_engine(source: Source, password: Optional[str], engine: str) -> str:
+    # auto takes the native engine where it does best, on image heavy files,
+    # and whenever Ghostscript is not installed.
+    if engine != "auto":
+        return engine
+    if not find_ghostscript():
+        return "native"
+    if image_byte_ratio(source, password) >= NATIVE_IMAGE_RATIO:
+        return "native"
+    return "ghostscript"
+
+
+def _image_key(doc, xref: int) -> Optional[str]:
+    # Identifies an image by its bytes and everything else that affects how it
+    # looks. Images the native engine can't re-encode faithfully (stencil and
+    # color key masks, decode arrays, 1 bit images) get None.
+    for key in ("ImageMask", "Mask", "Decode"):
+        if doc.xref_get_key(xref, key)[0] != "null":
+            return None
+    if _xref_value(doc, xref, "BitsPerComponent") == "1":
+        return None
+    raw = doc.xref_stream_raw(xref)
+    if raw is None or len(raw) < IMAGE_MIN_BYTES:
+        return None
+    digest = hashlib.sha256(raw)
+    kind, smask = doc.xref_get_key(xref, "SMask")
+    if kind == "xref":
+        digest.update(doc.xref_stream_raw(int(smask.split()[0])) or b"")
+    for key in ("Filter", "DecodeParms", "ColorSpace", "Width", "Height"):
+        digest.update(_xref_value(doc, xref, key).encode())
+    return digest.hexdigest()
+
+
+def plan_image_recompression(
+    source: Source, password: Optional[str], level: str
+) -> List[Dict[str, Any]]:
+    # One entry per distinct image worth re-encoding, with every xref holding
+    # it and the size it needs at the level's resolution where it is drawn
+    # largest.
+    dpi = IMAGE_SETTINGS.get(level, IMAGE_SETTINGS["recommended"])[0]
+    images: Dict[str, Dict[str, Any]] = {}
+    keys: Dict[int, Optional[str]] = {}
+    with open_fitz(source, password) as doc:
+        with metrics.stage("scan"):
+            for page in doc:
+                # MuPDF only ties placements to xrefs by decoding every image,
+                # so they are matched by pixel size instead; images of the
+                # same size on a page get the largest scale among them.
+                placements: Dict[Tuple[int, int], float] = {}
+                try:
+                    for info in page.get_image_info():
+                        a, b, c, d = info["transform"][:4]
+                        size = (info["width"], info["height"])
+                        scale = max(
+                            math.hypot(a, b) * dpi / 72 / max(1, size[0]),
+                            math.hypot(c, d) * dpi / 72 / max(1, size[1]),
+                        )
+                        placements[size] = max(placements.get(size, 0.0), scale)
+                    page_images = page.get_images(full=True)
+                except Exception as e:
+                    print(f"Skipping images of page {page.number + 1}: {e}")
+                    continue
+                for xref, _, width, height, *_ in page_images:
+                    if (width, height) not in placements:
+                        continue
+                    if xref not in keys:
+                        keys[xref] = _image_key(doc, xref)
+                    if keys[xref] is None:
+                        continue
+                    image = images.setdefault(
+                        keys[xref],
+                        {
+                            "xrefs": set(),
+                            "size": len(doc.xref_stream_raw(xref)),
+                            "scale": 0.0,
+                        },
+                    )
+                    image["xrefs"].add(xref)
+                    image["scale"] = min(
+                        1.0, max(image["scale"], placements[(width, height)])
+                    )
+    for image in images.values():
+        image["xrefs"] = sorted(image["xrefs"])
+    return list(images.values())
+
+
+def recompress_images(
+    source: Source,
+    password: Optional[str],
+    images: List[Dict[str, Any]],
+    level: str,
+) -> List[Tuple[List[int], bytes, int, int, int]]:
+    # Runs in a worker. Decodes, resamples and JPEG-encodes each image in
+    # MuPDF; returns (xrefs, data, width, height, components) for those that
+    # came out smaller.
+    quality = IMAGE_SETTINGS.get(level, IMAGE_SETTINGS["recommended"])[1]
+    results = []
+    with open_fitz(source, password) as doc:
+        for image in images:
+            try:
+                pixmap = fitz.Pixmap(doc, image["xrefs"][0])
+                if pixmap.alpha:
+                    pixmap = fitz.Pixmap(pixmap, 0)
+                if pixmap.colorspace is None:
+                    continue
+                if pixmap.colorspace.n not in (1, 3):
+                    pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+                width = max(1, round(pixmap.width * image["scale"]))
+                height = max(1, round(pixmap.height * image["scale"]))
+                if (width, height) != (pixmap.width, pixmap.height):
+                    pixmap = fitz.Pixmap(pixmap, width, height, None)
+                data = pixmap.tobytes("jpeg", jpg_quality=quality)
+            except Exception as e:
+                print(f"Skipping image {image['xrefs'][0]}: {e}")
+                continue
+            if len(data) <= image["size"] * (1 - IMAGE_MIN_SAVING):
+                results.append((image["xrefs"], data, width, height, pixmap.n))
+    return results
+
+
+def write_recompressed(
+    file_path: str,
+    password: Optional[str],
+    images: List[Tuple[List[int], bytes, int, int, int]],
+    level: str = "recommended",
+    rotation: int = 0,
+    output_dir: str = DIR_OUTPUT,
+    linearize: bool = False,
+) -> str:
+    # Swaps the re-encoded images in. Text and vector content are not touched;
+    # garbage collection on save merges the copies of an image left identical.
+    output_filename = f"compressed_{level}_{os.path.basename(file_path)}"
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, output_filename)
+    with open_fitz(file_path, password) as doc:
+        for xrefs, data, width, height, components in images:
+            colorspace = "/DeviceGray" if components == 1 else "/DeviceRGB"
+            for xref in xrefs:
+                doc.update_stream(xref, data, compress=False)
+                doc.xref_set_key(xref, "Filter", "/DCTDecode")
+                doc.xref_set_key(xref, "DecodeParms", "null")
+                doc.xref_set_key(xref, "Width", str(width))
+                doc.xref_set_key(xref, "Height", str(height))
+                doc.xref_set_key(xref, "ColorSpace", colorspace)
+                doc.xref_set_key(xref, "BitsPerComponent", "8")
+        if rotation:
+            for page in doc:
+                page.set_rotation((page.rotation + rotation) % 360)
+        with metrics.stage("write"):
+            doc.save(output_path, garbage=4, deflate=True)
+        metrics.add_pages(doc.page_count)
+    return linearize_output(output_path) if linearize else output_path
+
+
+def compress_pdf_native(
+    file_path: str,
+    level: str = "recommended",
+    password: str = None,
+    rotation: int = 0,
+    output_dir: str = DIR_OUTPUT,
+    linearize: bool = False,
+) -> str:
+    # The native engine in one process, for callers without a worker pool.
+    images = plan_image_recompression(file_path, password, level)
+    with metrics.stage("images"):
+        encoded = recompress_images(file_path, password, images, level)
+    return write_recompressed(
+        file_path, password, encoded, level, rotation, output_dir, linearize
+    )
+
+
+def write_shards(
+    file_path: str,
+    password: str = None,
+    rotation: int = 0,
+    output_dir: str = DIR_OUTPUT,
+    shard_pages: int = SHARD_PAGES,
+) -> Optional[Tuple[str, List[str]]]:
+    # The page chunks sharded compression hands to Ghostscript, written to a
+    # new directory under output_dir. Returns (directory, shard paths), or
+    # None when the document fits in one shard.
+    reader = open_pdf(file_path, password)
+    page_count = len(reader.pages)
+    if page_count <= shard_pages:
+        return None
+
+    ranges = ",".join(
+        f"{start}-{min(start + shard_pages - 1, page_count)}"
+        for start in range(1, page_count + 1, shard_pages)
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    shard_dir = tempfile.mkdtemp(prefix=".shards_", dir=output_dir)
+    shard_paths = []
+    try:
+        for i, pages in split_page_groups(ranges, page_count):
+            shard_path = os.path.join(shard_dir, f"shard_{i}.pdf")
+            with open(shard_path, "wb") as f:
+                write_pages(reader, pages, rotation, f)
+            shard_paths.append(shard_path)
+    except BaseException:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        raise
+    return shard_dir, shard_paths
+
+
+def compressed_shard_path(shard_path: str) -> str:
+    return f"{os.path.splitext(shard_path)[0]}_compressed.pdf"
+
+
+def join_shards(
+    file_path: str,
+    password: str,
+    shard_paths: List[str],
+    level: str = "recommended",
+    output_dir: str = DIR_OUTPUT,
+    linearize: bool = False,
+) -> str:
+    reader = open_pdf(file_path, password)
+    writer = PdfWriter()
+    for shard_path in shard_paths:
+        writer.append(shard_path)
+    # Ghostscript encodes an image shared by several shards the same way in
+    # each, so those copies collapse into one here. Fonts don't: every shard
+    # embeds its own subset, holding only the glyphs of its pages.
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    if reader.metadata:
+        writer.add_metadata(reader.metadata)
 
-            filename = f"locked_{os.path.basename(path)}"
-            out_path = os.path.join(DIR_OUTPUT, filename)
+    output_filename = f"compressed_{level}_{os.path.basename(file_path)}"
+    output_path = os.path.join(output_dir, output_filename)
+    with metrics.stage("write"), open(output_path, "wb") as f:
+        writer.write(f)
+    metrics.add_pages(len(reader.pages))
+    return linearize_output(output_path) if linearize else output_path
+
+
+def compress_pdf_sharded(
+    file_path: str,
+    level: str = "recommended",
+    password: str = None,
+    rotation: int = 0,
+    output_dir: str = DIR_OUTPUT,
+    shard_pages: int = SHARD_PAGES,
+    workers: int = None,
+    linearize: bool = False,
+) -> str:
+    # Sharded compression in one process, for callers without a worker pool.
+    shards = write_shards(file_path, password, rotation, output_dir, shard_pages)
+    if shards is None:
+        return compress_pdf(file_path, level, password, rotation, output_dir, linearize)
 
-            with open(out_path, "wb") as f:
-                writer.write(f)
+    shard_dir, shard_paths = shards
+    try:
+        # Each shard runs in its own Ghostscript process, so threads are enough
+        # to keep several cores busy; the gs pool size caps real concurrency.
+        compressed_paths = [compressed_shard_path(path) for path in shard_paths]
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            list(
+                pool.map(
+                    lambda paths: compress_file(*paths, level),
+                    zip(shard_paths, compressed_paths),
+                )
+            )
+        return join_shards(
+            file_path, password, compressed_paths, level, output_dir, linearize
+        )
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
 
-            output_files.append(out_path)
 
-        except Exception as e:
-            print(f"Error locking {path}: {e}")
-            raise e
+def lock_pdfs(
+    items: List[Dict[str, Any]],
+    new_password: str,
+    output_dir: Optional[str] = DIR_OUTPUT,
+) -> Result:
+    readers = open_pdfs(items)
+    parts = iter_locked_parts(items, readers, new_password)
 
-    if not output_files:
+    if not items:
         raise ValueError("Failed to lock any files.")
 
-    if len(output_files) == 1:
-        return output_files[0]
-
-    zip_filename = "locked_files.zip"
-    zip_path = os.path.join(DIR_OUTPUT, zip_filename)
-
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for f in output_files:
-            zipf.write(f, os.path.basename(f))
-            os.remove(f)
-
-    return zip_path
-
-
-def unlock_pdf(file_path: str, password: str = None, rotation: int = 0) -> str:
-    reader = PdfReader(file_path)
-    unlock_if_encrypted(reader, password, os.path.basename(file_path))
+    if len(items) == 1:
+        filename, data = next(parts)
+        f = create_output(output_dir, filename)
+        shutil.copyfileobj(data, f)
+        data.close()
+        return finish_output(f)
+
+    f = create_output(output_dir, "locked_files.zip")
+    write_zip(parts, f)
+    return finish_output(f)
+
+
+def lock_pdf(
+    item: Dict[str, Any],
+    new_password: str,
+    output_dir: Optional[str] = DIR_OUTPUT,
+) -> Result:
+    name = item.get("name") or os.path.basename(item["path"])
+    reader = open_pdf(item_source(item), item.get("password"), name)
+    f = create_output(output_dir, f"locked_{name}")
+    write_locked(reader, item.get("rotation", 0), new_password, f)
+    return finish_output(f)
+
+
+def unlock_pdf(
+    file_path: Source,
+    password: str = None,
+    rotation: int = 0,
+    output_dir: Optional[str] = DIR_OUTPUT,
+    filename: str = None,
+    linearize: bool = False,
+) -> Result:
+    filename = filename or source_name(file_path)
+    reader = open_pdf(file_path, password, filename)
+
+    output_filename = f"unlocked_{filename}"
+
+    # Nothing to decrypt: keep the original bytes and append any rotation.
+    if can_update_incrementally(reader):
+        f = copy_output(file_path, output_dir, output_filename)
+        if rotation != 0:
+            _append_update(f, reader, _rotated_pages(reader, rotation))
+    else:
+        writer = PdfWriter()
+        for page in reader.pages:
+            page_rotate(writer, page, rotation)
+
+        f = create_output(output_dir, output_filename)
+        with metrics.stage("write"):
+            writer.write(f)
+        metrics.add_pages(len(writer.pages))
+
+    result = finish_output(f)
+    return linearize_output(result) if linearize else result
+
+
+def _step_pages(step: Dict[str, Any], index: int) -> List[Tuple[int, int]]:
+    # Kept as spans; they are only expanded once checked against the document.
+    pages = page_spans(str(step.get("pages") or ""))
+    if not pages:
+        raise PipelineStepError(index, step["op"], "No pages given.")
+    return pages
+
+
+def plan_pipeline(steps: List[Any]) -> List[Dict[str, Any]]:
+    # Checks the parameters of every step before anything is read. Page
+    # numbers are checked when the plan runs, against the document as the
+    # steps before have left it.
+    plan = []
+    seen = set()
+    for i, step in enumerate(steps):
+        op = step.get("op") if isinstance(step, dict) else None
+        if op not in PIPELINE_OPS:
+            raise PipelineStepError(
+                i,
+                str(op),
+                f"Unknown operation, expected one of {', '.join(PIPELINE_OPS)}.",
+            )
+        if "lock" in seen:
+            raise PipelineStepError(i, op, "No step can follow lock.")
+        if op == "delete":
+            plan.append({"op": op, "step": i, "pages": _step_pages(step, i)})
+        elif op == "rotate":
+            try:
+                angle = int(step.get("angle", 90))
+            except (TypeError, ValueError):
+                angle = None
+            if angle is None or angle % 90:
+                raise PipelineStepError(i, op, "Angle must be a multiple of 90.")
+            pages = _step_pages(step, i) if step.get("pages") else None
+            plan.append({"op": op, "step": i, "angle": angle % 360, "pages": pages})
+        elif op == "compress":
+            if op in seen:
+                raise PipelineStepError(i, op, "Compression can only run once.")
+            level = step.get("level", "recommended")
+            if level not in COMPRESSION_SETTINGS:
+                levels = ", ".join(COMPRESSION_SETTINGS)
+                raise PipelineStepError(
+                    i, op, f"Unknown level, expected one of {levels}."
+                )
+            plan.append({"op": op, "step": i, "level": level})
+        else:
+            password = step.get("password")
+            if not isinstance(password, str) or not password:
+                raise PipelineStepError(i, op, "A password is required.")
+            plan.append({"op": op, "step": i, "password": password})
+        seen.add(op)
+    return plan
+
+
+def _edit_pages(plan: List[Dict[str, Any]], page_count: int) -> List[Tuple[int, int]]:
+    # Replays deletions and rotations on (source page, rotation) pairs, so all
+    # of them end up in a single write.
+    pages = [(i, 0) for i in range(page_count)]
+    for step in plan:
+        if step["op"] not in ("delete", "rotate") or step.get("pages") is None:
+            selected = None
+        else:
+            for first, last in step["pages"]:
+                missing = first if first < 1 else max(first, len(pages) + 1)
+                if missing <= last:
+                    raise PipelineStepError(
+                        step["step"],
+                        step["op"],
+                        f"Page {missing} does not exist, the document has "
+                        f"{len(pages)} pages at this step.",
+                    )
+            selected = {
+                n - 1 for first, last in step["pages"] for n in range(first, last + 1)
+            }
+        if step["op"] == "delete":
+            if len(selected) == len(pages):
+                raise PipelineStepError(
+                    step["step"], "delete", "Cannot delete all pages from the PDF"
+                )
+            pages = [page for n, page in enumerate(pages) if n not in selected]
+        elif step["op"] == "rotate":
+            pages = [
+                (
+                    (index, (rotation + step["angle"]) % 360)
+                    if selected is None or n in selected
+                    else (index, rotation)
+                )
+                for n, (index, rotation) in enumerate(pages)
+            ]
+    return pages
+
+
+def _write_edited(
+    reader: PdfReader, pages: List[Tuple[int, int]], password: Optional[str], target
+):
     writer = PdfWriter()
-
-    for page in reader.pages:
-        page_rotate(writer, page, rotation)
-
-    output_filename = f"unlocked_{os.path.basename(file_path)}"
-    os.makedirs(DIR_OUTPUT, exist_ok=True)
-
-    output_path = os.path.join(DIR_OUTPUT, output_filename)
+    for index, rotation in pages:
+        page_rotate(writer, reader.pages[index], rotation)
+    if password:
+        with metrics.stage("encrypt"):
+            writer.encrypt(user_password=password, algorithm="AES-256")
+    with metrics.stage("write"):
+        writer.write(target)
+    metrics.add_pages(len(pages))
+
+
+def pipeline_gs_input(
+    source: Source,
+    password: Optional[str],
+    plan: List[Dict[str, Any]],
+    output_dir: str,
+    filename: str = None,
+) -> Tuple[str, Optional[str]]:
+    # The part of a compressing pipeline before Ghostscript: all page edits in
+    # one pass. Returns the file Ghostscript should read and its password.
+    filename = filename or source_name(source)
+    reader = open_pdf(source, password, filename)
+    pages = _edit_pages(plan, len(reader.pages))
+    if isinstance(source, str) and pages == [(i, 0) for i in range(len(pages))]:
+        # Nothing to edit: Ghostscript reads (and decrypts) the source.
+        return source, password if reader.is_encrypted else None
+    os.makedirs(output_dir, exist_ok=True)
+    gs_input = os.path.join(output_dir, f".edited_{filename}")
+    with open(gs_input, "wb") as f:
+        _write_edited(reader, pages, None, f)
+    return gs_input, None
+
+
+def lock_file(input_path: str, output_path: str, password: str) -> str:
     with open(output_path, "wb") as f:
-        writer.write(f)
+        write_locked(PdfReader(input_path), 0, password, f)
+    return output_path
+
 
+def run_pipeline(
+    source: Source,
+    password: Optional[str],
+    plan: List[Dict[str, Any]],
+    output_dir: Optional[str] = DIR_OUTPUT,
+    filename: str = None,
+) -> Result:
+    # The source is read once and the page edits are written in one pass,
+    # wherever they sit in the plan. Ghostscript runs at most once, on the
+    # edited pages, and the lock is applied as the last file is written.
+    # The server runs the compressing stages itself (run_pipeline_compressed).
+    filename = filename or source_name(source)
+    steps = {step["op"]: step for step in plan}
+    lock_password = steps["lock"]["password"] if "lock" in steps else None
+    output_filename = f"processed_{filename}"
+
+    if "compress" not in steps:
+        reader = open_pdf(source, password, filename)
+        pages = _edit_pages(plan, len(reader.pages))
+        f = create_output(output_dir, output_filename)
+        _write_edited(reader, pages, lock_password, f)
+        return finish_output(f)
+
+    output_path = os.path.join(output_dir, output_filename)
+    gs_input, gs_password = pipeline_gs_input(
+        source, password, plan, output_dir, filename
+    )
+    gs_output = output_path
+    if lock_password:
+        gs_output = os.path.join(output_dir, f".compressed_{filename}")
+    try:
+        compress_file(gs_input, gs_output, steps["compress"]["level"], gs_password)
+        if lock_password:
+            lock_file(gs_output, output_path, lock_password)
+    finally:
+        for path in (gs_input, gs_output):
+            if path not in (source, output_path) and os.path.exists(path):
+                os.remove(path)
     return output_path
@@ -0,0 +1,312 @@
+import io
+import re
+import hashlib
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+from pypdf import PdfReader
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    PdfObject,
+    StreamObject,
+)
+
+CATALOG_ID = 1
+PAGES_ID = 2
+# /Parent is replaced by our page tree; article beads (/B) point into the
+# source catalog's threads, which are not copied.
+SKIPPED_PAGE_KEYS = ("/Parent", "/B")
+# Resource categories that content streams refer to by name.
+NAMED_RESOURCES = (
+    "/Font",
+    "/XObject",
+    "/ExtGState",
+    "/ColorSpace",
+    "/Pattern",
+    "/Shading",
+    "/Properties",
+)
+NAME_TOKEN = re.compile(rb"/([^\s/\[\]()<>{}%]*)")
+NAME_ESCAPE = re.compile(rb"#([0-9A-Fa-f]{2})")
+
+
+def used_names(page) -> Optional[Set[str]]:
+    # Every name in the page's content, operator or not, so nothing a page
+    # draws is missed; None when the content can't be decoded.
+    try:
+        contents = page.get_contents()
+        data = contents.get_data() if contents is not None else b""
+    except Exception:
+        return None
+    names = set()
+    for token in set(NAME_TOKEN.findall(data)):
+        token = NAME_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), token)
+        names.add("/" + token.decode("latin-1"))
+    return names
+
+
+def is_used(name: str, names: Set[str]) -> bool:
+    # Non-ASCII names may be spelled differently in the content.
+    return name in names or not name.isascii()
+
+
+def borrows_resources(resources: DictionaryObject, names: Set[str]) -> bool:
+    # A Form XObject or Type3 font without /Resources of its own draws with
+    # the page's, by names that never appear in the page's content.
+    for key, subtype in (("/XObject", "/Form"), ("/Font", "/Type3")):
+        category = resources.get(key)
+        category = category.get_object() if category is not None else None
+        if not isinstance(category, DictionaryObject):
+            continue
+        for name, entry in category.items():
+            entry = entry.get_object()
+            if (
+                is_used(name, names)
+                and isinstance(entry, DictionaryObject)
+                and entry.get("/Subtype") == subtype
+                and "/Resources" not in entry
+            ):
+                return True
+    return False
+
+
+def pruned_resources(page) -> Optional[DictionaryObject]:
+    # The page's resources without the fonts, images etc. its content never
+    # uses. Catalogs often give every page one dictionary listing all of
+    # them, which would otherwise drag all of them into each split part.
+    resources = page.get("/Resources")
+    names = used_names(page) if resources is not None else None
+    if names is None:
+        return None
+    resources = resources.get_object()
+    if borrows_resources(resources, names):
+        return None
+    pruned = DictionaryObject()
+    for key, value in resources.items():
+        category = value.get_object() if key in NAMED_RESOURCES else None
+        if isinstance(category, DictionaryObject):
+            value = DictionaryObject(
+                (NameObject(name), entry)
+                for name, entry in category.items()
+                if is_used(name, names)
+            )
+        pruned[NameObject(key)] = value
+    return pruned
+
+
+def page_closure(page, page_ids: Set[int]) -> Set[int]:
+    # Numbers of the objects a page needs when written on its own, as
+    # add_pages(prune_resources=True) would copy them; other pages excluded.
+    resources = pruned_resources(page)
+    stack = [
+        value
+        for key, value in page.items()
+        if key not in SKIPPED_PAGE_KEYS
+        and not (key == "/Resources" and resources is not None)
+    ]
+    if resources is not None:
+        stack.append(resources)
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.idnum in seen or obj.idnum in page_ids:
+                continue
+            resolved = obj.get_object()
+            if isinstance(resolved, DictionaryObject) and resolved.get("/Type") in (
+                "/Pages",
+                "/Catalog",
+            ):
+                continue
+            seen.add(obj.idnum)
+            obj = resolved
+        if isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+    return seen
+
+
+class StreamingPdfWriter:
+    # Copies the pages of one source after another straight to the output.
+    # Every object is written as soon as it has been copied, so only the
+    # current source and the cross-reference offsets stay in memory. Objects
+    # with the same content (a logo or font shared by several inputs) are
+    # written once and referenced from every page that uses them.
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.offsets: Dict[int, int] = {}
+        self.kids: List[int] = []
+        self.deduplicated = 0
+        self._next_id = PAGES_ID + 1
+        self._shared: Dict[bytes, int] = {}
+        self._ids: Dict[Tuple[int, int], int] = {}
+        self._pending: Set[Tuple[int, int]] = set()
+        self._excluded: Set[Tuple[int, int]] = set()
+        f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _reserve(self) -> int:
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _write(self, obj_id: int, obj: PdfObject):
+        self.offsets[obj_id] = self.f.tell()
+        self.f.write(f"{obj_id} 0 obj\n".encode())
+        obj.write_to_stream(self.f)
+        self.f.write(b"\nendobj\n")
+
+    def add_document(self, reader: PdfReader, rotation: int = 0):
+        self.add_pages(reader, range(len(reader.pages)), rotation)
+
+    def add_pages(
+        self,
+        reader: PdfReader,
+        indices: Iterable[int],
+        rotation: int = 0,
+        prune_resources: bool = False,
+    ):
+        # Copies the given pages of a source. Links to its other pages (link
+        # targets, annotation owners) become null rather than pulling them in.
+        # Object numbers are per source, so the map starts over each time.
+        self._ids = {}
+        self._pending = set()
+        pages = [reader.pages[i] for i in indices]
+        self._excluded = {
+            self._key(page.indirect_reference)
+            for page in reader.pages
+            if page.indirect_reference is not None
+        }
+        # Ids for all pages first, so links between them resolve to the copies.
+        for page in pages:
+            if page.indirect_reference is not None:
+                key = self._key(page.indirect_reference)
+                self._excluded.discard(key)
+                self._ids[key] = self._reserve()
+
+        for page in pages:
+            ref = page.indirect_reference
+            page_id = self._ids[self._key(ref)] if ref is not None else self._reserve()
+            copy = DictionaryObject()
+            for key, value in page.items():
+                if key not in SKIPPED_PAGE_KEYS and key != "/Rotate":
+                    copy[NameObject(key)] = value
+            resources = pruned_resources(page) if prune_resources else None
+            if resources is not None:
+                copy[NameObject("/Resources")] = resources
+            for key, value in copy.items():
+                copy[key] = self._copy(value)
+            copy[NameObject("/Parent")] = IndirectObject(PAGES_ID, 0, None)
+            # page.rotation resolves an indirect /Rotate.
+            turned = (int(page.rotation) + rotation) % 360
+            copy[NameObject("/Rotate")] = NumberObject(turned)
+            self._write(page_id, copy)
+            self.kids.append(page_id)
+        self._ids = {}
+        self._excluded = set()
+
+    @staticmethod
+    def _key(ref: IndirectObject) -> Tuple[int, int]:
+        return ref.idnum, ref.generation
+
+    def _copy(self, obj):
+        if isinstance(obj, IndirectObject):
+            return self._copy_ref(obj)
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for key, value in obj.items():
+                copy[NameObject(key)] = self._copy(value)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(value) for value in obj)
+        return obj
+
+    def _copy_ref(self, ref: IndirectObject) -> PdfObject:
+        key = self._key(ref)
+        if key in self._ids:
+            return IndirectObject(self._ids[key], 0, None)
+        if key in self._excluded:
+            return NullObject()
+        if key in self._pending:
+            # Reached again through a reference cycle; the object is written
+            # under this id once its own copy is done.
+            self._ids[key] = self._reserve()
+            return IndirectObject(self._ids[key], 0, None)
+
+        obj = ref.get_object()
+        if obj is None or isinstance(obj, NullObject):
+            return NullObject()
+        if isinstance(obj, DictionaryObject) and obj.get("/Type") == "/Pages":
+            return IndirectObject(PAGES_ID, 0, None)
+        if isinstance(obj, DictionaryObject) and obj.get("/Type") == "/Catalog":
+            return NullObject()
+
+        # What the object references is copied first, so it already has its
+        # final id and identical objects serialize to identical bytes.
+        self._pending.add(key)
+        if isinstance(obj, StreamObject):
+            copy = StreamObject()
+            for name, value in obj.items():
+                copy[NameObject(name)] = self._copy(value)
+            copy._data = obj._data
+        else:
+            copy = self._copy(obj)
+        self._pending.discard(key)
+
+        body = io.BytesIO()
+        copy.write_to_stream(body)
+        body = body.getvalue()
+        # An annotation belongs to a single page, so it is never shared.
+        shared = not (
+            isinstance(obj, DictionaryObject) and obj.get("/Type") == "/Annot"
+        )
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        if shared and key not in self._ids and digest in self._shared:
+            self.deduplicated += 1
+            self._ids[key] = self._shared[digest]
+            return IndirectObject(self._ids[key], 0, None)
+
+        obj_id = self._ids.setdefault(key, self._reserve())
+        if shared:
+            self._shared.setdefault(digest, obj_id)
+        self.offsets[obj_id] = self.f.tell()
+        self.f.write(f"{obj_id} 0 obj\n".encode() + body + b"\nendobj\n")
+        return IndirectObject(obj_id, 0, None)
+
+    def close(self):
+        pages = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(
+                    IndirectObject(kid, 0, None) for kid in self.kids
+                ),
+                NameObject("/Count"): NumberObject(len(self.kids)),
+            }
+        )
+        self._write(PAGES_ID, pages)
+        catalog = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): IndirectObject(PAGES_ID, 0, None),
+            }
+        )
+        self._write(CATALOG_ID, catalog)
+
+        xref_offset = self.f.tell()
+        self.f.write(f"xref\n0 {self._next_id}\n0000000000 65535 f\r\n".encode())
+        for obj_id in range(1, self._next_id):
+            if obj_id in self.offsets:
+                self.f.write(f"{self.offsets[obj_id]:010d} 00000 n\r\n".encode())
+            else:
+                self.f.write(b"0000000000 00000 f\r\n")
+        trailer = DictionaryObject(
+            {
+                NameObject("/Size"): NumberObject(self._next_id),
+                NameObject("/Root"): IndirectObject(CATALOG_ID, 0, None),
+            }
+        )
+        self.f.write(b"trailer\n")
+        trailer.write_to_stream(self.f)
+        self.f.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+
+
+def cache_key(operation: str, inputs: List[Dict[str, Any]], **params) -> str:
+    # Inputs are identified by content, never by name or upload path. A
+    # password only enters the key through a hash salted with the content,
+    # so an encrypted document is only served back to someone who knows it.
+    digest = hashlib.sha256(operation.encode())
+    for item in inputs:
+        digest.update(item["sha256"].encode())
+        password = item.get("password")
+        if password:
+            secret = f"{item['sha256']}:{password}".encode()
+            digest.update(hashlib.sha256(secret).digest())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    # One directory per key holding the result under its original file name.
+    # mtime marks when an entry was stored (TTL), atime when it was last
+    # served (LRU).
+    def __init__(self, cache_dir: str, max_bytes: int, ttl: float):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_file(self, entry_dir: str) -> Optional[str]:
+        try:
+            names = os.listdir(entry_dir)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return os.path.join(entry_dir, names[0]) if names else None
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._entry_file(os.path.join(self.cache_dir, key))
+        if path is not None:
+            try:
+                stat = os.stat(path)
+                if time.time() - stat.st_mtime <= self.ttl:
+                    os.utime(path, (time.time(), stat.st_mtime))
+                    self._count(True)
+                    return path
+                self._remove(os.path.dirname(path))
+            except FileNotFoundError:
+                pass
+        self._count(False)
+        return None
+
+    def export(self, key: str, output_dir: str) -> Optional[str]:
+        # Hands out a private copy for callers that delete their result.
+        path = self.get(key)
+        if path is None:
+            return None
+        os.makedirs(output_dir, exist_ok=True)
+        target = os.path.join(output_dir, os.path.basename(path))
+        try:
+            link_or_copy(path, target)
+        except FileNotFoundError:
+            return None
+        return target
+
+    def start(self, name: str) -> str:
+        staging = os.path.join(self.cache_dir, f".tmp_{uuid.uuid4().hex}")
+        os.makedirs(staging)
+        return os.path.join(staging, os.path.basename(name))
+
+    def commit(self, key: str, staged_path: str, evict: bool = True):
+        staging = os.path.dirname(staged_path)
+        if os.path.getsize(staged_path) > self.max_bytes:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        # Replace any expired entry, but leave a live one written concurrently.
+        entry_dir = os.path.join(self.cache_dir, key)
+        existing = self._entry_file(entry_dir)
+        if existing and time.time() - os.path.getmtime(existing) > self.ttl:
+            self._remove(entry_dir)
+        try:
+            os.rename(staging, entry_dir)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        # Callers storing many entries at once evict once at the end.
+        if evict:
+            self.evict()
+
+    def abort(self, staged_path: str):
+        shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
+
+    def put(self, key: str, path: str):
+        staged_path = self.start(path)
+        try:
+            # Copied, not linked: the result path may be rewritten in place later.
+            shutil.copyfile(path, staged_path)
+        except Exception:
+            self.abort(staged_path)
+            raise
+        self.commit(key, staged_path)
+
+    def put_data(self, key: str, name: str, data: bytes, evict: bool = True):
+        staged_path = self.start(name)
+        try:
+            with open(staged_path, "wb") as f:
+                f.write(data)
+        except Exception:
+            self.abort(staged_path)
+            raise
+        self.commit(key, staged_path, evict)
+
+    def _remove(self, entry_dir: str):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _entries(self) -> List[Dict[str, Any]]:
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key.startswith("."):
+                continue
+            entry_dir = os.path.join(self.cache_dir, key)
+            path = self._entry_file(entry_dir)
+            try:
+                stat = os.stat(path) if path else None
+            except FileNotFoundError:
+                stat = None
+            if stat is None:
+                self._remove(entry_dir)
+                continue
+            entries.append(
+                {
+                    "dir": entry_dir,
+                    "size": stat.st_size,
+                    "stored": stat.st_mtime,
+                    "used": stat.st_atime,
+                }
+            )
+        return entries
+
+    def capacity(self) -> int:
+        return self.max_bytes
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for entry in self._entries():
+            if now - entry["stored"] > self.ttl:
+                self._remove(entry["dir"])
+                self.evictions += 1
+            else:
+                entries.append(entry)
+
+        total = sum(entry["size"] for entry in entries)
+        capacity = self.capacity()
+        for entry in sorted(entries, key=lambda e: e["used"]):
+            if total <= capacity:
+                break
+            self._remove(entry["dir"])
+            self.evictions += 1
+            total -= entry["size"]
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self._entries()
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(entry["size"] for entry in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+def link_or_copy(source: str, target: str):
+    # Cache entries are never written in place, so handing out a hard link is
+    # safe and avoids copying large outputs.
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def create_result_cache() -> Optional[ResultCache]:
+    max_mb = int(os.getenv("RESULT_CACHE_MAX_MB", 1024))
+    if max_mb <= 0:
+        return None
+    return ResultCache(
+        os.getenv("RESULT_CACHE_DIR", "result_cache"),
+        max_mb * 1024 * 1024,
+        float(os.getenv("RESULT_CACHE_TTL", 86400)),
+    )
+
+
+def create_thumbnail_cache() -> ResultCache:
+    # Always on: thumbnails are only ever served from here.
+    return ResultCache(
+        os.getenv("THUMBNAIL_CACHE_DIR", "thumbnail_cache"),
+        int(os.getenv("THUMBNAIL_CACHE_MAX_MB", 256)) * 1024 * 1024,
+        float(os.getenv("THUMBNAIL_CACHE_TTL", 86400)),
+    )
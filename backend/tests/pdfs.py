@@ -0,0 +1,49 @@
+from typing import List
+
+FONT = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+# Font 3 under /F1, as in every document below.
+RESOURCES = b"<< /Font << /F1 3 0 R >> >>"
+
+
+def page(parent: int, content: int, resources: bytes = RESOURCES) -> bytes:
+    return (
+        b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 200 200] "
+        b"/Resources %s /Contents %d 0 R >>" % (parent, resources, content)
+    )
+
+
+def stream(data: bytes, entries: bytes = b"") -> bytes:
+    return b"<< /Length %d %s>>\nstream\n%s\nendstream" % (len(data), entries, data)
+
+
+def text(value: str) -> bytes:
+    return stream(b"BT /F1 12 Tf 20 100 Td (%s) Tj ET" % value.encode())
+
+
+def build_pdf(objects: List[bytes], shift: int = 0) -> bytes:
+    # Objects are numbered from 1; `shift` moves every xref offset.
+    data = b"%PDF-1.7\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        data += b"%010d 00000 n \n" % (offset + shift)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    return data + b"startxref\n%d\n%%%%EOF\n" % xref
+
+
+# Root -> [empty /Pages node, /Pages node with "one", "two"]
+UNEVEN = [
+    b"<< /Type /Catalog /Pages 2 0 R >>",
+    b"<< /Type /Pages /Kids [4 0 R 5 0 R] /Count 2 >>",
+    FONT,
+    b"<< /Type /Pages /Parent 2 0 R /Kids [] /Count 0 >>",
+    b"<< /Type /Pages /Parent 2 0 R /Kids [6 0 R 7 0 R] /Count 2 >>",
+    page(5, 8),
+    page(5, 9),
+    text("one"),
+    text("two"),
+]
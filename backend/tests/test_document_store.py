@@ -0,0 +1,68 @@
+import os
+import pytest
+from fastapi import HTTPException
+from document_store import DocumentStore, fcntl
+
+
+def make_store(root, max_bytes=1000):
+    return DocumentStore(str(root), max_bytes, 3600, max_bytes, 3600)
+
+
+@pytest.mark.skipif(fcntl is None, reason="needs fcntl")
+def test_second_writer_is_refused_while_a_chunk_is_written(tmp_path):
+    store = make_store(tmp_path)
+    upload_id = store.create_session("a.pdf", 10)["upload_id"]
+    session, f = store.open_session(upload_id, 0)
+    try:
+        with pytest.raises(HTTPException) as e:
+            store.open_session(upload_id, 0)
+        assert e.value.status_code == 409
+        f.write(b"%PDF-")
+    finally:
+        f.close()
+
+    # The offset is read again once the lock is free.
+    with pytest.raises(HTTPException) as e:
+        store.open_session(upload_id, 0)
+    assert e.value.headers["Upload-Offset"] == "5"
+    session, f = store.open_session(upload_id, 5)
+    f.close()
+    assert session["offset"] == 5
+
+
+def test_sessions_reserve_their_size(tmp_path):
+    store = make_store(tmp_path)
+    first = store.create_session("a.pdf", 600)
+    with pytest.raises(HTTPException) as e:
+        store.create_session("b.pdf", 600)
+    assert e.value.status_code == 507
+    assert store.capacity() == 400
+
+    store.discard_session(first["upload_id"])
+    store.create_session("b.pdf", 600)
+
+
+def test_reservations_evict_stored_documents(tmp_path):
+    store = make_store(tmp_path)
+    store.add("a.pdf", "a" * 64, b"%PDF-" + b"0" * 595)
+    store.create_session("b.pdf", 600)
+    assert store.describe("a" * 64) is None
+    assert os.listdir(store.sessions_dir)
+
+
+def test_a_document_goes_with_its_last_claim(tmp_path):
+    store = make_store(tmp_path)
+    doc_id = "a" * 64
+    first = store.add("a.pdf", doc_id, b"%PDF-1.7")["token"]
+    second = store.add("a.pdf", doc_id, b"%PDF-1.7")["token"]
+
+    # Knowing the id is not enough, and a token only counts once.
+    assert not store.remove(doc_id, "")
+    assert not store.remove(doc_id, "b" * 32)
+    assert store.remove(doc_id, first)
+    assert not store.remove(doc_id, first)
+    assert store.describe(doc_id) is not None
+
+    assert store.remove(doc_id, second)
+    assert store.describe(doc_id) is None
+    assert os.listdir(store.owners_dir) == []
@@ -0,0 +1,31 @@
+import fitz
+from pypdf import PdfReader
+import pdf_utils
+from pdfs import UNEVEN, build_pdf
+
+
+def write(tmp_path, data: bytes) -> str:
+    path = tmp_path / "in.pdf"
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_delete_in_place_walks_an_uneven_page_tree(tmp_path):
+    path = write(tmp_path, build_pdf(UNEVEN))
+    reader = PdfReader(path)
+    assert pdf_utils.can_update_incrementally(reader)
+
+    f = pdf_utils.delete_pages_in_place(reader, path, str(tmp_path), "out.pdf", {1})
+    f.close()
+
+    result = PdfReader(f.name)
+    assert [p.extract_text() for p in result.pages] == ["one"]
+    with fitz.open(f.name) as doc:
+        assert [p.get_text().strip() for p in doc] == ["one"]
+
+
+def test_repaired_xref_is_not_updated_in_place(tmp_path):
+    path = write(tmp_path, build_pdf(UNEVEN, shift=7))
+    reader = PdfReader(path)
+    assert len(reader.pages) == 2
+    assert not pdf_utils.can_update_incrementally(reader)
@@ -0,0 +1,78 @@
+import pytest
+from fastapi import HTTPException
+from python_multipart.multipart import MultipartParser
+from ingest import FIELD_MAX_SIZE, StreamingUploadParser
+from workspace import TempStore
+
+BOUNDARY = b"boundary"
+
+
+def multipart(files):
+    body = b""
+    for name, data in files:
+        body += (
+            b"--" + BOUNDARY + b"\r\n"
+            b'Content-Disposition: form-data; name="files"; filename="'
+            + name.encode()
+            + b'"\r\n\r\n'
+            + data
+            + b"\r\n"
+        )
+    return body + b"--" + BOUNDARY + b"--\r\n"
+
+
+def field(name, value):
+    return (
+        b"--" + BOUNDARY + b"\r\n"
+        b'Content-Disposition: form-data; name="'
+        + name.encode()
+        + b'"\r\n\r\n'
+        + value
+        + b"\r\n"
+    )
+
+
+def parse(tmp_path, files, collect_errors, fields=b""):
+    workspace = TempStore(str(tmp_path), 0, 0, 3600).create()
+    handler = StreamingUploadParser(workspace, 100, 1000, (), collect_errors)
+    parser = MultipartParser(BOUNDARY, handler.callbacks())
+    parser.write(fields + multipart(files))
+    parser.finalize()
+    handler.flush()
+    return handler.form
+
+
+FILES = [
+    ("empty.pdf", b""),
+    ("bad.pdf", b"hello"),
+    ("big.pdf", b"%PDF-" + b"0" * 200),
+    ("ok.pdf", b"%PDF-1.7"),
+]
+
+
+def test_collected_errors_stay_with_their_file(tmp_path):
+    form = parse(tmp_path, FILES, collect_errors=True)
+    errors = {u["name"]: u.get("error", {}).get("type") for u in form.uploads}
+    assert errors == {
+        "empty.pdf": "empty",
+        "bad.pdf": "invalid_format",
+        "big.pdf": "too_large",
+        "ok.pdf": None,
+    }
+    assert form.uploads[-1]["data"] == b"%PDF-1.7"
+
+
+def test_without_collect_errors_a_bad_file_fails_the_request(tmp_path):
+    with pytest.raises(HTTPException) as e:
+        parse(tmp_path, FILES[1:], collect_errors=False)
+    assert e.value.status_code == 400
+
+
+def test_oversized_form_field_is_rejected(tmp_path):
+    fields = field("password", b"x" * FIELD_MAX_SIZE) + field("level", b"less")
+    form = parse(tmp_path, [], collect_errors=True, fields=fields)
+    assert form.fields == {"password": "x" * FIELD_MAX_SIZE, "level": "less"}
+
+    with pytest.raises(HTTPException) as e:
+        parse(tmp_path, [], collect_errors=True, fields=field("password", b"x" * 70000))
+    assert e.value.status_code == 413
@@ -0,0 +1,63 @@
+import asyncio
+import sqlite3
+import workers
+from jobs import FAILED, RUNNING, JobRunner, MemoryJobStore, SqliteJobStore
+
+
+def test_passwords_are_not_stored(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    store = SqliteJobStore(db_path)
+    job = store.create("compress", {"path": "a.pdf"}, [], {"password": "secret"})
+
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("SELECT * FROM jobs").fetchall()
+    assert "secret" not in repr(rows)
+    assert store.secrets(job["id"]) == {"password": "secret"}
+
+
+def test_only_the_process_holding_the_secrets_claims_the_job(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    creator, other = SqliteJobStore(db_path), SqliteJobStore(db_path)
+    locked = creator.create("compress", {}, [], {"password": "secret"})
+    plain = creator.create("compress", {}, [])
+
+    assert other.claim()["id"] == plain["id"]
+    assert other.claim() is None
+    assert creator.claim()["id"] == locked["id"]
+
+
+def test_older_databases_gain_the_owner_column(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "CREATE TABLE jobs (id TEXT PRIMARY KEY, operation TEXT NOT NULL, "
+            "state TEXT NOT NULL, progress REAL NOT NULL, params TEXT, "
+            "result TEXT, error TEXT, cleanup TEXT, created_at REAL NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+    store = SqliteJobStore(db_path)
+    job = store.create("merge", {}, [])
+    assert store.claim()["id"] == job["id"]
+
+
+def test_sweep_fails_running_jobs_nobody_is_running(monkeypatch):
+    monkeypatch.setenv("JOB_TTL", "60")
+    store = MemoryJobStore()
+    cleaned = []
+    runner = JobRunner(store, {}, cleaned.extend)
+    orphan = store.create("compress", {}, ["a.pdf"])
+    active = store.create("compress", {}, ["b.pdf"])
+    store.claim()
+    store.claim()
+    runner._running.add(active["id"])
+    for job in (orphan, active):
+        store._jobs[job["id"]]["updated_at"] -= 120
+
+    try:
+        asyncio.run(runner.sweep())
+    finally:
+        workers.shutdown_pools()
+
+    assert store.get(orphan["id"])["state"] == FAILED
+    assert store.get(active["id"])["state"] == RUNNING
+    assert cleaned == ["a.pdf"]
@@ -0,0 +1,39 @@
+import io
+import pytest
+from pypdf import PdfReader, PdfWriter
+import key_cache
+import pdf_utils
+
+
+@pytest.fixture
+def locked():
+    writer = PdfWriter()
+    writer.add_blank_page(100, 100)
+    writer.encrypt("secret", algorithm="AES-256")
+    f = io.BytesIO()
+    writer.write(f)
+    return f.getvalue()
+
+
+def unlock(data: bytes, password: str) -> PdfReader:
+    reader = PdfReader(io.BytesIO(data))
+    pdf_utils.unlock_if_encrypted(reader, password, "a.pdf")
+    return reader
+
+
+def test_second_open_reuses_the_file_key(locked, monkeypatch):
+    monkeypatch.setattr(key_cache, "_keys", key_cache.KeyCache(8, 60))
+    unlock(locked, "secret")
+    monkeypatch.setattr(PdfReader, "decrypt", None)
+
+    assert len(unlock(locked, "secret").pages) == 1
+
+
+def test_missing_pypdf_internals_bypass_the_cache(locked, monkeypatch):
+    monkeypatch.setattr(key_cache, "_keys", key_cache.KeyCache(8, 60))
+    monkeypatch.setattr(key_cache, "KEY_FIELDS", ("_gone",))
+
+    assert len(unlock(locked, "secret").pages) == 1
+    assert not key_cache.get_key_cache()._entries
+    with pytest.raises(ValueError, match="INVALID_PASSWORD"):
+        unlock(locked, "wrong")
@@ -0,0 +1,14 @@
+import os
+import pytest
+import pdf_utils
+
+
+def test_hung_qpdf_is_a_failure(tmp_path, monkeypatch):
+    qpdf = tmp_path / "qpdf"
+    qpdf.write_text("#!/bin/sh\nsleep 10\n")
+    os.chmod(qpdf, 0o755)
+    monkeypatch.setattr(pdf_utils, "find_qpdf", lambda: str(qpdf))
+    monkeypatch.setenv("QPDF_TIMEOUT", "0.2")
+
+    with pytest.raises(RuntimeError, match="timed out"):
+        pdf_utils.linearize_pdf(str(tmp_path / "in.pdf"), str(tmp_path / "out.pdf"))
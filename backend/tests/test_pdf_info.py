@@ -0,0 +1,47 @@
+import fitz
+import pytest
+from pypdf import PdfWriter
+from pdf_utils import get_pdf_info
+
+
+def _document() -> fitz.Document:
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "hello")
+    return doc
+
+
+def test_plain(tmp_path):
+    path = str(tmp_path / "plain.pdf")
+    _document().save(path)
+    info = get_pdf_info(path)
+    assert info["pages"] == 1
+    assert not info["encrypted"]
+    assert info["encryption"] is None
+
+
+def test_pymupdf_inline_encrypt_dictionary(tmp_path):
+    # MuPDF writes /Encrypt directly into the trailer, not as an object.
+    path = str(tmp_path / "aes256.pdf")
+    _document().save(
+        path, encryption=fitz.PDF_ENCRYPT_AES_256, user_pw="pw", owner_pw="pw"
+    )
+    assert fitz.open(path).xref_get_key(-1, "Encrypt")[0] == "dict"
+    info = get_pdf_info(path)
+    assert info["encrypted"]
+    assert info["needs_password"]
+    assert info["encryption"] == "AES-256"
+
+
+@pytest.mark.parametrize(
+    "algorithm, name",
+    [("AES-256", "AES-256"), ("AES-128", "AES-128"), ("RC4-128", "RC4-128")],
+)
+def test_pypdf_encrypt_object(tmp_path, algorithm, name):
+    path = str(tmp_path / "encrypted.pdf")
+    writer = PdfWriter()
+    writer.add_blank_page(200, 200)
+    writer.encrypt(user_password="pw", algorithm=algorithm)
+    writer.write(path)
+    info = get_pdf_info(path)
+    assert info["encrypted"]
+    assert info["encryption"] == name
@@ -0,0 +1,35 @@
+import io
+import fitz
+from pypdf import PdfReader
+from pdf_writer import StreamingPdfWriter
+from pdfs import FONT, build_pdf, page, stream
+
+# The page draws form /Fm0, whose text uses the page's /F1.
+BORROWING_FORM = [
+    b"<< /Type /Catalog /Pages 2 0 R >>",
+    b"<< /Type /Pages /Kids [4 0 R] /Count 1 >>",
+    FONT,
+    page(2, 5, b"<< /Font << /F1 3 0 R >> /XObject << /Fm0 6 0 R >> >>"),
+    stream(b"/Fm0 Do"),
+    stream(
+        b"BT /F1 12 Tf 20 100 Td (form) Tj ET",
+        b"/Type /XObject /Subtype /Form /BBox [0 0 200 200] ",
+    ),
+]
+
+
+def split(data: bytes) -> bytes:
+    out = io.BytesIO()
+    writer = StreamingPdfWriter(out)
+    writer.add_pages(PdfReader(io.BytesIO(data)), [0], prune_resources=True)
+    writer.close()
+    return out.getvalue()
+
+
+def test_pruning_keeps_resources_a_form_borrows():
+    result = split(build_pdf(BORROWING_FORM))
+
+    resources = PdfReader(io.BytesIO(result)).pages[0]["/Resources"]
+    assert "/F1" in resources["/Font"]
+    with fitz.open(stream=result) as doc:
+        assert doc[0].get_text().strip() == "form"
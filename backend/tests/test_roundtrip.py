@@ -0,0 +1,205 @@
+import io
+import random
+import shutil
+import fitz
+import pytest
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+import pdf_utils
+from gs_pool import find_ghostscript
+
+PAGES = 5
+
+
+def make_pdf(path, pages: int = PAGES, xref_stream: bool = False) -> str:
+    doc = fitz.open()
+    for i in range(pages):
+        doc.new_page().insert_text((72, 72), f"page {i + 1}", fontname="helv")
+    doc.save(str(path), garbage=1, use_objstms=xref_stream)
+    doc.close()
+    return str(path)
+
+
+def image_pdf(path) -> str:
+    # Two pages holding the same noisy image under two xrefs.
+    pixels = random.Random(0).randbytes(400 * 400 * 3)
+    pixmap = fitz.Pixmap(fitz.csRGB, 400, 400, pixels, False)
+    doc = fitz.open()
+    for i in range(2):
+        part = fitz.open()
+        page = part.new_page()
+        page.insert_text((72, 72), f"page {i + 1}", fontname="helv")
+        page.insert_image(fitz.Rect(100, 100, 300, 300), pixmap=pixmap)
+        doc.insert_pdf(part)
+        part.close()
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def read(result) -> bytes:
+    if isinstance(result, tuple):
+        return result[1]
+    with open(result, "rb") as f:
+        return f.read()
+
+
+def pages_of(data: bytes, password=None):
+    # (text, rotation) per page, checked to agree between pypdf and MuPDF.
+    reader = PdfReader(io.BytesIO(data))
+    if password:
+        reader.decrypt(password)
+    pages = [(p.extract_text().strip(), p.rotation) for p in reader.pages]
+    with fitz.open(stream=data) as doc:
+        if password:
+            assert doc.authenticate(password)
+        assert [(p.get_text().strip(), p.rotation) for p in doc] == pages
+    return pages
+
+
+def reachable(reader: PdfReader) -> set:
+    seen = set()
+    stack = [reader.trailer.raw_get("/Root")]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.idnum in seen:
+                continue
+            seen.add(obj.idnum)
+            obj = obj.get_object()
+        if isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+    return seen
+
+
+def reachable_of_type(reader: PdfReader, kind: str) -> set:
+    return {
+        idnum
+        for idnum in reachable(reader)
+        if isinstance(obj := reader.get_object(idnum), DictionaryObject)
+        and obj.get("/Type") == kind
+    }
+
+
+def expected(numbers, rotation=0):
+    return [(f"page {n}", rotation) for n in numbers]
+
+
+def test_merge_copies_pages_in_order_and_shares_fonts(tmp_path):
+    a = make_pdf(tmp_path / "a.pdf", 2)
+    b = make_pdf(tmp_path / "b.pdf", 3, xref_stream=True)
+
+    result = pdf_utils.merge_pdfs(
+        [{"path": a, "rotation": 90}, {"path": b}], output_dir=str(tmp_path / "out")
+    )
+
+    data = read(result)
+    assert pages_of(data) == expected([1, 2], 90) + expected([1, 2, 3])
+    # Both sources embed the same Helvetica dictionary; it is written once.
+    assert len(reachable_of_type(PdfReader(io.BytesIO(data)), "/Font")) == 1
+
+
+@pytest.mark.parametrize("xref_stream", [False, True])
+def test_rotate_in_place_appends_an_update(tmp_path, xref_stream):
+    path = make_pdf(tmp_path / "in.pdf", xref_stream=xref_stream)
+    original = read(path)
+
+    pdf_utils.rotate_pages_in_place(path, 90)
+
+    data = read(path)
+    assert data.startswith(original)
+    assert pages_of(data) == expected(range(1, PAGES + 1), 90)
+
+
+@pytest.mark.parametrize("xref_stream", [False, True])
+def test_delete_in_place_leaves_deleted_pages_unreachable(tmp_path, xref_stream):
+    path = make_pdf(tmp_path / "in.pdf", xref_stream=xref_stream)
+    original = read(path)
+    source = PdfReader(path)
+    deleted = {source.pages[i].indirect_reference.idnum for i in (1, 3)}
+
+    result = pdf_utils.delete_pages(
+        path, "2,4", rotation=180, incremental=True, output_dir=str(tmp_path / "out")
+    )
+
+    data = read(result)
+    assert data.startswith(original)
+    assert pages_of(data) == expected([1, 3, 5], 180)
+    assert not deleted & reachable(PdfReader(io.BytesIO(data)))
+
+
+def test_shards_split_and_join_back_in_order(tmp_path):
+    path = make_pdf(tmp_path / "in.pdf")
+    output_dir = str(tmp_path / "out")
+
+    shard_dir, shard_paths = pdf_utils.write_shards(path, None, 90, output_dir, 2)
+    try:
+        assert [len(PdfReader(p).pages) for p in shard_paths] == [2, 2, 1]
+        result = pdf_utils.join_shards(path, None, shard_paths, output_dir=output_dir)
+    finally:
+        shutil.rmtree(shard_dir)
+
+    data = read(result)
+    assert pages_of(data) == expected(range(1, PAGES + 1), 90)
+    # Every shard carries its own copy of the font; the join keeps one.
+    assert len(reachable_of_type(PdfReader(io.BytesIO(data)), "/Font")) == 1
+
+
+def test_native_recompression_swaps_in_one_jpeg(tmp_path):
+    path = image_pdf(tmp_path / "in.pdf")
+
+    images = pdf_utils.plan_image_recompression(path, None, "recommended")
+    assert sum(len(image["xrefs"]) for image in images) == 2
+    encoded = pdf_utils.recompress_images(path, None, images, "recommended")
+    assert encoded
+    result = pdf_utils.write_recompressed(
+        path, None, encoded, rotation=270, output_dir=str(tmp_path / "out")
+    )
+
+    data = read(result)
+    assert len(data) < len(read(path))
+    assert pages_of(data) == expected([1, 2], 270)
+    with fitz.open(stream=data) as doc:
+        xrefs = {image[0] for page in doc for image in page.get_images()}
+        assert len(xrefs) == 1
+        assert doc.xref_get_key(xrefs.pop(), "Filter") == ("name", "/DCTDecode")
+
+
+def test_pipeline_edits_in_one_pass_and_locks_last(tmp_path):
+    path = make_pdf(tmp_path / "in.pdf")
+    plan = pdf_utils.plan_pipeline(
+        [
+            {"op": "delete", "pages": "2"},
+            {"op": "rotate", "angle": 90, "pages": "1-2"},
+            {"op": "delete", "pages": "4"},
+            {"op": "lock", "password": "secret"},
+        ]
+    )
+
+    result = pdf_utils.run_pipeline(path, None, plan, str(tmp_path / "out"))
+
+    data = read(result)
+    assert PdfReader(io.BytesIO(data)).is_encrypted
+    assert pages_of(data, "secret") == [
+        ("page 1", 90),
+        ("page 3", 90),
+        ("page 4", 0),
+    ]
+
+
+@pytest.mark.skipif(not find_ghostscript(), reason="Ghostscript is not installed")
+def test_compressing_pipeline_keeps_the_edits(tmp_path):
+    path = make_pdf(tmp_path / "in.pdf")
+    plan = pdf_utils.plan_pipeline(
+        [
+            {"op": "rotate", "angle": 180},
+            {"op": "compress", "level": "recommended"},
+            {"op": "delete", "pages": "1"},
+        ]
+    )
+
+    result = pdf_utils.run_pipeline(path, None, plan, str(tmp_path / "out"))
+
+    assert pages_of(read(result)) == expected(range(2, PAGES + 1), 180)
@@ -0,0 +1,51 @@
+import asyncio
+import workers
+
+
+def chunks_of(*chunks):
+    yield from chunks
+
+
+def run(coroutine):
+    try:
+        return asyncio.run(coroutine)
+    finally:
+        workers.shutdown_pools()
+
+
+def test_unread_stream_holds_no_slot(monkeypatch):
+    monkeypatch.setenv("OPERATION_LIMITS", "archive=1")
+
+    async def scenario():
+        # The client leaves before the body is read.
+        await workers.stream_io("archive", chunks_of(b"a"))
+        chunks = await workers.stream_io("archive", chunks_of(b"b", b"c"))
+        return [chunk async for chunk in chunks]
+
+    assert run(asyncio.wait_for(scenario(), 5)) == [b"b", b"c"]
+
+
+def test_stream_releases_its_slot_when_closed_early(monkeypatch):
+    monkeypatch.setenv("OPERATION_LIMITS", "archive=1")
+
+    async def scenario():
+        chunks = await workers.stream_io("archive", chunks_of(b"a", b"b"))
+        async for chunk in chunks:
+            break
+        await chunks.aclose()
+        return workers._limiters["archive"].locked()
+
+    assert run(scenario()) is False
+
+
+def test_batch_files_wait_for_a_busy_pool(monkeypatch):
+    monkeypatch.setenv("OPERATION_LIMITS", "count=1")
+    monkeypatch.setenv("MAX_QUEUE_DEPTH", "0")
+    monkeypatch.setenv("BATCH_WORKERS", "3")
+    items = [{"size": 1, "name": name} for name in ("a", "bb", "ccc")]
+
+    async def scenario():
+        results = workers.run_batch("count", len, items, lambda item: (item["name"],))
+        return sorted([(result, error) async for _, result, error in results])
+
+    assert run(scenario()) == [(1, None), (2, None), (3, None)]
@@ -0,0 +1,339 @@
+import os
+import time
+import asyncio
+import contextlib
+import contextvars
+import multiprocessing
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+import metrics
+from key_cache import get_key_cache
+
+_io_pool: Optional[ThreadPoolExecutor] = None
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_limiters: Dict[str, asyncio.Semaphore] = {}
+_waiting = 0
+_budget: Optional["MemoryBudget"] = None
+# Rough peak memory of rewriting a PDF, per byte of input.
+BATCH_MEMORY_FACTOR = 4
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def io_workers() -> int:
+    return _env_int("IO_WORKERS", min(32, (os.cpu_count() or 1) + 4))
+
+
+def cpu_workers() -> int:
+    return _env_int("CPU_WORKERS", os.cpu_count() or 1)
+
+
+def max_queue_depth() -> int:
+    return _env_int("MAX_QUEUE_DEPTH", 32)
+
+
+def retry_after() -> int:
+    return _env_int("RETRY_AFTER", 5)
+
+
+def batch_workers() -> int:
+    return _env_int("BATCH_WORKERS", cpu_workers())
+
+
+def batch_memory() -> int:
+    return _env_int("BATCH_MEMORY_MB", 512) * 1024 * 1024
+
+
+def operation_limits() -> Dict[str, int]:
+    # e.g. OPERATION_LIMITS=merge=4,compress=2
+    limits = {}
+    for part in os.getenv("OPERATION_LIMITS", "").split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            limits[name.strip()] = int(value)
+    return limits
+
+
+def get_io_pool() -> ThreadPoolExecutor:
+    global _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(
+            max_workers=io_workers(), thread_name_prefix="pdf-io"
+        )
+    return _io_pool
+
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    global _cpu_pool
+    if _cpu_pool is None:
+        _cpu_pool = ProcessPoolExecutor(
+            max_workers=cpu_workers(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _cpu_pool
+
+
+def _get_limiter(operation: str, default: int) -> asyncio.Semaphore:
+    if operation not in _limiters:
+        limit = operation_limits().get(operation, default)
+        _limiters[operation] = asyncio.Semaphore(max(1, limit))
+    return _limiters[operation]
+
+
+def queue_depth() -> int:
+    return _waiting
+
+
+def _check_queue(operation: str, default_limit: int) -> asyncio.Semaphore:
+    limiter = _get_limiter(operation, default_limit)
+    if limiter.locked() and _waiting >= max_queue_depth():
+        metrics.inc("requests_rejected_total", operation=operation)
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please try again later.",
+            headers={"Retry-After": str(retry_after())},
+        )
+    return limiter
+
+
+async def _wait_for(limiter: asyncio.Semaphore):
+    global _waiting
+    _waiting += 1
+    try:
+        await limiter.acquire()
+    finally:
+        _waiting -= 1
+
+
+async def _acquire(operation: str, default_limit: int) -> asyncio.Semaphore:
+    limiter = _check_queue(operation, default_limit)
+    await _wait_for(limiter)
+    return limiter
+
+
+async def _run(
+    operation: str, pool, default_limit: int, task: Callable, limited: bool = True
+):
+    start = time.perf_counter()
+    limiter = await _acquire(operation, default_limit) if limited else None
+    metrics.record_stage("queue_wait", time.perf_counter() - start, operation)
+    try:
+        loop = asyncio.get_running_loop()
+        with metrics.stage("execute", operation):
+            return await loop.run_in_executor(pool, task)
+    finally:
+        if limiter is not None:
+            limiter.release()
+
+
+@contextlib.asynccontextmanager
+async def operation_slot(operation: str):
+    # One slot for a request that fans out into several tasks; they run with
+    # run_cpu_held so they don't queue behind (or 503 on) the request itself.
+    limiter = await _acquire(operation, cpu_workers())
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+async def run_io(operation: str, func: Callable, *args, **kwargs):
+    return await _run_io(operation, True, func, args, kwargs)
+
+
+async def run_io_held(operation: str, func: Callable, *args, **kwargs):
+    # run_io inside operation_slot(operation).
+    return await _run_io(operation, False, func, args, kwargs)
+
+
+async def _run_io(
+    operation: str, limited: bool, func: Callable, args: Tuple, kwargs: Dict
+):
+    # Threads share the registry; the copied context carries the request's
+    # stage list into the worker thread.
+    context = contextvars.copy_context()
+    task = partial(context.run, metrics.run_traced, operation, func, *args, **kwargs)
+    return await _run(operation, get_io_pool(), io_workers(), task, limited)
+
+
+def _cpu_task(keys: Optional[Dict], operation: str, func: Callable, *args, **kwargs):
+    # Runs in the worker process. Verified decryption keys travel with the task
+    # in both directions, so a password checked in one process is not derived
+    # again in another.
+    get_key_cache().load(keys)
+    result = metrics.run_collected(operation, func, *args, **kwargs)
+    return result + (get_key_cache().drain(),)
+
+
+async def run_cpu(operation: str, func: Callable, *args, **kwargs):
+    return await _run_cpu(operation, True, func, args, kwargs)
+
+
+async def run_cpu_held(operation: str, func: Callable, *args, **kwargs):
+    # run_cpu inside operation_slot(operation).
+    return await _run_cpu(operation, False, func, args, kwargs)
+
+
+async def _run_cpu(
+    operation: str, limited: bool, func: Callable, args: Tuple, kwargs: Dict
+):
+    global _cpu_pool
+    keys = get_key_cache()
+    task = partial(_cpu_task, keys.export(), operation, func, *args, **kwargs)
+    try:
+        result, error, samples, stages, verified = await _run(
+            operation, get_cpu_pool(), cpu_workers(), task, limited
+        )
+        metrics.merge_collected(samples, stages)
+        keys.merge(verified)
+        if error is not None:
+            raise error
+        return result
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); start a fresh pool for the next request.
+        print(f"Process pool broken during {operation}, restarting it")
+        metrics.inc("worker_crashes_total", operation=operation)
+        _cpu_pool = None
+        raise RuntimeError("Worker process crashed while processing the file.")
+
+
+class MemoryBudget:
+    # Bytes that batch files being processed may use between them, across all
+    # requests. A file bigger than the whole budget still runs, on its own.
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._changed = asyncio.Event()
+
+    async def acquire(self, size: int):
+        while self.used and self.used + size > self.limit:
+            self._changed.clear()
+            await self._changed.wait()
+        self.used += size
+
+    def release(self, size: int):
+        self.used -= size
+        self._changed.set()
+
+
+def get_memory_budget() -> MemoryBudget:
+    global _budget
+    if _budget is None:
+        _budget = MemoryBudget(batch_memory())
+    return _budget
+
+
+async def run_batch(
+    operation: str,
+    func: Callable,
+    items: List[Dict],
+    make_args: Callable[[Dict], Tuple],
+) -> AsyncIterator[Tuple[Dict, Any, Optional[Exception]]]:
+    # Runs func on every item in the process pool, at most batch_workers() at a
+    # time and within the memory budget, and yields (item, result, error) as
+    # each one finishes. A failed file is reported, the others carry on.
+    budget = get_memory_budget()
+    slots = asyncio.Semaphore(batch_workers())
+
+    async def run_one(item: Dict):
+        cost = item["size"] * BATCH_MEMORY_FACTOR
+        async with slots:
+            await budget.acquire(cost)
+            try:
+                # The batch was admitted as a whole, so a busy pool means
+                # waiting for a slot, not a 503 for this one file.
+                limiter = _get_limiter(operation, cpu_workers())
+                await _wait_for(limiter)
+                try:
+                    result = await run_cpu_held(operation, func, *make_args(item))
+                finally:
+                    limiter.release()
+                metrics.inc("batch_files_total", operation=operation, result="ok")
+                return item, result, None
+            except Exception as e:
+                metrics.inc("batch_files_total", operation=operation, result="error")
+                return item, None, e
+            finally:
+                budget.release(cost)
+
+    tasks = [asyncio.ensure_future(run_one(item)) for item in items]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _next(iterator: AsyncIterator):
+    return await iterator.__anext__()
+
+
+async def _close(iterator: AsyncIterator):
+    await iterator.aclose()
+
+
+def iter_async(
+    iterator: AsyncIterator, loop: asyncio.AbstractEventLoop
+) -> Iterator[Any]:
+    # Lets blocking code on the I/O pool consume an async iterator that runs on
+    # the event loop, e.g. run_batch results written into a zip.
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(_next(iterator), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(_close(iterator), loop).result()
+
+
+async def _drain(
+    limiter: asyncio.Semaphore, iterator: Iterator[bytes], context: contextvars.Context
+):
+    loop = asyncio.get_running_loop()
+    done = object()
+    acquired = False
+    try:
+        await _wait_for(limiter)
+        acquired = True
+        while True:
+            chunk = await loop.run_in_executor(
+                get_io_pool(), context.run, next, iterator, done
+            )
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        if acquired:
+            limiter.release()
+        await loop.run_in_executor(get_io_pool(), context.run, iterator.close)
+
+
+async def stream_io(operation: str, iterator: Iterator[bytes]) -> AsyncIterator[bytes]:
+    # Drives a blocking generator on the I/O pool. A full queue is refused
+    # before the response starts, but the operation slot is only taken once
+    # the body is iterated and held until it is complete: a body that is
+    # never iterated (the client left first) never holds one.
+    limiter = _check_queue(operation, io_workers())
+    context = contextvars.copy_context()
+    context.run(metrics.current_operation.set, operation)
+    return _drain(limiter, iterator, context)
+
+
+def shutdown_pools(wait: bool = False):
+    global _io_pool, _cpu_pool, _budget
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=wait, cancel_futures=True)
+        _io_pool = None
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=wait, cancel_futures=True)
+        _cpu_pool = None
+    _limiters.clear()
+    _budget = None
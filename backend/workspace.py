@@ -0,0 +1,186 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import threading
+from typing import Dict
+from workers import get_io_pool
+
+OUTPUT_SUBDIR = "out"
+
+
+class QuotaExceededError(Exception):
+    def __init__(self, message: str, request_limit: bool):
+        super().__init__(message)
+        # True when this request is too big, False when the server is full.
+        self.request_limit = request_limit
+
+
+class Workspace:
+    # A private directory per request. Uploads go in the top level, results in
+    # out/, and the whole directory is removed in one go when the request ends.
+    def __init__(self, store: "TempStore", path: str):
+        self.store = store
+        self.path = path
+        self.reserved = 0
+        # Set once a job owns the workspace; it outlives the request then.
+        self.kept = False
+        self._names = set()
+
+    @property
+    def output_dir(self) -> str:
+        return os.path.join(self.path, OUTPUT_SUBDIR)
+
+    def upload_path(self, filename: str) -> str:
+        # Two uploads may share a name; the second goes one level down so the
+        # file keeps its name (outputs are named after it).
+        path = os.path.join(self.path, filename)
+        n = 1
+        while path in self._names:
+            path = os.path.join(self.path, str(n), filename)
+            n += 1
+        self._names.add(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def reserve(self, size: int):
+        self.store.reserve(self, size)
+
+    def keep(self):
+        self.kept = True
+
+
+class TempStore:
+    # Hands out workspaces under one root (which may be a tmpfs such as
+    # /dev/shm), enforces byte quotas, and reclaims workspaces that nobody has
+    # touched for max_age. Live workspaces are touched on every sweep, so
+    # several server processes can share the root and a crashed one's
+    # leftovers still go away.
+    def __init__(self, root: str, request_quota: int, total_quota: int, max_age: float):
+        self.root = os.path.abspath(root)
+        self.request_quota = request_quota
+        self.total_quota = total_quota
+        self.max_age = max_age
+        self.reclaimed = 0
+        self._active: Dict[str, Workspace] = {}
+        self._disk_bytes = 0
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def create(self) -> Workspace:
+        path = os.path.join(self.root, uuid.uuid4().hex)
+        os.makedirs(os.path.join(path, OUTPUT_SUBDIR))
+        workspace = Workspace(self, path)
+        with self._lock:
+            self._active[path] = workspace
+        return workspace
+
+    def detach(self, workspace: Workspace):
+        # Leaves the workspace on disk for the janitor to reclaim by age.
+        with self._lock:
+            self._active.pop(workspace.path, None)
+
+    def owns(self, path: str) -> bool:
+        return os.path.dirname(os.path.abspath(path)) == self.root
+
+    def reserve(self, workspace: Workspace, size: int):
+        with self._lock:
+            if self.request_quota and workspace.reserved + size > self.request_quota:
+                raise QuotaExceededError(
+                    f"Request exceeds the {self.request_quota} byte storage quota.",
+                    True,
+                )
+            used = self._disk_bytes + self._pending_bytes
+            if self.total_quota and used + size > self.total_quota:
+                raise QuotaExceededError(
+                    "Server storage is full, try again later.", False
+                )
+            workspace.reserved += size
+            self._pending_bytes += size
+
+    def release(self, path: str):
+        with self._lock:
+            workspace = self._active.pop(os.path.abspath(path), None)
+            if workspace is not None:
+                self._pending_bytes = max(0, self._pending_bytes - workspace.reserved)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def sweep(self):
+        # Also re-measures the root, which picks up result files and the
+        # uploads of other processes sharing it.
+        now = time.time()
+        with self._lock:
+            active = list(self._active)
+        for path in active:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                age = now - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if path not in active and age > self.max_age:
+                print(f"Reclaiming stale workspace {path}")
+                self.release(path)
+                self.reclaimed += 1
+                continue
+            try:
+                total += _disk_usage(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self._disk_bytes = total
+            self._pending_bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "active": len(self._active),
+                "bytes": self._disk_bytes + self._pending_bytes,
+                "quota": self.total_quota,
+                "reclaimed": self.reclaimed,
+            }
+
+    async def run_janitor(self, interval: float):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(get_io_pool(), self.sweep)
+            except Exception as e:
+                print(f"Workspace sweep failed: {e}")
+            await asyncio.sleep(interval)
+
+
+def _disk_usage(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.stat(path).st_size
+    total = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(folder, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def create_temp_store() -> TempStore:
+    max_request_size = int(os.getenv("MAX_REQUEST_SIZE", 0))
+    request_mb = int(os.getenv("WORKSPACE_QUOTA_MB", 0))
+    return TempStore(
+        os.getenv("WORKSPACE_ROOT") or os.getenv("TEMP_FOLDER", "temp_uploads"),
+        request_mb * 1024 * 1024 if request_mb else max_request_size,
+        int(os.getenv("TEMP_STORE_QUOTA_MB", 10240)) * 1024 * 1024,
+        float(os.getenv("WORKSPACE_MAX_AGE", 3600)),
+    )